@@ -0,0 +1,274 @@
+"""
+Checks that the files referenced by the Files of a NeuronBridge release exist.
+
+While the validation workers read the image lookups and matches, they resolve
+every path in their Files with the prefixes of its store in the data config
+(config.json), or use it as an absolute path if its file type has no prefix,
+and write the locations, deduplicated and sorted, to a run file for each
+batch. Once the validation is done, the runs are merged into a single sorted
+stream, so that each location is only checked once, and the locations are
+checked concurrently:
+
+  local paths   os.stat, in batches of consecutive paths
+  http(s) URLs  HEAD requests over pooled connections, with a cap on the rate
+
+The prefixes can be rewritten before the locations are checked, e.g. to check
+a local copy of a bucket, or an S3-compatible endpoint other than AWS:
+
+./neuronbridge/validate_ray.py --check-assets \\
+    --asset-prefix https://s3.amazonaws.com/janelia-flylight-color-depth/=/nrs/color-depth/
+
+Missing files are counted as "Missing <file type> asset" errors, and logged
+with the first file which references them.
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import itertools
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+from neuronbridge.integrity import MAX_MERGE_FAN_IN, merge_runs, sorted_keys
+
+# Number of concurrent checks
+DEFAULT_THREADS = 32
+
+# Maximum number of HEAD requests per second, across all threads
+DEFAULT_RATE = 200
+
+# Number of consecutive local paths to stat in a single task
+STAT_BATCH_SIZE = 500
+
+# Number of tasks to keep in flight per thread
+TASKS_PER_THREAD = 4
+
+# Number of times to retry a HEAD request which failed or was throttled
+MAX_RETRIES = 3
+
+# Fields of Files which are not paths
+NON_PATH_FIELDS = {"store"}
+
+
+def load_prefixes(config_path:str) -> Dict[str, Dict[str, str]]:
+    """ Returns the file prefixes of each store in the given data config, a
+        local path or a URL. Relative prefixes (such as those written by
+        neuronbridge mirror) are resolved against the directory of the config.
+    """
+    if urlparse(config_path).scheme in ("http", "https"):
+        import requests
+        res = requests.get(config_path)
+        res.raise_for_status()
+        config = res.json()
+    else:
+        with open(config_path) as f:
+            config = json.load(f)
+    base = config_path.rpartition("/")[0]
+    prefixes = {}
+    for store_name, store in config["stores"].items():
+        prefixes[store_name] = {}
+        for file_key, prefix in store["prefixes"].items():
+            if not urlparse(prefix).scheme and not os.path.isabs(prefix):
+                prefix = f"{base}/{prefix}"
+            prefixes[store_name][file_key] = prefix
+    return prefixes
+
+
+def resolve(prefixes:Dict[str, str], file_key:str, path:str) -> str:
+    """ Returns the location of a path from Files, given the prefixes of its
+        store. As documented for DataStore, paths of a file type without a
+        prefix (and absolute URLs) are used as they are.
+    """
+    if urlparse(path).scheme:
+        return path
+    prefix = prefixes.get(file_key)
+    return prefix + path if prefix else path
+
+
+def parse_prefix_map(s:str) -> Tuple[str, str]:
+    """ Parse a prefix rewrite like "https://host/bucket/=/local/dir/".
+    """
+    old, sep, new = s.partition("=")
+    if not sep or not old:
+        raise argparse.ArgumentTypeError(f"Invalid prefix rewrite {s}, expected OLD=NEW")
+    return old, new
+
+
+class AssetCollector:
+    """ Collects the locations of the files referenced by a batch of image
+        lookups or matches, with the first file referencing each of them.
+    """
+
+    def __init__(self, prefixes:Dict[str, Dict[str, str]]):
+        self.prefixes = prefixes
+        self.refs = {}
+
+
+    def add(self, files:Dict, filepath:str):
+        """ Add the paths of the given Files, referenced by the given file.
+        """
+        store_prefixes = self.prefixes.get(files.get("store"), {})
+        for file_key, path in files.items():
+            if file_key in NON_PATH_FIELDS or not path:
+                continue
+            location = resolve(store_prefixes, file_key, path)
+            if location not in self.refs:
+                self.refs[location] = (file_key, filepath)
+
+
+    def write(self, run_file:str):
+        """ Write the locations to the given file as a sorted run of
+            "location\\tfile_key\\tfilepath" lines.
+        """
+        tmp_path = run_file + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(f"{location}\t{file_key}\t{filepath}\n"
+                         for location, (file_key, filepath) in sorted(self.refs.items()))
+        os.replace(tmp_path, run_file)
+
+
+class AssetChecker:
+    """ Checks the existence of local files and URLs concurrently. Consecutive
+        local paths are checked in batches, and URLs with HEAD requests which
+        share a pool of connections and a rate limit.
+    """
+
+    def __init__(self, threads:int=DEFAULT_THREADS, rate:float=DEFAULT_RATE,
+                 rewrites:List[Tuple[str, str]]=None, session=None):
+        from neuronbridge.client import make_session
+        from neuronbridge.mirror import RateLimiter
+        self.threads = threads
+        self.limiter = RateLimiter(rate) if rate else None
+        # The longest prefix wins
+        self.rewrites = sorted(rewrites or [], key=lambda r: len(r[0]), reverse=True)
+        self.session = session or make_session(threads)
+
+
+    def rewrite(self, location:str) -> str:
+        for old, new in self.rewrites:
+            if location.startswith(old):
+                return new + location[len(old):]
+        return location
+
+
+    def stat_batch(self, paths:List[str]) -> List[Optional[Exception]]:
+        """ Returns None for each path which exists, and an exception otherwise.
+        """
+        results = []
+        for path in paths:
+            try:
+                os.stat(path)
+                results.append(None)
+            except OSError as e:
+                results.append(e)
+        return results
+
+
+    def head(self, url:str) -> Optional[Exception]:
+        """ Returns None if the URL exists, and an exception otherwise. Missing
+            objects are 404 on S3, or 403 when the bucket cannot be listed, and
+            both are broken links. Throttled or failed requests are retried.
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            if self.limiter:
+                self.limiter.consume(1)
+            try:
+                res = self.session.head(url, allow_redirects=True)
+            except Exception as e:
+                error = e
+            else:
+                if res.status_code < 400:
+                    return None
+                if res.status_code != 429 and res.status_code < 500:
+                    return FileNotFoundError(f"{url} (status {res.status_code})")
+                error = IOError(f"{url} (status {res.status_code})")
+            if attempt < MAX_RETRIES:
+                time.sleep(0.5 * 2 ** attempt)
+        return error
+
+
+    def head_batch(self, urls:List[str]) -> List[Optional[Exception]]:
+        return [self.head(url) for url in urls]
+
+
+    def _batches(self, refs:Iterable[Tuple[str, str]]):
+        """ Group the given refs into batches of consecutive local paths, and
+            single URLs, each with the function which checks them.
+        """
+        batch = []
+        for location, value in refs:
+            target = self.rewrite(location)
+            if urlparse(target).scheme in ("http", "https"):
+                if batch:
+                    yield self.stat_batch, batch
+                    batch = []
+                yield self.head_batch, [(location, value, target)]
+            else:
+                path = urlparse(target).path if target.startswith("file:") else target
+                batch.append((location, value, path))
+                if len(batch) >= STAT_BATCH_SIZE:
+                    yield self.stat_batch, batch
+                    batch = []
+        if batch:
+            yield self.stat_batch, batch
+
+
+    def check(self, refs:Iterable[Tuple[str, str]]) -> Iterator[Tuple[str, str, Optional[Exception]]]:
+        """ Check the given (location, value) pairs, and yield (location, value,
+            error) for each of them in the same order, where error is None if
+            the location exists. Only a bounded number of checks is in flight.
+        """
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            pending = deque()
+            for fn, batch in self._batches(refs):
+                pending.append((batch, executor.submit(fn, [target for _, _, target in batch])))
+                while len(pending) > self.threads * TASKS_PER_THREAD or (pending and pending[0][1].done()):
+                    batch, future = pending.popleft()
+                    for (location, value, _), error in zip(batch, future.result()):
+                        yield location, value, error
+            for batch, future in pending:
+                for (location, value, _), error in zip(batch, future.result()):
+                    yield location, value, error
+
+
+def unique_refs(runs:List[str]) -> Iterator[Tuple[str, str]]:
+    """ Returns a sorted stream of the distinct locations in the given runs,
+        with the first value found for each of them.
+    """
+    for location, group in itertools.groupby(sorted_keys(runs), key=lambda kv: kv[0]):
+        yield location, next(group)[1]
+
+
+def check_assets(runs:List[str], counter, work_dir:str, checker:AssetChecker=None) -> int:
+    """ Check the locations in the given runs, and count the missing ones as
+        errors in the given Counter. Returns the number of distinct locations.
+    """
+    checker = checker or AssetChecker()
+    if len(runs) > MAX_MERGE_FAN_IN:
+        # Merging removes the runs, which are kept for resumed validations
+        links = []
+        for i, run in enumerate(runs):
+            link = os.path.join(work_dir, f"assets.{i}.run")
+            try:
+                os.link(run, link)
+            except OSError:
+                shutil.copyfile(run, link)
+            links.append(link)
+        runs = merge_runs(links, work_dir, "assets")
+    checked = 0
+    for location, value, error in tqdm(checker.check(unique_refs(runs)), desc="Checking assets", unit=" files"):
+        checked += 1
+        if error is None:
+            continue
+        file_key, _, filepath = value.partition("\t")
+        if isinstance(error, (FileNotFoundError, NotADirectoryError)):
+            counter.error(f"Missing {file_key} asset", location, filepath)
+        else:
+            counter.error("Asset check failed", location, filepath, trace=repr(error))
+    return checked
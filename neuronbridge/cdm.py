@@ -0,0 +1,249 @@
+"""
+Vectorized comparison of color depth MIPs (CDMs).
+
+A CDM encodes the depth of each pixel of a neuron as its color, following the
+rainbow lookup table used by NeuronBridge (magenta at the front, then blue,
+cyan, green, yellow and red at the back). Here the depth is recovered from the
+hue of each pixel, and two CDMs are compared pixel by pixel: a mask pixel
+matches a target pixel if both are above their intensity thresholds and their
+depths are within a given tolerance. This follows the color depth search
+algorithm, although the scores are not identical to the precomputed
+NeuronBridge scores, which also include a gradient term.
+
+The scorer only reads the target pixels under the mask, and reuses its
+buffers across batches, so many candidate matches can be scored at once:
+
+    scorer = CDMScorer(client.get_target_searchable_image(matches[0]))
+    targets = load_cdms([client.get_match_searchable_image(m) for m in matches])
+    scores = scorer.score(targets)
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, List, NamedTuple, Sequence, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from PIL.Image import Image
+    from neuronbridge.client import Client
+    from neuronbridge.model import CDSMatch
+
+# Minimum intensity (max of RGB) for a mask pixel to be considered signal
+DEFAULT_MASK_THRESHOLD = 20
+
+# Minimum intensity (max of RGB) for a target pixel to be considered signal
+DEFAULT_DATA_THRESHOLD = 20
+
+# Tolerated depth difference between matching pixels, as a percentage of the depth range
+DEFAULT_PIX_COLOR_FLUCTUATION = 2.0
+
+# Maximum pixel shift in x and y when looking for a matching target pixel
+DEFAULT_XY_SHIFT = 0
+
+# Number of threads used to fetch images from the client
+DEFAULT_THREADS = 8
+
+
+class Scores(NamedTuple):
+    """ Scores for a batch of targets, as parallel arrays.
+    """
+    matching_pixels: np.ndarray
+    normalized_score: np.ndarray
+    mirrored: np.ndarray
+
+
+def to_array(image:Image) -> np.ndarray:
+    """ Returns the given CDM as an HxWx3 uint8 array.
+    """
+    return np.asarray(image.convert("RGB"), dtype=np.uint8)
+
+
+def load_cdms(images:Sequence[Image], out:np.ndarray=None) -> np.ndarray:
+    """ Stacks the given CDMs into an NxHxWx3 uint8 array. All images must have
+        the same size, e.g. because they are in the same alignment space. If an
+        output array of the right shape is given, it is filled and returned.
+    """
+    if not images:
+        raise ValueError("No images to load")
+    h, w = images[0].size[1], images[0].size[0]
+    shape = (len(images), h, w, 3)
+    if out is None or out.shape != shape:
+        out = np.empty(shape, dtype=np.uint8)
+    for i, image in enumerate(images):
+        if (image.size[1], image.size[0]) != (h, w):
+            raise ValueError(f"Image {i} has size {image.size}, expected {(w, h)}")
+        out[i] = to_array(image)
+    return out
+
+
+def mirror(cdms:np.ndarray) -> np.ndarray:
+    """ Returns a view of the given CDM (HxWx3) or CDMs (NxHxWx3) mirrored
+        along the x axis.
+    """
+    return cdms[..., ::-1, :]
+
+
+def intensity(rgb:np.ndarray) -> np.ndarray:
+    """ Returns the intensity of each pixel, i.e. the max of its channels.
+    """
+    # Element-wise maximum is much faster than a reduction over the short last axis
+    return np.maximum(np.maximum(rgb[..., 0], rgb[..., 1]), rgb[..., 2])
+
+
+def depth(rgb:np.ndarray, out:np.ndarray=None) -> np.ndarray:
+    """ Returns the depth of each pixel as a float32 between 0 (front) and 5/6
+        (back), derived from the hue of the pixel along the color depth lookup
+        table, from magenta to red. Hues between red and magenta, which are not
+        in the table, get the depth of the nearest end. The depth of black pixels
+        is undefined and should be masked using intensity().
+    """
+    rgb = rgb.astype(np.float32)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    mx = np.maximum(np.maximum(r, g), b)
+    delta = mx - np.minimum(np.minimum(r, g), b)
+    np.maximum(delta, 1e-6, out=delta)
+
+    hue = (r - g) / delta + 4
+    sel = mx == g
+    hue[sel] = ((b - r) / delta + 2)[sel]
+    sel = mx == r
+    hue[sel] = ((g - b) / delta)[sel]
+    # Hues between magenta (-1) and red (0) are snapped to the nearest of the two
+    hue[hue < -0.5] = 5
+    np.clip(hue, 0, 5, out=hue)
+    # Map hue (red=0, magenta=5) to depth (magenta=0, red=5/6)
+    return np.multiply(5 - hue, np.float32(1 / 6), out=out, dtype=np.float32)
+
+
+def overlap_mask(mask:np.ndarray, target:np.ndarray,
+                 mask_threshold:int=DEFAULT_MASK_THRESHOLD,
+                 data_threshold:int=DEFAULT_DATA_THRESHOLD,
+                 pix_color_fluctuation:float=DEFAULT_PIX_COLOR_FLUCTUATION) -> np.ndarray:
+    """ Returns a boolean HxW mask of the pixels where the two CDMs match, or
+        an NxHxW mask if the target is a stack of CDMs.
+    """
+    tolerance = pix_color_fluctuation / 100
+    signal = (intensity(mask) > mask_threshold) & (intensity(target) > data_threshold)
+    return signal & (np.abs(depth(mask) - depth(target)) <= tolerance)
+
+
+class CDMScorer:
+    """ Scores a mask CDM against batches of target CDMs.
+
+        The mask pixels and their depths are computed once. For each batch, only
+        the target pixels under the mask (and its shifted positions) are read,
+        into buffers that are reused across batches of the same size.
+    """
+
+    def __init__(self, mask:Image|np.ndarray,
+                 mask_threshold:int=DEFAULT_MASK_THRESHOLD,
+                 data_threshold:int=DEFAULT_DATA_THRESHOLD,
+                 pix_color_fluctuation:float=DEFAULT_PIX_COLOR_FLUCTUATION,
+                 xy_shift:int=DEFAULT_XY_SHIFT,
+                 mirror_mask:bool=False):
+        mask = mask if isinstance(mask, np.ndarray) else to_array(mask)
+        self.shape = mask.shape[:2]
+        self.data_threshold = data_threshold
+        self.tolerance = np.float32(pix_color_fluctuation / 100)
+        self.xy_shift = xy_shift
+        self.variants = [self._prepare(mask, mask_threshold)]
+        if mirror_mask:
+            self.variants.append(self._prepare(mirror(mask), mask_threshold))
+        self._buffers = {}
+
+
+    def _prepare(self, mask:np.ndarray, mask_threshold:int) -> Tuple[np.ndarray, np.ndarray]:
+        """ Returns the flat indices of the target pixels to compare with each
+            mask pixel, for every shift, and the depths of the mask pixels.
+        """
+        h, w = self.shape
+        ys, xs = np.nonzero(intensity(mask) > mask_threshold)
+        mask_depth = depth(mask[ys, xs])
+        offsets = range(-self.xy_shift, self.xy_shift + 1)
+        indices = np.stack([np.clip(ys + dy, 0, h - 1) * w + np.clip(xs + dx, 0, w - 1)
+                            for dy in offsets for dx in offsets])
+        return indices, mask_depth
+
+
+    @property
+    def mask_pixels(self) -> int:
+        """ Number of signal pixels in the mask.
+        """
+        return len(self.variants[0][1])
+
+
+    def _buffer(self, name:str, shape:Tuple[int,...], dtype) -> np.ndarray:
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape:
+            buf = self._buffers[name] = np.empty(shape, dtype=dtype)
+        return buf
+
+
+    def _matching_pixels(self, flat:np.ndarray, indices:np.ndarray, mask_depth:np.ndarray) -> np.ndarray:
+        n, m = flat.shape[0], len(mask_depth)
+        pixels = self._buffer("pixels", (n, m, 3), np.uint8)
+        signal = self._buffer("signal", (n, m), bool)
+        matched = self._buffer("matched", (n, m), bool)
+        mask_depths = np.broadcast_to(mask_depth, (n, m))
+
+        matched.fill(False)
+        for shift_indices in indices:
+            np.take(flat, shift_indices, axis=1, out=pixels)
+            np.greater(intensity(pixels), self.data_threshold, out=signal)
+            # Targets are mostly black under the mask, so the depths are
+            # only computed for the pixels with signal
+            signal &= ~matched
+            diff = np.abs(depth(pixels[signal]) - mask_depths[signal])
+            matched[signal] = diff <= self.tolerance
+        return matched.sum(axis=1)
+
+
+    def score(self, targets:np.ndarray) -> Scores:
+        """ Scores the given NxHxWx3 stack of target CDMs. Returns the number of
+            matching pixels, the fraction of mask pixels that match, and whether
+            the best score was obtained with the mirrored mask.
+        """
+        if targets.shape[1:3] != self.shape:
+            raise ValueError(f"Targets have shape {targets.shape[1:3]}, expected {self.shape}")
+        flat = targets.reshape(targets.shape[0], -1, 3)
+        if not self.mask_pixels:
+            zeros = np.zeros(len(targets), dtype=np.int64)
+            return Scores(zeros, zeros.astype(np.float32), zeros.astype(bool))
+
+        best = None
+        mirrored = np.zeros(len(targets), dtype=bool)
+        for i, (indices, mask_depth) in enumerate(self.variants):
+            pixels = self._matching_pixels(flat, indices, mask_depth)
+            if best is None:
+                best = pixels
+            else:
+                mirrored = pixels > best
+                best = np.maximum(best, pixels)
+        return Scores(best, (best / self.mask_pixels).astype(np.float32), mirrored)
+
+
+def rescore_matches(client:Client, matches:List[CDSMatch],
+                    batch_size:int=64, threads:int=DEFAULT_THREADS, **kwargs) -> List[Tuple[CDSMatch, int, float, bool]]:
+    """ Recomputes the color depth scores for the given CDS matches, which all
+        share the same input image. The searchable images are fetched
+        concurrently and scored in batches. Returns (match, matching_pixels,
+        normalized_score, mirrored) tuples, sorted by descending score. Any
+        other keyword arguments are passed to the CDMScorer.
+    """
+    if not matches:
+        return []
+    scorer = CDMScorer(client.get_target_searchable_image(matches[0]), **kwargs)
+    results = []
+    targets = None
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for start in range(0, len(matches), batch_size):
+            batch = matches[start:start+batch_size]
+            images = list(executor.map(client.get_match_searchable_image, batch))
+            targets = load_cdms(images, out=targets)
+            scores = scorer.score(targets)
+            results.extend(zip(batch, scores.matching_pixels.tolist(),
+                               scores.normalized_score.tolist(), scores.mirrored.tolist()))
+    results.sort(key=lambda r: r[2], reverse=True)
+    return results
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+"""
+Entry point for the neuronbridge command line tools. Each sub-command is a
+module with its own main(argv) function, e.g.
+
+    neuronbridge mirror --help
+"""
+
+import sys
+import importlib
+
+# Sub-command name -> module implementing it
+COMMANDS = {
+    "mirror": "neuronbridge.mirror",
+    "merge-logs": "neuronbridge.merge_logs",
+    "integrity": "neuronbridge.integrity",
+    "diff": "neuronbridge.diff",
+    "serve": "neuronbridge.serve",
+    "search": "neuronbridge.search",
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in COMMANDS:
+        print("usage: neuronbridge <command> [options]", file=sys.stderr)
+        print(f"commands: {', '.join(COMMANDS)}", file=sys.stderr)
+        return 2
+    module = importlib.import_module(COMMANDS[argv[0]])
+    return module.main(argv[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
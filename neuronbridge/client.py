@@ -1,64 +1,427 @@
-import requests
-from PIL import Image
-from neuronbridge.model import *
+from __future__ import annotations
+
+import os
+import json
+import time
 import logging
+import threading
+from urllib.parse import urlparse
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple, Union
+
+# The heavy dependencies (requests, PIL and the pydantic model) are imported
+# lazily, on first use, so that importing this module and creating a Client
+# stays cheap for short-lived jobs.
+if TYPE_CHECKING:
+    from PIL.Image import Image
+    from neuronbridge.model import DataConfig, Files, NeuronImage, EMImage, LMImage, \
+        Match, CDSMatch, PPPMatch
+    from neuronbridge.stack import ImageStack
+    from neuronbridge.swc import Skeleton
+
+# Number of concurrent requests made by the batch methods, and the number of
+# connections kept open to each host
+DEFAULT_THREADS = 16
+
+# Maximum total size of the responses kept by a ResponseCache, in bytes
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+# Number of recent latencies kept per endpoint to compute the percentiles
+LATENCY_WINDOW = 1000
+
+
+def make_session(pool_size : int = DEFAULT_THREADS):
+    """
+    Returns a requests.Session which keeps up to pool_size open connections to each host.
+    """
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache of response bodies, keyed by URL and bounded by their total size.
+    The raw bytes are kept, so that every caller gets its own freshly parsed objects.
+    """
+
+    def __init__(self, max_bytes : int = DEFAULT_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.responses = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, url : str) -> Optional[bytes]:
+        with self.lock:
+            content = self.responses.get(url)
+            if content is not None:
+                self.responses.move_to_end(url)
+            return content
+
+
+    def put(self, url : str, content : bytes):
+        if len(content) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.responses.pop(url, None)
+            if old is not None:
+                self.nbytes -= len(old)
+            self.responses[url] = content
+            self.nbytes += len(content)
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.responses.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the function,
+    and callers arriving while it is in flight wait for it and get the same result (or
+    exception) instead of running it again.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+
+    def do(self, key, fn) -> Tuple[Future, bool]:
+        """
+        Returns a future of the result, and whether it is shared with a call which was 
+        already in flight. The future is done when the first caller returns.
+        """
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            return future, True
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return future, False
+
+
+class LatencyStats:
+    """
+    Thread-safe latency counters per endpoint (e.g. "metadata/by_body"). For each endpoint,
+    the number of calls, errors and calls coalesced with an identical call in flight are
+    counted, and the latencies of the most recent calls are kept for the percentiles.
+    """
+
+    def __init__(self, window : int = LATENCY_WINDOW):
+        self.window = window
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+
+    def record(self, endpoint : str, seconds : float, shared : bool = False, error : bool = False):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {"count": 0, "errors": 0, "coalesced": 0, 
+                    "total": 0.0, "max": 0.0, "recent": deque(maxlen=self.window)}
+            stats["count"] += 1
+            stats["errors"] += error
+            stats["coalesced"] += shared
+            stats["total"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            stats["recent"].append(seconds)
+
+
+    def summary(self) -> Dict[str, Dict]:
+        """
+        Returns the counts and the mean, max and p50/p95/p99 latencies (of the recent 
+        calls) in milliseconds, for each endpoint.
+        """
+        with self.lock:
+            endpoints = {name: (dict(stats), sorted(stats["recent"])) for name, stats in self.endpoints.items()}
+        summary = {}
+        for name, (stats, recent) in endpoints.items():
+            percentile = lambda p: recent[min(int(p * len(recent)), len(recent) - 1)] * 1000
+            summary[name] = {
+                "count": stats["count"],
+                "errors": stats["errors"],
+                "coalesced": stats["coalesced"],
+                "mean_ms": stats["total"] / stats["count"] * 1000,
+                "p50_ms": percentile(0.50),
+                "p95_ms": percentile(0.95),
+                "p99_ms": percentile(0.99),
+                "max_ms": stats["max"] * 1000,
+            }
+        return summary
+
 
 class Client:
-    def __init__(self, data_bucket="janelia-neuronbridge-data-prod", version="current"):
+    def __init__(self, data_bucket="janelia-neuronbridge-data-prod", version="current", config_file=None, data_url=None,
+                 session=None, cache : ResponseCache = None):
         """
-        Client constructor. 
-        
-        When the client is created, it retrieves the configuration for the specified version. 
-        If ``version='current'`` then the latest version is first retrieved from NeuronBridge.
-        
+        Client constructor.
+
+        The client does not make any network calls until they are needed. The configuration
+        for the specified version is retrieved the first time it is used. If ``version='current'``
+        then the latest version is first retrieved from NeuronBridge.
+
+        If a ``config_file`` is given, the configuration is read from that local file instead.
+        If the file does not exist yet, it is created from the downloaded configuration, so
+        that later clients can start without fetching it again. The version of a snapshot
+        created this way is recorded next to it (in ``<config_file>.version``), and the
+        snapshot is downloaded again when a client asks for another version. Pass an explicit
+        version together with a config_file to avoid any network calls at startup.
+
+        If a ``data_url`` is given, the metadata is read from there instead of the S3 bucket.
+        This can be another URL or a local directory, such as a mirror created with
+        ``neuronbridge mirror``. In that case, the version defaults to the last component
+        of the data_url.
+
+        The client is thread-safe. Concurrent calls which need the same file (e.g. many 
+        threads of a web service asking for the matches of a popular body) share a single
+        fetch and JSON parse, and the latencies of the calls are counted per endpoint
+        (see latency_stats).
+
         Args:
             data_bucket:
                 name of the S3 bucket containing the NeuronBridge metadata
             version:
                 version number (e.g. "v3.0.0") or "current" to use the latest version
-                
+            config_file:
+                optional path to a local snapshot of the version's config.json
+            data_url:
+                optional URL or local directory holding the metadata for one version
+            session:
+                optional requests.Session to use, e.g. to share connections between clients
+            cache:
+                optional ResponseCache for the fetched metadata, which can be shared between clients
+
+        """
+        self.data_url_prefix = f"https://{data_bucket}.s3.us-east-1.amazonaws.com"
+        self.config_file = config_file
+        self._data_url = data_url.rstrip("/") if data_url else None
+        self._version = None if version == "current" else version
+        self._config = None
+        self._session = session
+        self._cache = cache
+        # Reentrant, since loading the config needs the session
+        self._lock = threading.RLock()
+        self._flights = SingleFlight()
+        self.stats = LatencyStats()
+
+
+    @property
+    def version(self) -> str:
+        """
+        The data version used by this client, resolved on first access if it is "current".
+        """
+        if self._version is None:
+            with self._lock:
+                if self._version is None and self._data_url:
+                    self._version = os.path.basename(self._data_url)
+                if self._version is None:
+                    url = self.data_url_prefix + "/current.txt"
+                    res = self._get(url)
+                    self._version = res.text.rstrip()
+        return self._version
+
+
+    @property
+    def data_url(self) -> str:
         """
+        Base URL of the metadata for the selected version.
+        """
+        if self._data_url:
+            return self._data_url
+        return f"{self.data_url_prefix}/{self.version}"
 
-        data_url_prefix = f"https://{data_bucket}.s3.us-east-1.amazonaws.com"
 
-        if version == "current":
-            url = data_url_prefix + "/current.txt"
-            res = requests.get(url)
-            if res.status_code != 200:
-                raise Exception("Could not retrieve "+url)
-            self.version = res.text.rstrip()
-        else:
-            self.version = version
-            
-        self.data_url = f"{data_url_prefix}/{self.version}"
-        url = self.data_url + "/config.json"
-        res = requests.get(url)
-        if res.status_code != 200:
-            raise Exception("Could not retrieve "+url)
+    @property
+    def config(self) -> DataConfig:
+        """
+        The DataConfig for the selected version, loaded on first access.
+        """
+        if self._config is None:
+            with self._lock:
+                if self._config is None:
+                    self._config = self._load_config()
+        return self._config
 
-        self.config = DataConfig(**res.json())
 
+    def _load_config(self) -> DataConfig:
+        """
+        Reads the configuration from the local snapshot, if any, or else downloads it.
+        """
+        from neuronbridge.model import DataConfig
 
-    def _get_image(self, url):
+        if self.config_file and os.path.exists(self.config_file) \
+                and self._snapshot_version() in (None, self.version):
+            with open(self.config_file) as f:
+                return DataConfig(**json.load(f))
+
+        obj = self._get_json(self.data_url + "/config.json")
+        if self.config_file:
+            with open(self.config_file, 'w') as f:
+                json.dump(obj, f, indent=2)
+            with open(self.config_file + ".version", 'w') as f:
+                f.write(self.version)
+        return DataConfig(**obj)
+
+
+    def _snapshot_version(self):
         """
-        Fetches and opens the image at the given URL.
+        Returns the version of the config snapshot, or None if it was not written by a client.
         """
-        res = requests.get(url, stream=True)
+        try:
+            with open(self.config_file + ".version") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+
+    def _local_path(self, url):
+        """
+        Returns the local file path for the given URL, or None if it is a remote URL.
+        """
+        parsed = urlparse(url)
+        if parsed.scheme == "file":
+            return parsed.path
+        if parsed.scheme in ("http", "https"):
+            return None
+        return url
+
+
+    def _get_session(self):
+        """
+        Returns the HTTP session shared by all the requests of this client, which
+        keeps a pool of open connections to each host.
+        """
+        with self._lock:
+            if self._session is None:
+                self._session = make_session()
+            return self._session
+
 
+    def _get(self, url, **kwargs):
+        """
+        Fetches the given URL and returns the response. Raises FileNotFoundError
+        if it does not exist, as when reading a missing local file.
+        """
+        res = self._get_session().get(url, **kwargs)
+
+        if res.status_code == 404:
+            raise FileNotFoundError("Could not retrieve "+url)
         if res.status_code != 200:
             raise Exception("Could not retrieve "+url)
 
+        return res
+
+
+    def _endpoint(self, url) -> str:
+        """
+        Returns the name under which the latency of a fetch is counted: the directory of
+        the file relative to the data_url (e.g. "metadata/by_body"), or else the host.
+        """
+        base = self._data_url or (self._version and f"{self.data_url_prefix}/{self._version}")
+        if base and url.startswith(base + "/"):
+            path = url[len(base)+1:]
+            return os.path.dirname(path) or path
+        return urlparse(url).netloc or "local"
+
+
+    def _coalesce(self, kind : str, url, fetch):
+        """
+        Runs fetch(url), sharing the result with any identical call already in flight,
+        and records its latency.
+        """
+        start = time.perf_counter()
+        future, shared = self._flights.do((kind, url), lambda: fetch(url))
+        try:
+            result = future.result()
+        except Exception:
+            self.stats.record(self._endpoint(url), time.perf_counter() - start, shared=shared, error=True)
+            raise
+        self.stats.record(self._endpoint(url), time.perf_counter() - start, shared=shared)
+        return result
+
+
+    def _get_json(self, url):
+        """
+        Fetches the given URL and returns the parsed JSON object. The object may be 
+        shared with concurrent callers, so it must not be modified.
+        """
+        return self._coalesce("json", url, self._fetch_json)
+
+
+    def _fetch_json(self, url):
+        path = self._local_path(url)
+        if path:
+            with open(path) as f:
+                return json.load(f)
+        if self._cache is None:
+            return self._get(url).json()
+        return json.loads(self._fetch_bytes(url))
+
+
+    def _get_bytes(self, url) -> bytes:
+        """
+        Fetches the given URL and returns its content.
+        """
+        return self._coalesce("bytes", url, self._fetch_bytes)
+
+
+    def _fetch_bytes(self, url) -> bytes:
+        path = self._local_path(url)
+        if path:
+            with open(path, 'rb') as f:
+                return f.read()
+        if self._cache is None:
+            return self._get(url).content
+        content = self._cache.get(url)
+        if content is None:
+            content = self._get(url).content
+            self._cache.put(url, content)
+        return content
+
+
+    def latency_stats(self) -> Dict[str, Dict]:
+        """
+        Returns the call counts and latencies of the metadata fetched by this client, 
+        per endpoint (see LatencyStats.summary).
+        """
+        return self.stats.summary()
+
+
+    def _get_image(self, url):
+        """
+        Fetches and opens the image at the given URL.
+        """
+        from PIL import Image
+        path = self._local_path(url)
+        if path:
+            return Image.open(path)
+        res = self._get(url, stream=True)
         return Image.open(res.raw)
 
 
     def _get_files_url(self, files : Files, file_key : str) -> str:
         """
-        Returns the full URL to the given file.
+        Returns the full URL to the given file. Relative prefixes (such as those written
+        by ``neuronbridge mirror``) are resolved against the data_url.
         """
         store = files.store
         prefixes = self.config.stores[store].prefixes
         prefix = prefixes[file_key]
         if not prefix: raise Exception("Config has no prefix for file type '"+file_key+"'")
+        if not urlparse(prefix).scheme and not os.path.isabs(prefix):
+            prefix = f"{self.data_url}/{prefix}"
         if self.version not in prefix or True:
             logging.warn(f"Version {self.version} not in prefix. NeuronBridge metadata seems to be out of date.")
         path = getattr(files, file_key)
@@ -76,7 +439,7 @@ class Client:
         url = self._get_files_url(match.image.files, file_key)
         if url: return url
         raise Exception("Match contains no file with type '"+file_key+"'")
-    
+
 
     def get_em_image(self, body_id) -> EMImage:
         images = self.get_em_images(body_id)
@@ -88,58 +451,79 @@ class Client:
         """
         Returns the EMImage for the specified body ID.
         """
-        
+        from neuronbridge.model import ImageLookup
         url = f"{self.data_url}/metadata/by_body/{body_id}.json"
-        res = requests.get(url)
+        return ImageLookup(**self._get_json(url)).results
 
-        if res.status_code != 200:
-            raise Exception("Could not retrieve "+url)
 
-        return ImageLookup(**res.json()).results
-
-    
     def get_lm_images(self, line_id) -> List[LMImage]:
         """
         Returns the LMImages for the specified line ID.
         """
-        
+        from neuronbridge.model import ImageLookup
         url = f"{self.data_url}/metadata/by_line/{line_id}.json"
-        res = requests.get(url)
+        return ImageLookup(**self._get_json(url)).results
 
-        if res.status_code != 200:
-            raise Exception("Could not retrieve "+url)
 
-        return ImageLookup(**res.json()).results
+    def _get_images_batch(self, lookup_dir : str, ids : Iterable, threads : int) -> Dict:
+        """
+        Fetches and parses the image lookups for the given ids concurrently.
+        """
+        from neuronbridge.model import ImageLookup
 
-    
-    def get_cds_matches(self, neuron_image : NeuronImage) -> List[CDSMatch]:
+        def fetch(key):
+            try:
+                url = f"{self.data_url}/metadata/{lookup_dir}/{key}.json"
+                return ImageLookup(**self._get_json(url)).results
+            except Exception as e:
+                return e
+
+        ids = list(ids)
+        keys = list(dict.fromkeys(str(i) for i in ids))
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = dict(zip(keys, executor.map(fetch, keys)))
+        return {i: results[str(i)] for i in ids}
+
+
+    def get_em_images_batch(self, body_ids : Iterable, threads : int = DEFAULT_THREADS) -> Dict:
         """
-        Returns the CDS matches for the specified neuron image (i.e. LMImage or EMImage).
+        Returns the EMImages for many body IDs at once, as a dict keyed by body ID.
+        Duplicate IDs are only fetched once, and the lookups are fetched and parsed 
+        concurrently over pooled connections. If a lookup fails (e.g. the body does 
+        not exist), the value for its ID is the exception instead of a list of images.
         """
+        return self._get_images_batch("by_body", body_ids, threads)
 
-        url = self._get_files_url(neuron_image.files, 'CDSResults')
-        res = requests.get(url)
 
-        if res.status_code != 200:
-            raise Exception("Could not retrieve "+url)
+    def get_lm_images_batch(self, line_ids : Iterable, threads : int = DEFAULT_THREADS) -> Dict:
+        """
+        Returns the LMImages for many line IDs at once, as a dict keyed by line ID.
+        Duplicate IDs are only fetched once, and the lookups are fetched and parsed 
+        concurrently over pooled connections. If a lookup fails (e.g. the line does 
+        not exist), the value for its ID is the exception instead of a list of images.
+        """
+        return self._get_images_batch("by_line", line_ids, threads)
+
 
-        cds_matches = PrecomputedMatches(**res.json())
+    def get_cds_matches(self, neuron_image : NeuronImage) -> List[CDSMatch]:
+        """
+        Returns the CDS matches for the specified neuron image (i.e. LMImage or EMImage).
+        """
+        from neuronbridge.model import PrecomputedMatches
+        url = self._get_files_url(neuron_image.files, 'CDSResults')
+        cds_matches = PrecomputedMatches(**self._get_json(url))
         results = cds_matches.results
 
         return results
-    
-    
+
+
     def get_ppp_matches(self, em_image : EMImage) -> List[PPPMatch]:
         """
         Returns the PPPM matches for the specified EMImage.
         """
+        from neuronbridge.model import PrecomputedMatches
         url = self._get_files_url(em_image.files, 'PPPMResults')
-        res = requests.get(url)
-
-        if res.status_code != 200:
-            raise Exception("Could not retrieve "+url)
-
-        ppp_matches = PrecomputedMatches(**res.json())
+        ppp_matches = PrecomputedMatches(**self._get_json(url))
         results = ppp_matches.results
 
         return results
@@ -184,17 +568,160 @@ class Client:
         return self._get_image(url)
 
 
-    def get_swc_skeleton(self, match : PPPMatch) -> Image:
+    def _get_swc_url(self, item : Union[NeuronImage, Match]) -> str:
         """
-        Returns the SWC skeleton for the specified PPPMatch.
+        Returns the URL of the SWC skeleton of an EMImage, or of the image of a match.
         """
-        url = self._get_match_url(match, 'AlignedBodySWC')
-        return self._get_image(url)
+        if hasattr(item, "image"):
+            return self._get_match_url(item, 'AlignedBodySWC')
+        url = self._get_files_url(item.files, 'AlignedBodySWC')
+        if not url: raise Exception("Image has no file with type 'AlignedBodySWC'")
+        return url
+
+
+    def get_swc_skeleton(self, item : Union[EMImage, Match]) -> Skeleton:
+        """
+        Returns the SWC skeleton of the specified EMImage (or the EMImage of a match),
+        with the nodes parsed into NumPy arrays.
+        """
+        from neuronbridge.swc import read_swc
+        return read_swc(self._get_bytes(self._get_swc_url(item)))
+
+
+    def get_swc_skeletons_batch(self, items : Iterable[Union[EMImage, Match]], 
+                                threads : int = DEFAULT_THREADS) -> Dict:
+        """
+        Returns the SWC skeletons of many EMImages (e.g. the results of get_em_images)
+        or of the EMImages of many matches at once, as a dict keyed by image ID. The 
+        skeletons are fetched and parsed concurrently over pooled connections. If a
+        skeleton cannot be loaded, the value for its ID is the exception instead.
+        """
+        from neuronbridge.swc import read_swc
+
+        def fetch(item):
+            try:
+                return read_swc(self._get_bytes(self._get_swc_url(item)))
+            except Exception as e:
+                return e
+
+        by_id = {}
+        for item in items:
+            image = item.image if hasattr(item, "image") else item
+            by_id.setdefault(image.id, item)
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            return dict(zip(by_id, executor.map(fetch, by_id.values())))
 
 
-    def get_image_stack(self, match : Match) -> Image:
+    def get_image_stack(self, match : Match, **kwargs) -> ImageStack:
         """
-        Returns the LM image stack for the specified Match.
+        Returns the LM image stack for the specified Match, as a lazily loaded ImageStack.
+        Only the HDF5 metadata is read when the stack is opened. Channels and slices are 
+        fetched with range requests (or file seeks, for local data) as they are accessed, 
+        e.g. stack[0, 40:60] only reads the first channel up to slice 60. Any keyword 
+        arguments are passed to the ImageStack, e.g. block_size and cache_blocks.
         """
+        from neuronbridge.stack import ImageStack
         url = self._get_match_url(match, 'VisuallyLosslessStack')
-        return self._get_image(url)
+        path = self._local_path(url)
+        if path:
+            return ImageStack(path, **kwargs)
+        return ImageStack(url, session=self._get_session(), **kwargs)
+
+
+class MultiVersionClient:
+    def __init__(self, versions : List[str], data_bucket="janelia-neuronbridge-data-prod", data_url_prefix=None,
+                 cache_size : int = DEFAULT_CACHE_SIZE, threads : int = DEFAULT_THREADS):
+        """
+        Client for queries across several versions of the data, e.g. to follow a neuron's
+        matches from one release to the next.
+
+        There is one Client per version, created on first use, and each one fetches its own
+        configuration lazily. The clients share a single pool of HTTP connections and a single
+        cache of the fetched metadata. Queries which take a list of versions run them 
+        concurrently and return a dict keyed by version. If a query fails for a version 
+        (e.g. the image does not exist in that release), the value for that version is the 
+        exception instead.
+
+        Args:
+            versions:
+                versions to query by default, e.g. ["v3.0.0", "v3.4.0"]
+            data_bucket:
+                name of the S3 bucket containing the NeuronBridge metadata
+            data_url_prefix:
+                optional URL or local directory holding one subdirectory per version, 
+                such as a mirror or a server started with ``neuronbridge serve``
+            cache_size:
+                maximum total size of the cached metadata, in bytes
+            threads:
+                maximum number of versions to query concurrently
+
+        """
+        self.versions = list(versions)
+        self.data_bucket = data_bucket
+        self.data_url_prefix = data_url_prefix.rstrip("/") if data_url_prefix else None
+        self.threads = threads
+        self.cache = ResponseCache(cache_size)
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._session = None
+
+
+    def client(self, version : str) -> Client:
+        """
+        Returns the Client for the given version.
+        """
+        with self._lock:
+            if version not in self._clients:
+                if self._session is None:
+                    self._session = make_session()
+                data_url = f"{self.data_url_prefix}/{version}" if self.data_url_prefix else None
+                self._clients[version] = Client(data_bucket=self.data_bucket, version=version, data_url=data_url,
+                                                session=self._session, cache=self.cache)
+            return self._clients[version]
+
+
+    def _map(self, method : str, *args, versions : List[str] = None) -> Dict:
+        """
+        Calls the given Client method for each version concurrently.
+        """
+        def call(version):
+            try:
+                return getattr(self.client(version), method)(*args)
+            except Exception as e:
+                return e
+
+        versions = self.versions if versions is None else versions
+        if not versions:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.threads, len(versions))) as executor:
+            return dict(zip(versions, executor.map(call, versions)))
+
+
+    def get_em_images(self, body_id, versions : List[str] = None) -> Dict:
+        """
+        Returns the EMImages for the specified body ID in each version.
+        """
+        return self._map("get_em_images", body_id, versions=versions)
+
+
+    def get_lm_images(self, line_id, versions : List[str] = None) -> Dict:
+        """
+        Returns the LMImages for the specified line ID in each version.
+        """
+        return self._map("get_lm_images", line_id, versions=versions)
+
+
+    def get_cds_matches(self, neuron_image : NeuronImage, versions : List[str] = None) -> Dict:
+        """
+        Returns the CDS matches for the specified neuron image in each version. The image's
+        CDSResults file is looked up in each version, so this works as long as the image 
+        keeps its id across the versions.
+        """
+        return self._map("get_cds_matches", neuron_image, versions=versions)
+
+
+    def get_ppp_matches(self, em_image : EMImage, versions : List[str] = None) -> Dict:
+        """
+        Returns the PPPM matches for the specified EMImage in each version.
+        """
+        return self._map("get_ppp_matches", em_image, versions=versions)
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+"""
+This program compares two NeuronBridge releases and reports what changed:
+which metadata files were added or removed and, for each changed file, which
+images were added or removed and how the ranks and scores of the matches
+shifted.
+
+Two local release trees can be compared in full:
+
+    neuronbridge diff /nrs/neuronbridge/v3.3.0 /nrs/neuronbridge/v3.4.0 -o diff-v3.4.0
+
+Or a set of bodies and lines can be compared through the client:
+
+    neuronbridge diff --old-version v3.3.0 --new-version v3.4.0 --bodies 1734696429 --lines LH173
+
+Files with identical sizes are compared by hash first, so that unchanged files
+are skipped without parsing them. The report is written as JSON lines, one
+record per changed file, with a summary of the counts next to it.
+"""
+
+import os
+import sys
+import hashlib
+import argparse
+from typing import Dict, Iterator, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import rapidjson
+from tqdm import tqdm
+
+# Number of files to compare in a single task
+BATCH_SIZE = 500
+
+# Number of threads used to fetch files through the client
+DEFAULT_THREADS = 16
+
+# Scores compared for each type of match
+SCORE_FIELDS = ["normalizedScore", "matchingPixels", "pppmScore", "pppmRank"]
+
+# Fields compared for each image
+IMAGE_FIELDS = ["publishedName", "libraryName", "alignmentSpace", "anatomicalArea", "files"]
+
+
+def file_hash(filepath:str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _index_matches(obj) -> Dict[str, Tuple[int, Dict]]:
+    """ Returns {image id: (rank, match)}. If an image is matched more than once,
+        only its best ranked match is kept.
+    """
+    index = {}
+    for rank, match in enumerate(obj.get("results") or []):
+        image_id = (match.get("image") or {}).get("id")
+        if image_id not in index:
+            index[image_id] = (rank, match)
+    return index
+
+
+def diff_matches(old, new) -> Dict:
+    """ Compare two Matches objects. Returns the added and removed images and the
+        rank and score changes of the images present in both, as [id, old, new]
+        and [id, field, old, new] lists.
+    """
+    old_index = _index_matches(old)
+    new_index = _index_matches(new)
+    changes = {
+        "added": [i for i in new_index if i not in old_index],
+        "removed": [i for i in old_index if i not in new_index],
+        "rank_changes": [],
+        "score_changes": [],
+    }
+    for image_id, (new_rank, new_match) in new_index.items():
+        if image_id not in old_index:
+            continue
+        old_rank, old_match = old_index[image_id]
+        if old_rank != new_rank:
+            changes["rank_changes"].append([image_id, old_rank, new_rank])
+        for field in SCORE_FIELDS:
+            if old_match.get(field) != new_match.get(field):
+                changes["score_changes"].append([image_id, field, old_match.get(field), new_match.get(field)])
+
+    old_input = (old.get("inputImage") or {}).get("id")
+    new_input = (new.get("inputImage") or {}).get("id")
+    if old_input != new_input:
+        changes["input_image"] = [old_input, new_input]
+    return changes
+
+
+def diff_lookups(old, new) -> Dict:
+    """ Compare two ImageLookups. Returns the added and removed images, and the
+        images whose fields changed, as [id, [fields]] lists.
+    """
+    old_images = {image.get("id"): image for image in old.get("results") or []}
+    new_images = {image.get("id"): image for image in new.get("results") or []}
+    changes = {
+        "added": [i for i in new_images if i not in old_images],
+        "removed": [i for i in old_images if i not in new_images],
+        "changed": [],
+    }
+    for image_id, new_image in new_images.items():
+        old_image = old_images.get(image_id)
+        if old_image is None:
+            continue
+        fields = [f for f in IMAGE_FIELDS if old_image.get(f) != new_image.get(f)]
+        if fields:
+            changes["changed"].append([image_id, fields])
+    return changes
+
+
+def diff_objects(old, new) -> Optional[Dict]:
+    """ Compare two parsed metadata files. Returns None if there are no changes.
+    """
+    if "inputImage" in new or "inputImage" in old:
+        changes = diff_matches(old, new)
+    else:
+        changes = diff_lookups(old, new)
+    if not any(changes.values()):
+        return None
+    return changes
+
+
+def diff_files(old_root:str, new_root:str, relpaths:List[str]) -> List[Dict]:
+    """ Compare the given files, which exist in both trees. Returns a change
+        record for each file that changed.
+    """
+    records = []
+    for relpath in relpaths:
+        old_path = os.path.join(old_root, relpath)
+        new_path = os.path.join(new_root, relpath)
+        if os.path.getsize(old_path) == os.path.getsize(new_path) \
+                and file_hash(old_path) == file_hash(new_path):
+            continue
+        with open(old_path) as f:
+            old = rapidjson.load(f)
+        with open(new_path) as f:
+            new = rapidjson.load(f)
+        changes = diff_objects(old, new)
+        if changes:
+            records.append({"path": relpath, "status": "changed", **changes})
+    return records
+
+
+def list_files(root:str) -> List[str]:
+    """ Returns the sorted relative paths of all the JSON files under the given root.
+    """
+    paths = []
+    for dirpath, _, files in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        for filename in files:
+            if filename.endswith(".json"):
+                paths.append(filename if rel == "." else os.path.join(rel, filename))
+    paths.sort()
+    return paths
+
+
+def diff_trees(old_root:str, new_root:str, cores:int=None) -> Iterator[Dict]:
+    """ Compare two local release trees. Yields a change record for each file
+        which was added, removed or changed.
+    """
+    old_paths = list_files(old_root)
+    new_paths = list_files(new_root)
+    old_set = set(old_paths)
+    new_set = set(new_paths)
+
+    for relpath in old_paths:
+        if relpath not in new_set:
+            yield {"path": relpath, "status": "removed"}
+    for relpath in new_paths:
+        if relpath not in old_set:
+            yield {"path": relpath, "status": "added"}
+
+    common = [p for p in new_paths if p in old_set]
+    batches = [common[i:i+BATCH_SIZE] for i in range(0, len(common), BATCH_SIZE)]
+    with ProcessPoolExecutor(max_workers=cores) as executor:
+        futures = [executor.submit(diff_files, old_root, new_root, batch) for batch in batches]
+        with tqdm(total=len(common), desc="Comparing files") as pbar:
+            for batch, future in zip(batches, futures):
+                yield from future.result()
+                pbar.update(len(batch))
+
+
+def diff_clients(old_client, new_client, body_ids:List[str]=(), line_ids:List[str]=(),
+                 threads:int=DEFAULT_THREADS) -> Iterator[Dict]:
+    """ Compare the lookups of the given bodies and lines, and the matches of
+        their images, between the releases served by two clients. Files which
+        could not be fetched (other than missing ones) or parsed are reported
+        with an "error" status.
+    """
+    from neuronbridge.model import Files
+
+    def fetch(client, url):
+        """ Returns the content of the URL, or None if it does not exist.
+        """
+        try:
+            return client._get_bytes(url)
+        except FileNotFoundError:
+            return None
+
+    def compare(path, old_url, new_url):
+        """ Returns the change record (or None) and the parsed old and new
+            objects, which are None if missing or if the files are identical.
+        """
+        try:
+            return compare_files(path, old_url, new_url)
+        except Exception as e:
+            # Timeouts, server errors and invalid JSON are not missing files
+            return {"path": path, "status": "error", "error": repr(e)}, None, None
+
+    def compare_files(path, old_url, new_url):
+        old_data, new_data = fetch(old_client, old_url), fetch(new_client, new_url)
+        if old_data is None and new_data is None:
+            return None, None, None
+        if old_data is None:
+            return {"path": path, "status": "added"}, None, None
+        if new_data is None:
+            return {"path": path, "status": "removed"}, None, None
+        old, new = rapidjson.loads(old_data), rapidjson.loads(new_data)
+        if old_data == new_data:
+            return None, old, new
+        changes = diff_objects(old, new)
+        return ({"path": path, "status": "changed", **changes} if changes else None), old, new
+
+    lookups = [f"metadata/by_body/{i}.json" for i in body_ids] + \
+              [f"metadata/by_line/{i}.json" for i in line_ids]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        match_files = {}
+        results = executor.map(lambda p: compare(p, f"{old_client.data_url}/{p}", f"{new_client.data_url}/{p}"), lookups)
+        for record, old, new in results:
+            if record:
+                yield record
+            if old is None or new is None:
+                continue
+            # Compare the matches of the images present in both releases
+            old_images = {image["id"]: image for image in old.get("results") or []}
+            for image in new.get("results") or []:
+                old_image = old_images.get(image["id"])
+                if old_image is None:
+                    continue
+                old_files, new_files = Files(**old_image["files"]), Files(**image["files"])
+                for file_type in ["CDSResults", "PPPMResults"]:
+                    if getattr(old_files, file_type) and getattr(new_files, file_type):
+                        match_files[f"{file_type}/{image['id']}"] = (
+                            old_client._get_files_url(old_files, file_type),
+                            new_client._get_files_url(new_files, file_type))
+
+        results = executor.map(lambda item: compare(item[0], *item[1]), match_files.items())
+        for record, _, _ in results:
+            if record:
+                yield record
+
+
+def write_report(records:Iterator[Dict], output_dir:str) -> Dict:
+    """ Write the change records to changes.jsonl and the counts to summary.json.
+        Returns the summary.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    summary = {"added": 0, "removed": 0, "changed": 0, "error": 0, "images_added": 0, "images_removed": 0,
+               "rank_changes": 0, "score_changes": 0}
+    with open(os.path.join(output_dir, "changes.jsonl"), "w") as f:
+        for record in records:
+            f.write(rapidjson.dumps(record) + "\n")
+            summary[record["status"]] += 1
+            summary["images_added"] += len(record.get("added", []))
+            summary["images_removed"] += len(record.get("removed", []))
+            summary["rank_changes"] += len(record.get("rank_changes", []))
+            summary["score_changes"] += len(record.get("score_changes", []))
+    with open(os.path.join(output_dir, "summary.json"), "w") as f:
+        f.write(rapidjson.dumps(summary, indent=2))
+    return summary
+
+
+def main(argv:List[str]=None):
+
+    parser = argparse.ArgumentParser(prog="neuronbridge diff", fromfile_prefix_chars="@",
+        description='Compare two NeuronBridge releases and report the changes')
+    parser.add_argument('old', type=str, nargs='?', default=None, \
+        help='Old release directory')
+    parser.add_argument('new', type=str, nargs='?', default=None, \
+        help='New release directory')
+    parser.add_argument('-o', '--output', type=str, default="diff", \
+        help='Directory where the change report is written')
+    parser.add_argument('--cores', type=int, default=None, \
+        help='Number of worker processes to use for local trees')
+    parser.add_argument('--old-version', dest='old_version', type=str, default=None, \
+        help='Old version to compare through the client, e.g. v3.3.0')
+    parser.add_argument('--new-version', dest='new_version', type=str, default="current", \
+        help='New version to compare through the client')
+    parser.add_argument('--bodies', type=str, nargs='*', default=[], \
+        help='EM body ids to compare through the client')
+    parser.add_argument('--lines', type=str, nargs='*', default=[], \
+        help='LM line names to compare through the client')
+
+    args = parser.parse_args(argv)
+
+    if args.old and args.new:
+        records = diff_trees(args.old, args.new, args.cores)
+    elif args.old_version:
+        from neuronbridge.client import Client
+        records = diff_clients(Client(version=args.old_version), Client(version=args.new_version),
+                               args.bodies, args.lines)
+    else:
+        parser.error("Specify two release directories, or --old-version with --bodies/--lines")
+
+    summary = write_report(records, args.output)
+    for key, count in summary.items():
+        print(f"  {key}: {count}")
+    print(f"Wrote change report to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
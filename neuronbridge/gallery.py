@@ -0,0 +1,198 @@
+"""
+Renders overviews of many matches at once, as a single mosaic image or as a
+sprite sheet on disk with a JSON index of the tile positions.
+
+Thumbnails are fetched and decoded on a thread pool (PIL releases the GIL
+while decoding), and the decoded tiles are kept in a cache so that repeated
+renders of overlapping match lists only fetch the new images:
+
+    from neuronbridge import gallery
+    mosaic = gallery.render_mosaic(client, cds_matches[:200], columns=20)
+"""
+
+from __future__ import annotations
+
+import io
+import os
+import json
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, List, Optional, Sequence, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageDraw
+
+if TYPE_CHECKING:
+    from neuronbridge.client import Client
+    from neuronbridge.model import NeuronImage, Match
+
+# Number of threads used to fetch and decode thumbnails
+DEFAULT_THREADS = 16
+
+# Size of each tile in the mosaic (width, height)
+DEFAULT_TILE_SIZE = (200, 100)
+
+# Number of decoded tiles to keep in memory
+DEFAULT_CACHE_SIZE = 2000
+
+# Height of the label under each tile, if labels are enabled
+LABEL_HEIGHT = 14
+
+
+class ThumbnailCache:
+    """ Thread-safe LRU cache of decoded tiles, keyed by URL and tile size.
+        If a directory is given, the fetched files are also kept on disk so
+        that they survive between sessions.
+    """
+
+    def __init__(self, max_size:int=DEFAULT_CACHE_SIZE, cache_dir:str=None):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+            return tile
+
+
+    def put(self, key, tile:Image.Image):
+        with self.lock:
+            self.tiles[key] = tile
+            self.tiles.move_to_end(key)
+            while len(self.tiles) > self.max_size:
+                self.tiles.popitem(last=False)
+
+
+    def disk_path(self, url:str) -> Optional[str]:
+        if not self.cache_dir:
+            return None
+        # Keep the bucket-relative path, so that the cache is easy to inspect
+        path = url.split("://", 1)[-1].lstrip("/")
+        return os.path.join(self.cache_dir, path)
+
+
+# Cache shared by all renders in this process, unless another one is given
+default_cache = ThumbnailCache()
+
+
+def thumbnail_url(client:Client, match:Union[NeuronImage, Match]) -> str:
+    """ Returns the URL of the thumbnail for the given match or image. PPPM
+        matches use the thumbnail of their best channel.
+    """
+    if getattr(match, "type", None) == "PPPMatch":
+        return client._get_match_url(match, 'CDMBestThumbnail')
+    if hasattr(match, "image"):
+        return client._get_match_url(match, 'CDMThumbnail')
+    return client._get_files_url(match.files, 'CDMThumbnail')
+
+
+def _fetch(client:Client, url:str, cache:ThumbnailCache) -> bytes:
+    path = cache.disk_path(url)
+    if path and os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    data = client._get_bytes(url)
+    if path:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Threads fetching the same URL each write their own temporary file
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=os.path.basename(path),
+                                         suffix=".tmp", delete=False) as f:
+            f.write(data)
+        os.replace(f.name, path)
+    return data
+
+
+def _load_tile(client:Client, url:str, tile_size:Tuple[int,int], cache:ThumbnailCache) -> Image.Image:
+    key = (url, tile_size)
+    tile = cache.get(key)
+    if tile is None:
+        img = Image.open(io.BytesIO(_fetch(client, url, cache)))
+        # For JPEGs, this lets the decoder downscale while decoding
+        img.draft('RGB', tile_size)
+        img = img.convert('RGB')
+        img.thumbnail(tile_size)
+        tile = img
+        cache.put(key, tile)
+    return tile
+
+
+def fetch_thumbnails(client:Client, matches:Sequence[Union[NeuronImage, Match]],
+                     tile_size:Tuple[int,int]=DEFAULT_TILE_SIZE, threads:int=DEFAULT_THREADS,
+                     cache:ThumbnailCache=None) -> List[Optional[Image.Image]]:
+    """ Fetches and decodes the thumbnails for the given matches in parallel,
+        scaled to fit in the tile size. Returns None for any thumbnail which
+        could not be retrieved.
+    """
+    cache = cache or default_cache
+
+    def load(match):
+        url = None
+        try:
+            url = thumbnail_url(client, match)
+            return _load_tile(client, url, tile_size, cache)
+        except Exception as e:
+            logging.warning(f"Could not load thumbnail {url or ''} for {_label(match)}: {e!r}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(load, matches))
+
+
+def _label(match:Union[NeuronImage, Match]) -> str:
+    image = getattr(match, "image", match)
+    return image.publishedName
+
+
+def render_mosaic(client:Client, matches:Sequence[Union[NeuronImage, Match]], columns:int=10,
+                  tile_size:Tuple[int,int]=DEFAULT_TILE_SIZE, labels:bool=True,
+                  threads:int=DEFAULT_THREADS, cache:ThumbnailCache=None) -> Image.Image:
+    """ Returns a single image with the thumbnails of the given matches laid
+        out in a grid, in order, optionally with their published names.
+        Missing thumbnails are left blank.
+    """
+    return _render(client, matches, columns, tile_size, labels, threads, cache)[0]
+
+
+def _render(client, matches, columns, tile_size, labels, threads, cache):
+    tiles = fetch_thumbnails(client, matches, tile_size, threads, cache)
+    w, h = tile_size
+    cell_h = h + (LABEL_HEIGHT if labels else 0)
+    rows = max(1, -(-len(tiles) // columns))
+    mosaic = Image.new('RGB', (columns * w, rows * cell_h))
+    draw = ImageDraw.Draw(mosaic) if labels else None
+
+    index = []
+    for i, (match, tile) in enumerate(zip(matches, tiles)):
+        x, y = (i % columns) * w, (i // columns) * cell_h
+        if tile is not None:
+            # Center the tile in its cell, since thumbnails keep their aspect ratio
+            mosaic.paste(tile, (x + (w - tile.width) // 2, y + (h - tile.height) // 2))
+        if draw:
+            draw.text((x + 2, y + h), _label(match), fill=(255, 255, 255))
+        image = getattr(match, "image", match)
+        index.append({"id": image.id, "publishedName": image.publishedName,
+                      "x": x, "y": y, "width": w, "height": h, "missing": tile is None})
+    return mosaic, index
+
+
+def write_sprite_sheet(client:Client, matches:Sequence[Union[NeuronImage, Match]], filepath:str,
+                       columns:int=10, tile_size:Tuple[int,int]=DEFAULT_TILE_SIZE, labels:bool=False,
+                       threads:int=DEFAULT_THREADS, cache:ThumbnailCache=None) -> str:
+    """ Writes the thumbnails of the given matches to a sprite sheet image, and
+        its index next to it, with the same name and a .json extension. The
+        index lists the id, published name and position of each tile. Returns
+        the path of the index.
+    """
+    sheet, index = _render(client, matches, columns, tile_size, labels, threads, cache)
+    sheet.save(filepath)
+    index_path = os.path.splitext(filepath)[0] + ".json"
+    with open(index_path, 'w') as f:
+        json.dump({"image": os.path.basename(filepath), "tileSize": list(tile_size), "tiles": index}, f, indent=2)
+    return index_path
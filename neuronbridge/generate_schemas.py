@@ -4,6 +4,7 @@ import json
 from pathlib import Path
 
 from neuronbridge.model import *
+from neuronbridge.schema_validators import write_validators
 
 ROOT_DIR = "schemas"
 
@@ -26,6 +27,9 @@ def write_schemas():
     write_schema("PrecomputedMatches", PrecomputedMatches)
     write_schema("CustomMatches", CustomMatches)
 
+    # Generate the fast validators for the new schemas ahead of time
+    write_validators([DataConfig, ImageLookup, PrecomputedMatches, CustomMatches])
+
 
 if __name__ == '__main__':
     write_schemas()
\ No newline at end of file
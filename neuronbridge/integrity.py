@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""
+This program checks the referential integrity of a NeuronBridge metadata set:
+
+  dangling    CDSResults/PPPMResults files referenced by an image lookup
+              which do not exist in the match directories
+  orphaned    match files which are not referenced by any image lookup
+  unresolved  image ids in match files (input images and matched images)
+              which are not found in any image lookup
+  missing ids images in lookup files which have no id
+
+To scale to releases with tens of millions of ids, no sets of keys are kept
+in memory. Worker processes parse the files and write the keys they find to
+sorted run files on disk. The runs for each kind of key are then merged into
+sorted streams, and the streams are compared with a sort-merge join.
+
+./neuronbridge/integrity.py -d /nrs/neuronbridge/v3.4.0 --cores 40 -o integrity
+"""
+
+import os
+import sys
+import heapq
+import shutil
+import argparse
+import itertools
+import tempfile
+from collections import deque
+from typing import Iterable, Iterator, List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+
+import rapidjson
+from tqdm import tqdm
+
+from neuronbridge.validate_ray import DEFAULT_VERSION, get_image_dirs, get_match_dirs
+
+# Number of files to process in a single task
+BATCH_SIZE = 2000
+
+# Maximum number of keys to sort in memory before writing a run to disk
+MAX_RUN_LINES = 1000000
+
+# Maximum number of runs to merge at once, to stay under the open file limit
+MAX_MERGE_FAN_IN = 200
+
+# Number of tasks to keep in flight per worker process
+TASKS_PER_WORKER = 4
+
+# Match file types, by the name of the directory containing them
+MATCH_DIR_TYPES = {
+    "cdmatches": "CDSResults",
+    "pppmatches": "PPPMResults",
+}
+
+
+class RunWriter:
+    """ Collects "key\\tvalue" lines for one kind of key, and writes them to
+        disk as sorted runs of at most max_lines lines.
+    """
+
+    def __init__(self, work_dir:str, name:str, prefix:str, max_lines:int=None):
+        self.work_dir = work_dir
+        self.name = name
+        self.prefix = prefix
+        self.max_lines = max_lines or MAX_RUN_LINES
+        self.lines = []
+        self.runs = []
+
+
+    def add(self, key:str, value:str):
+        self.lines.append(f"{key}\t{value}\n")
+        if len(self.lines) >= self.max_lines:
+            self.flush()
+
+
+    def flush(self):
+        if not self.lines:
+            return
+        self.lines.sort()
+        filepath = os.path.join(self.work_dir, f"{self.name}.{self.prefix}.{len(self.runs)}.run")
+        with open(filepath, "w") as f:
+            f.writelines(self.lines)
+        self.runs.append(filepath)
+        self.lines = []
+
+
+def get_match_type(match_dir:str) -> str:
+    """ Returns the type of the match files (CDSResults or PPPMResults) in the given directory.
+    """
+    for part in os.path.normpath(match_dir).split(os.sep):
+        if part in MATCH_DIR_TYPES:
+            return MATCH_DIR_TYPES[part]
+    raise ValueError(f"Unknown match directory: {match_dir}")
+
+
+def emit_lookup_keys(work_dir:str, task_id:int, root:str, filenames:List[str]):
+    """ Emit the ids of the images in the given lookup files, and the match
+        files they reference. Returns the run files for each kind of key.
+    """
+    images = RunWriter(work_dir, "images", task_id)
+    refs = RunWriter(work_dir, "refs", task_id)
+    missing_ids = RunWriter(work_dir, "missing_ids", task_id)
+    for filename in filenames:
+        filepath = os.path.join(root, filename)
+        with open(filepath) as f:
+            obj = rapidjson.load(f)
+        for i, image in enumerate(obj.get("results") or []):
+            if not image.get("id"):
+                # Keyed by file, with the position of the image in its results
+                missing_ids.add(filepath, str(i))
+                continue
+            images.add(image["id"], filepath)
+            files = image.get("files") or {}
+            for file_type in MATCH_DIR_TYPES.values():
+                if files.get(file_type):
+                    refs.add(f"{file_type}/{files[file_type]}", filepath)
+    images.flush()
+    refs.flush()
+    missing_ids.flush()
+    return {"images": images.runs, "refs": refs.runs, "missing_ids": missing_ids.runs}
+
+
+def emit_match_keys(work_dir:str, task_id:int, root:str, filenames:List[str], file_type:str):
+    """ Emit the given match files, and the ids of the images they contain.
+        Returns the run files for each kind of key.
+    """
+    files = RunWriter(work_dir, "files", task_id)
+    image_refs = RunWriter(work_dir, "image_refs", task_id)
+    for filename in filenames:
+        filepath = os.path.join(root, filename)
+        files.add(f"{file_type}/{filename}", filepath)
+        with open(filepath) as f:
+            obj = rapidjson.load(f)
+        input_image = obj.get("inputImage") or {}
+        if input_image.get("id"):
+            image_refs.add(input_image["id"], filepath)
+        for match in obj.get("results") or []:
+            image_id = (match.get("image") or {}).get("id")
+            if image_id:
+                image_refs.add(image_id, filepath)
+    files.flush()
+    image_refs.flush()
+    return {"files": files.runs, "image_refs": image_refs.runs}
+
+
+def read_run(filepath:str) -> Iterator[Tuple[str,str]]:
+    with open(filepath) as f:
+        for line in f:
+            key, _, value = line.rstrip("\n").partition("\t")
+            yield key, value
+
+
+def merge_runs(runs:List[str], work_dir:str, name:str) -> List[str]:
+    """ Merge the given sorted runs until there are few enough to be read
+        at once. Returns the remaining runs.
+    """
+    level = 0
+    while len(runs) > MAX_MERGE_FAN_IN:
+        merged = []
+        for i in range(0, len(runs), MAX_MERGE_FAN_IN):
+            group = runs[i:i+MAX_MERGE_FAN_IN]
+            filepath = os.path.join(work_dir, f"{name}.merged{level}.{i}.run")
+            files = [open(run) for run in group]
+            try:
+                with open(filepath, "w") as out:
+                    out.writelines(heapq.merge(*files))
+            finally:
+                for f in files:
+                    f.close()
+            for run in group:
+                os.remove(run)
+            merged.append(filepath)
+        runs = merged
+        level += 1
+    return runs
+
+
+def sorted_keys(runs:List[str]) -> Iterator[Tuple[str,str]]:
+    """ Returns a sorted stream of (key, value) pairs from the given runs.
+    """
+    return heapq.merge(*[read_run(run) for run in runs])
+
+
+def join(left:Iterable[Tuple[str,str]], right:Iterable[Tuple[str,str]]) -> Iterator[Tuple[str,str,str]]:
+    """ Sort-merge join of two sorted streams of (key, value) pairs. Yields
+        each distinct key, with the first value found for it on each side,
+        or None if the key is missing on that side. Only one value per side
+        is kept, since some keys (e.g. popular images) have millions of values.
+    """
+    tagged = heapq.merge(((key, 0, value) for key, value in left),
+                         ((key, 1, value) for key, value in right))
+    for key, group in itertools.groupby(tagged, key=lambda t: t[0]):
+        sides = [None, None]
+        for _, side, value in group:
+            if sides[side] is None:
+                sides[side] = value
+        yield key, sides[0], sides[1]
+
+
+def check_integrity(runs, work_dir:str, output_dir:str):
+    """ Join the key streams and write the dangling, orphaned and unresolved
+        keys, and the lookup images without ids, to TSV files in the output
+        directory. Returns the number of problems of each kind.
+    """
+    for name in runs:
+        runs[name] = merge_runs(runs[name], work_dir, name)
+
+    os.makedirs(output_dir, exist_ok=True)
+    counts = {"dangling": 0, "orphaned": 0, "unresolved": 0, "missing_ids": 0}
+    with open(os.path.join(output_dir, "dangling.tsv"), "w") as dangling, \
+         open(os.path.join(output_dir, "orphaned.tsv"), "w") as orphaned:
+        for key, ref, file in join(sorted_keys(runs["refs"]), sorted_keys(runs["files"])):
+            if file is None:
+                counts["dangling"] += 1
+                dangling.write(f"{key}\t{ref}\n")
+            elif ref is None:
+                counts["orphaned"] += 1
+                orphaned.write(f"{key}\t{file}\n")
+
+    with open(os.path.join(output_dir, "unresolved.tsv"), "w") as unresolved:
+        for key, image, image_ref in join(sorted_keys(runs["images"]), sorted_keys(runs["image_refs"])):
+            if image is None:
+                counts["unresolved"] += 1
+                unresolved.write(f"{key}\t{image_ref}\n")
+
+    with open(os.path.join(output_dir, "missing_ids.tsv"), "w") as missing_ids:
+        for filepath, index in sorted_keys(runs["missing_ids"]):
+            counts["missing_ids"] += 1
+            missing_ids.write(f"{filepath}\t{index}\n")
+
+    return counts
+
+
+def collect(future, runs, pbar:tqdm):
+    """ Add the run files of a completed task to the runs of each kind.
+    """
+    for name, task_runs in future.result().items():
+        runs[name].extend(task_runs)
+    pbar.update()
+
+
+def iter_batches(directory:str):
+    for root, _, files in os.walk(directory):
+        for i in range(0, len(files), BATCH_SIZE):
+            yield root, files[i:i+BATCH_SIZE]
+
+
+def iter_tasks(data_path:str):
+    """ Yields the function and arguments of each task, as the directories are walked.
+    """
+    for image_dir in get_image_dirs(data_path):
+        for root, batch in iter_batches(image_dir):
+            yield emit_lookup_keys, (root, batch)
+    for match_dir in get_match_dirs(data_path):
+        file_type = get_match_type(match_dir)
+        for root, batch in iter_batches(match_dir):
+            yield emit_match_keys, (root, batch, file_type)
+
+
+def run(data_path:str, output_dir:str, cores:int=None, work_dir:str=None):
+    """ Check the referential integrity of the release at the given path.
+        Returns the number of problems of each kind.
+    """
+    work_dir = tempfile.mkdtemp(prefix="integrity-", dir=work_dir)
+    runs = {"images": [], "refs": [], "files": [], "image_refs": [], "missing_ids": []}
+    try:
+        with ProcessPoolExecutor(max_workers=cores) as executor, tqdm(desc="Collecting keys") as pbar:
+            # Only a bounded number of tasks is in flight, so that the file
+            # names of the whole release are never held in memory at once
+            max_pending = (cores or os.cpu_count() or 1) * TASKS_PER_WORKER
+            pending = deque()
+            for task_id, (fn, args) in enumerate(iter_tasks(data_path)):
+                pending.append(executor.submit(fn, work_dir, task_id, *args))
+                while len(pending) > max_pending or (pending and pending[0].done()):
+                    collect(pending.popleft(), runs, pbar)
+            while pending:
+                collect(pending.popleft(), runs, pbar)
+
+        return check_integrity(runs, work_dir, output_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main(argv:List[str]=None):
+
+    parser = argparse.ArgumentParser(prog="neuronbridge integrity",
+        description='Check that all the files referenced in a NeuronBridge release exist, and vice versa')
+    parser.add_argument('-d', '--data_path', type=str, default=f"/nrs/neuronbridge/v{DEFAULT_VERSION}", \
+        help='Data path to check, which holds "brain", "vnc", etc.')
+    parser.add_argument('-o', '--output', type=str, default="integrity", \
+        help='Directory where the dangling, orphaned and unresolved keys are written')
+    parser.add_argument('--cores', type=int, default=None, \
+        help='Number of worker processes to use')
+    parser.add_argument('--work-dir', dest='work_dir', type=str, default=None, \
+        help='Directory for temporary sorted runs (default: system temp dir)')
+
+    args = parser.parse_args(argv)
+
+    counts = run(args.data_path, args.output, args.cores, args.work_dir)
+    print(f"  Dangling match files: {counts['dangling']}")
+    print(f"  Orphaned match files: {counts['orphaned']}")
+    print(f"  Unresolved image ids: {counts['unresolved']}")
+    print(f"  Images without ids: {counts['missing_ids']}")
+    print(f"Wrote details to {args.output}")
+
+    return 1 if counts["dangling"] or counts["unresolved"] or counts["missing_ids"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+This program merges the JSON-lines logs written by the validation workers
+into a single report, grouped by level and warning/error type.
+
+Two files are written to the output directory:
+  report.jsonl      all the log records, sorted by level, type and file
+  report_index.json for each type, the number of records logged, the
+                    number of distinct files, and the byte range of its
+                    records in report.jsonl
+
+The workers only log a sample of each type (see MAX_LOGS in
+validate_worker.py), so the total counts should be taken from the
+validation summary, not from this report.
+
+./neuronbridge/merge_logs.py -l logs2 -o report
+"""
+
+import os
+import sys
+import glob
+import argparse
+from typing import Dict, List
+from collections import defaultdict
+
+import rapidjson
+
+# Order of the levels in the report
+LEVELS = ["error", "warn", "info"]
+
+
+def read_logs(log_dir:str) -> Dict[tuple, List[Dict]]:
+    """ Read all the worker logs in the given directory, and group the
+        records by (level, type). Lines which cannot be parsed (e.g. the
+        last line of a log from a worker that was killed) are skipped.
+    """
+    groups = defaultdict(list)
+    for filepath in sorted(glob.glob(os.path.join(log_dir, "*.jsonl"))):
+        worker = os.path.splitext(os.path.basename(filepath))[0]
+        with open(filepath) as f:
+            for line in f:
+                try:
+                    record = rapidjson.loads(line)
+                except ValueError:
+                    continue
+                record["worker"] = worker
+                groups[(record.get("level", "info"), record.get("type", ""))].append(record)
+    return groups
+
+
+def write_report(groups:Dict[tuple, List[Dict]], output_dir:str) -> Dict:
+    """ Write the merged report and its index to the output directory.
+        Returns the index.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    report_path = os.path.join(output_dir, "report.jsonl")
+
+    def order(key):
+        level, type = key
+        return (LEVELS.index(level) if level in LEVELS else len(LEVELS), type)
+
+    index = {"report": os.path.basename(report_path), "types": []}
+    with open(report_path, "wb") as f:
+        for key in sorted(groups, key=order):
+            level, type = key
+            records = sorted(groups[key], key=lambda r: (r.get("file", ""), r.get("arg", "")))
+            offset = f.tell()
+            for record in records:
+                f.write(rapidjson.dumps(record).encode() + b"\n")
+            index["types"].append({
+                "level": level,
+                "type": type,
+                "logged": len(records),
+                "files": len({r.get("file") for r in records}),
+                "offset": offset,
+                "length": f.tell() - offset,
+            })
+
+    with open(os.path.join(output_dir, "report_index.json"), "w") as f:
+        f.write(rapidjson.dumps(index, indent=2))
+    return index
+
+
+def read_type(output_dir:str, level:str, type:str) -> List[Dict]:
+    """ Read the records of a single type from a merged report, using its index.
+    """
+    with open(os.path.join(output_dir, "report_index.json")) as f:
+        index = rapidjson.load(f)
+    for entry in index["types"]:
+        if entry["level"] == level and entry["type"] == type:
+            with open(os.path.join(output_dir, index["report"]), "rb") as f:
+                f.seek(entry["offset"])
+                data = f.read(entry["length"])
+            return [rapidjson.loads(line) for line in data.splitlines()]
+    return []
+
+
+def main(argv:List[str]=None):
+
+    parser = argparse.ArgumentParser(prog="neuronbridge merge-logs",
+        description='Merge the validation worker logs into a single indexed report')
+    parser.add_argument('-l', '--log-dir', dest='log_dir', type=str, default="logs2", \
+        help='Directory containing the worker logs')
+    parser.add_argument('-o', '--output', type=str, default="report", \
+        help='Directory where the report is written')
+
+    args = parser.parse_args(argv)
+
+    groups = read_logs(args.log_dir)
+    index = write_report(groups, args.output)
+
+    for entry in index["types"]:
+        if entry["level"] != "info":
+            print(f"  [{entry['level'].upper()}] {entry['type']}: {entry['logged']} logged in {entry['files']} files")
+    print(f"Wrote report for {len(index['types'])} types to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""
+This program creates a local mirror of the NeuronBridge metadata and match
+files for a subset of a release.
+
+The image lookups for the given body ids and line names are downloaded first,
+then all the CDSResults and PPPMResults files they reference. Downloads run
+concurrently, partial downloads are resumed, and the total bandwidth can be
+capped. The mirror is laid out like the data bucket, so that it can be used
+directly by the client:
+
+    neuronbridge mirror -o ./mirror --bodies 1734696429 1449611593 --lines LH173
+    client = Client(data_url="./mirror/v3.4.0")
+
+Long lists of ids can be read from a file, one per line, using @ids.txt
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import threading
+from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+from neuronbridge.client import Client
+from neuronbridge.units import parse_size
+
+# Number of concurrent downloads
+DEFAULT_THREADS = 16
+
+# Size of the chunks read from each response
+CHUNK_SIZE = 64 * 1024
+
+# Mirror paths for each type of match file. These are also written into the
+# mirrored config.json as relative prefixes, which the client resolves against
+# the mirror directory.
+MATCH_FILE_DIRS = {
+    "CDSResults": "metadata/cdsresults/",
+    "PPPMResults": "metadata/pppresults/",
+}
+
+
+class RateLimiter:
+    """ Token bucket shared by all download threads, which caps the total
+        bandwidth to the given number of bytes per second.
+    """
+
+    def __init__(self, rate:float):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def consume(self, nbytes:int):
+        """ Account for the given number of bytes, sleeping if the budget is exceeded.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= nbytes
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Downloader:
+    """ Downloads files concurrently, resuming any partial downloads left
+        behind by a previous run.
+    """
+
+    def __init__(self, threads:int=DEFAULT_THREADS, max_rate:float=None):
+        self.threads = threads
+        self.limiter = RateLimiter(max_rate) if max_rate else None
+        self.local = threading.local()
+
+
+    def _session(self):
+        """ Each thread gets its own session, so that connections are reused.
+        """
+        if not hasattr(self.local, "session"):
+            import requests
+            self.local.session = requests.Session()
+        return self.local.session
+
+
+    def download(self, url:str, filepath:str, pbar:tqdm=None) -> bool:
+        """ Download the given URL to the given path. Returns False if the file
+            was already complete. Files are written with a .part suffix and
+            renamed once their size has been checked against the upstream one,
+            so any existing file is complete. The ETag of a partial download is
+            recorded next to it, and the download is only resumed if the file
+            has not changed upstream since (If-Range). Otherwise it starts over.
+        """
+        if os.path.exists(filepath):
+            return False
+
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        part_path = filepath + ".part"
+        etag_path = part_path + ".etag"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        etag = None
+        if offset and os.path.exists(etag_path):
+            with open(etag_path) as f:
+                etag = f.read()
+        # Byte ranges must refer to the file itself, not to a compressed encoding of it
+        headers = {"Accept-Encoding": "identity"}
+        if etag:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = etag
+
+        with self._session().get(url, headers=headers, stream=True) as res:
+            size = expected_size(res)
+            if res.status_code == 416:
+                if size is None or size != offset:
+                    # The partial file does not match the upstream file, start over
+                    discard(part_path, etag_path)
+                    return self.download(url, filepath, pbar)
+            elif res.status_code in (200, 206):
+                # The whole file is sent if it changed, or if the server ignores ranges
+                mode = "ab" if res.status_code == 206 else "wb"
+                if mode == "wb":
+                    discard(etag_path)
+                    if res.headers.get("ETag"):
+                        with open(etag_path, "w") as f:
+                            f.write(res.headers["ETag"])
+                with open(part_path, mode) as f:
+                    for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                        if self.limiter:
+                            self.limiter.consume(len(chunk))
+                        f.write(chunk)
+                        if pbar is not None:
+                            pbar.update(len(chunk))
+            else:
+                raise Exception(f"Could not retrieve {url} (status {res.status_code})")
+
+        actual = os.path.getsize(part_path)
+        if size is not None and actual != size:
+            if actual > size:
+                # Cannot be resumed
+                discard(part_path, etag_path)
+            raise Exception(f"Downloaded {actual} bytes of {url}, expected {size}")
+
+        os.replace(part_path, filepath)
+        discard(etag_path)
+        return True
+
+
+    def download_all(self, files:List[Tuple[str,str]], desc:str) -> Dict[str,Exception]:
+        """ Download all the given (url, filepath) pairs concurrently. Returns
+            the errors, keyed by URL.
+        """
+        errors = {}
+        with tqdm(desc=desc, unit="B", unit_scale=True) as pbar:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                futures = {executor.submit(self.download, url, path, pbar): url for url, path in files}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        errors[futures[future]] = e
+        return errors
+
+
+def expected_size(res) -> Optional[int]:
+    """ Returns the size of the whole file sent (in part) by the given response,
+        or None if it is not known.
+    """
+    content_range = res.headers.get("Content-Range")
+    if content_range:
+        total = content_range.rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    if res.headers.get("Content-Encoding", "identity") != "identity":
+        return None
+    length = res.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+
+def discard(*paths:str):
+    """ Remove the given files, if they exist.
+    """
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def make_prefixes_relative(config:Dict) -> Tuple[Dict, Dict[str,Dict[str,str]]]:
+    """ Returns a copy of the given config with its match file prefixes pointed
+        at the relative MATCH_FILE_DIRS, and the original prefixes for each store.
+        The given config is not modified, since it may be shared by the client.
+    """
+    config = copy.deepcopy(config)
+    prefixes = {}
+    for store_name, store in config["stores"].items():
+        prefixes[store_name] = dict(store["prefixes"])
+        for file_key, path in MATCH_FILE_DIRS.items():
+            if file_key in store["prefixes"]:
+                store["prefixes"][file_key] = path
+    return config, prefixes
+
+
+def mirror_config(client:Client, version_dir:str):
+    """ Write the config.json for the mirror, with relative prefixes for the
+        match files so that the client reads them from the mirror. Returns
+        the original prefixes for each store.
+    """
+    config, prefixes = make_prefixes_relative(client._get_json(client.data_url + "/config.json"))
+
+    os.makedirs(version_dir, exist_ok=True)
+    with open(os.path.join(version_dir, "config.json"), "w") as f:
+        json.dump(config, f, indent=2)
+
+    return prefixes
+
+
+def get_match_files(lookup_paths:List[str], prefixes:Dict[str,Dict[str,str]],
+                    version_dir:str, libraries:List[str]=None) -> List[Tuple[str,str]]:
+    """ Returns the (url, filepath) pairs of the match files referenced by
+        the images in the given lookup files. Match files of a type which has
+        no prefix in the image's store are skipped with a warning.
+    """
+    from neuronbridge.model import ImageLookup
+    files = {}
+    missing_prefixes = set()
+    for lookup_path in lookup_paths:
+        if not os.path.exists(lookup_path):
+            continue
+        with open(lookup_path) as f:
+            lookup = ImageLookup(**json.load(f))
+        for image in lookup.results:
+            if libraries and image.libraryName not in libraries:
+                continue
+            for file_key, mirror_dir in MATCH_FILE_DIRS.items():
+                path = getattr(image.files, file_key)
+                if not path:
+                    continue
+                prefix = prefixes.get(image.files.store, {}).get(file_key)
+                if not prefix:
+                    if (image.files.store, file_key) not in missing_prefixes:
+                        missing_prefixes.add((image.files.store, file_key))
+                        print(f"[WARN] No {file_key} prefix for store {image.files.store}, "
+                              "skipping its match files", file=sys.stderr)
+                    continue
+                url = prefix + path
+                files[url] = os.path.join(version_dir, mirror_dir, path)
+    return list(files.items())
+
+
+def main(argv:List[str]=None):
+
+    parser = argparse.ArgumentParser(prog="neuronbridge mirror", fromfile_prefix_chars="@",
+        description='Download the metadata and matches for a subset of a NeuronBridge release')
+    parser.add_argument('-o', '--output', type=str, required=True, \
+        help='Mirror directory. Each version is written to a sub-directory.')
+    parser.add_argument('--version', type=str, default="current", \
+        help='Data version to mirror, e.g. v3.4.0')
+    parser.add_argument('--data-bucket', dest='data_bucket', type=str, default="janelia-neuronbridge-data-prod", \
+        help='S3 bucket containing the NeuronBridge metadata')
+    parser.add_argument('--data-url', dest='data_url', type=str, default=None, \
+        help='Mirror from this URL instead of the data bucket, e.g. http://localhost:8000/v3.4.0')
+    parser.add_argument('--bodies', type=str, nargs='*', default=[], \
+        help='EM body ids to mirror')
+    parser.add_argument('--lines', type=str, nargs='*', default=[], \
+        help='LM line names to mirror')
+    parser.add_argument('--libraries', type=str, nargs='*', default=None, \
+        help='Only mirror matches for images in these libraries')
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS, \
+        help='Number of concurrent downloads')
+    parser.add_argument('--max-rate', dest='max_rate', type=parse_size, default=None, \
+        help='Maximum total bandwidth, e.g. 500K or 10M (bytes per second)')
+
+    args = parser.parse_args(argv)
+
+    client = Client(data_bucket=args.data_bucket, version=args.version, data_url=args.data_url)
+    version_dir = os.path.join(args.output, client.version)
+    print(f"Mirroring {client.data_url} to {version_dir}")
+
+    prefixes = mirror_config(client, version_dir)
+    downloader = Downloader(threads=args.threads, max_rate=args.max_rate)
+
+    lookups = [(f"{client.data_url}/metadata/by_body/{body_id}.json",
+                os.path.join(version_dir, "metadata", "by_body", f"{body_id}.json")) for body_id in args.bodies]
+    lookups += [(f"{client.data_url}/metadata/by_line/{line}.json",
+                 os.path.join(version_dir, "metadata", "by_line", f"{line}.json")) for line in args.lines]
+    errors = downloader.download_all(lookups, "Downloading image lookups")
+
+    match_files = get_match_files([path for _, path in lookups], prefixes, version_dir, args.libraries)
+    print(f"Found {len(match_files)} match files")
+    errors.update(downloader.download_all(match_files, "Downloading matches"))
+
+    for url, e in errors.items():
+        print(f"[ERROR] {url}: {e}", file=sys.stderr)
+
+    print(f"Mirrored {len(lookups)+len(match_files)-len(errors)} files with {len(errors)} errors")
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,27 @@
+import copyreg
+from sys import intern
 from typing import List, Union, Optional, Any, Dict, Literal
 from enum import Enum
-from pydantic import BaseModel, Field, Extra
+from pydantic import BaseModel, Field, Extra, AfterValidator
 from typing_extensions import Annotated
 
+# Low-cardinality strings, such as library names and alignment spaces, repeat
+# thousands of times in a set of matches. They are interned as they are loaded,
+# so that all the images share a single copy of each value.
+InternedStr = Annotated[str, AfterValidator(intern)]
+
+
+def _reduce(self):
+    """ Pickle models with the compact wire format, which is much smaller and
+        faster than pickling their attributes. See wire.py. Subclasses defined
+        elsewhere are not known to the wire format, and pickle as usual.
+    """
+    from neuronbridge import wire
+    try:
+        return wire.loads, (wire.dumps(self),)
+    except wire.UnknownType:
+        return copyreg.__newobj__, (type(self),), self.__getstate__()
+
 
 class Gender(str, Enum):
     male = 'm'
@@ -57,10 +76,10 @@ class Files(BaseModel, extra=Extra.forbid):
     """
     Files associated with a NeuronImage or Match. These are either absolute URLs (e.g. starting with a protocol like http://) or relative paths. For relative paths, the first component should be replaced with its corresponding base URL from the DataConfig.
     """
-    store: str = Field(title="Data Store", description="Name of the DataStore that provides access to imagery for any relative paths in this object.")
+    store: InternedStr = Field(title="Data Store", description="Name of the DataStore that provides access to imagery for any relative paths in this object.")
     CDM: Optional[str] = Field(title="Color Depth MIP", description="The CDM of the image. This is for non-PPPM results only, for PPPM, see CDMBest/CDMBestThumbnail.", default=None)
     CDMThumbnail: Optional[str] = Field(title="Thumbnail of the CDM", description="The thumbnail sized version of the CDM, if available.", default=None)
-    CDMInput: Optional[str] = Field(title="CDM input", description="CDM-only. The actual color depth image that was input. 'Matched CDM' in the NeuronBridge GUI.", default=None)
+    CDMInput: Optional[InternedStr] = Field(title="CDM input", description="CDM-only. The actual color depth image that was input. 'Matched CDM' in the NeuronBridge GUI.", default=None)
     CDMMatch: Optional[str] = Field(title="CDM match", description="CDM-only. The actual color depth image that was matched. 'Matched CDM' in the NeuronBridge GUI.", default=None)
     CDMBest: Optional[str] = Field(title="CDM of best-matching channel", description="PPPM-only. The CDM of best matching channel of the matching LM stack and called 'Best Channel CDM' in the NeuronBridge GUI.", default=None)
     CDMBestThumbnail: Optional[str] = Field(title="Thumbnail of the CDM of best-matching channel", description="PPPM-only. The thumbnail of the CDM of best matching channel of the matching LM stack and called 'Best Channel CDM Thumbnail' in the NeuronBridge GUI.", default=None)
@@ -81,8 +100,8 @@ class UploadedImage(BaseModel, extra=Extra.forbid):
     An uploaded image containing neurons. 
     """
     filename: str = Field(title="Filename", description="Name of the uploaded file.")
-    alignmentSpace: str = Field(title="Alignment space", description="Alignment space to which this image was registered.")
-    anatomicalArea: str = Field(title="Anatomical area", description="Anatomical area represented in the image.")
+    alignmentSpace: InternedStr = Field(title="Alignment space", description="Alignment space to which this image was registered.")
+    anatomicalArea: InternedStr = Field(title="Anatomical area", description="Anatomical area represented in the image.")
     files: Files = Field(title="Files", description="Files associated with the image.")
 
 
@@ -91,14 +110,16 @@ class NeuronImage(BaseModel, extra=Extra.forbid):
     A color depth image containing neurons. 
     """
     id: str = Field(title="Image identifier", description="The unique identifier for this image.")
-    libraryName: str = Field(title="Library name", description="Name of the image library containing this image.")
+    libraryName: InternedStr = Field(title="Library name", description="Name of the image library containing this image.")
     publishedName: str = Field(title="Published name", description="Published name for the contents of this image. This is not a unique identifier.")
-    alignmentSpace: str = Field(title="Alignment space", description="Alignment space to which this image was registered.")
-    anatomicalArea: str = Field(title="Anatomical area", description="Anatomical area represented in the image.")
+    alignmentSpace: InternedStr = Field(title="Alignment space", description="Alignment space to which this image was registered.")
+    anatomicalArea: InternedStr = Field(title="Anatomical area", description="Anatomical area represented in the image.")
     gender: Gender = Field(title="Gender", description="Gender of the sample imaged.")
     files: Files = Field(title="Files", description="Files associated with the image.")
     annotations: Optional[List[str]] = Field(title="List of additional annotations", description="Bag of words associated with this neuron", default=None)
 
+    __reduce__ = _reduce
+
 
 class EMImage(NeuronImage, extra=Extra.forbid):
     """
@@ -115,8 +136,8 @@ class LMImage(NeuronImage, extra=Extra.forbid):
     """
     type: Literal['LMImage'] = 'LMImage'
     slideCode: str = Field(title="Slide code", description="Unique identifier for the sample that was imaged.")
-    objective: str = Field(title="Objective", description="Magnification of the microscope objective used to imaged this image.")
-    mountingProtocol: Optional[str] = Field(title="Mounting protocol", description="Description of the protocol used to mount the sample for imaging.", default=None)
+    objective: InternedStr = Field(title="Objective", description="Magnification of the microscope objective used to imaged this image.")
+    mountingProtocol: Optional[InternedStr] = Field(title="Mounting protocol", description="Description of the protocol used to mount the sample for imaging.", default=None)
     channel: Optional[int] = Field(title="Channel", description="Channel index within the full LM image stack. PPPM matches the entire stack and therefore this is blank.", default=None)
 
 
@@ -129,6 +150,8 @@ class ImageLookup(BaseModel, extra=Extra.forbid):
     """
     results: List[ConcreteNeuronImage] = Field(title="Results", description="List of images matching the query.")
 
+    __reduce__ = _reduce
+
 
 class Match(BaseModel, extra=Extra.forbid):
     """
@@ -138,6 +161,8 @@ class Match(BaseModel, extra=Extra.forbid):
     files: Files = Field(title="Files", description="Files associated with the match.")
     mirrored: bool = Field(title="Mirror flag", description="Indicates whether the target image was found within a mirrored version of the matching image.")
 
+    __reduce__ = _reduce
+
 
 class PPPMatch(Match, extra=Extra.forbid):
     """
@@ -166,6 +191,8 @@ class Matches(BaseModel, extra=Extra.forbid):
     inputImage: None
     results: List[ConcreteMatch] = Field(title="Results", description="List of other images matching the input image.")
 
+    __reduce__ = _reduce
+
 
 class PrecomputedMatches(Matches, extra=Extra.forbid):
     """
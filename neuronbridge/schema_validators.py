@@ -0,0 +1,254 @@
+"""
+Fast structural validators for raw JSON objects, generated from the JSON
+schemas of the models.
+
+Building pydantic objects is the main cost of validating a release. The
+validators generated here check a parsed JSON object against the same schema
+(types, required and unknown properties, constants, enums and discriminated
+unions) using plain Python code, without building any objects. They only
+return True or False, and are at least as strict as the models, so that an
+object which passes is known to be valid. If an object fails, build the
+pydantic model to find out why.
+
+    validate = get_validator(PrecomputedMatches)
+    if not validate(obj):
+        PrecomputedMatches(**obj)  # raises a ValidationError with the details
+
+The generated code is written to a cache directory, keyed by a hash of the
+schema, so that it is only generated once for each version of the models.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import importlib.util
+from types import ModuleType
+from typing import Any, Callable, Dict, List
+
+# Directory where the generated validator modules are cached
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "neuronbridge", "validators")
+
+# Version of the code generator, which is part of the cache key
+GENERATOR_VERSION = 1
+
+# Validators loaded in this process, by model name and cache directory
+_validators = {}
+
+
+class CodeGenerator:
+    """ Generates the source of a Python module which validates objects
+        against the given JSON schema, as produced by pydantic.
+    """
+
+    def __init__(self, schema:Dict):
+        self.schema = schema
+        self.defs = schema.get("$defs", {})
+        self.lines = []
+        self.constants = []
+        self.dispatch = []
+        self.helpers = 0
+
+
+    def generate(self) -> str:
+        for name, definition in self.defs.items():
+            self.function(f"v_{name}", definition)
+        self.function("validate", self.schema)
+        header = [
+            f"# Generated by neuronbridge.schema_validators from the {self.schema.get('title')} schema.",
+            "# Do not edit, it is regenerated whenever the schema changes.",
+            "",
+            "_MISSING = object()",
+            "",
+            "def _false(v):",
+            "    return False",
+            "",
+        ]
+        # The dispatch tables of the discriminated unions refer to the functions, so they come last
+        return "\n".join(header + self.constants + [""] + self.lines + self.dispatch) + "\n"
+
+
+    def constant(self, value) -> str:
+        name = f"_C{len(self.constants)}"
+        self.constants.append(f"{name} = {value!r}")
+        return name
+
+
+    def function(self, name:str, schema:Dict):
+        """ Generate a function validating an object with properties.
+        """
+        if schema.get("type") != "object" or "properties" not in schema:
+            self.lines += [f"def {name}(v):", f"    return {self.expr(schema, 'v', 0)}", "", ""]
+            return
+
+        properties = schema["properties"]
+        required = schema.get("required", [])
+        body = [f"def {name}(d):", "    if type(d) is not dict:", "        return False"]
+        if schema.get("additionalProperties") is False:
+            keys = self.constant(frozenset(properties))
+            body += [f"    if not d.keys() <= {keys}:", "        return False"]
+        elif schema.get("additionalProperties") not in (None, True):
+            raise NotImplementedError(f"additionalProperties schema with properties in {name}")
+        if required:
+            keys = self.constant(frozenset(required))
+            body += [f"    if not {keys} <= d.keys():", "        return False"]
+
+        # Optional properties are checked by looping over the keys which are present,
+        # since most of them are usually missing, grouping the keys with the same check
+        # The required properties are checked in a single condition
+        checks = []
+        optional = {}
+        for prop, prop_schema in properties.items():
+            if prop in required:
+                check = self.expr(prop_schema, f"d[{prop!r}]", 0)
+                if check != "True":
+                    checks.append(f"({check})")
+            else:
+                check = self.expr(prop_schema, "v", 0)
+                if check != "True":
+                    optional.setdefault(check, []).append(prop)
+        if checks:
+            body += ["    if not (" + "\n            and ".join(checks) + "):", "        return False"]
+        if optional:
+            body.append("    for k, v in d.items():")
+            for i, (check, props) in enumerate(optional.items()):
+                keyword = "if" if i == 0 else "elif"
+                if len(props) == 1:
+                    body.append(f"        {keyword} k == {props[0]!r}:")
+                else:
+                    body.append(f"        {keyword} k in {self.constant(frozenset(props))}:")
+                body += [f"            if not ({check}):", "                return False"]
+        body += ["    return True", "", ""]
+        self.lines += body
+
+
+    def expr(self, schema:Dict, var:str, depth:int) -> str:
+        """ Returns a boolean expression which checks the value of var against the schema.
+        """
+        supported = {"$ref", "type", "properties", "required", "additionalProperties", "items", "anyOf",
+                     "oneOf", "discriminator", "enum", "const", "title", "description", "default"}
+        unknown = set(schema) - supported
+        if unknown:
+            raise NotImplementedError(f"Unsupported schema keywords: {sorted(unknown)}")
+
+        if "$ref" in schema:
+            name = self.ref(schema["$ref"])
+            definition = self.defs[name]
+            if definition.get("type") != "object" and "$ref" not in definition:
+                # Inline simple definitions like enums, to save a function call
+                return self.expr(definition, var, depth)
+            return f"v_{name}({var})"
+
+        if "oneOf" in schema:
+            discriminator = schema.get("discriminator")
+            if not discriminator:
+                checks = [self.expr(s, var, depth) for s in schema["oneOf"]]
+                return f"(sum([{', '.join(checks)}]) == 1)"
+            mapping = ", ".join(f"{tag!r}: v_{self.ref(ref)}" for tag, ref in discriminator["mapping"].items())
+            dispatch = f"_D{len(self.dispatch)}"
+            self.dispatch.append(f"{dispatch} = {{{mapping}}}")
+            prop = discriminator["propertyName"]
+            return f"(type({var}) is dict and {dispatch}.get({var}.get({prop!r}), _false)({var}))"
+
+        if "anyOf" in schema:
+            return "(" + " or ".join(self.expr(s, var, depth) for s in schema["anyOf"]) + ")"
+
+        checks = []
+        schema_type = schema.get("type")
+        if schema_type == "string":
+            checks.append(f"type({var}) is str")
+        elif schema_type == "integer":
+            checks.append(f"type({var}) is int")
+        elif schema_type == "number":
+            checks.append(f"(type({var}) is float or type({var}) is int)")
+        elif schema_type == "boolean":
+            checks.append(f"type({var}) is bool")
+        elif schema_type == "null":
+            checks.append(f"{var} is None")
+        elif schema_type == "array":
+            checks.append(f"type({var}) is list")
+            if "items" in schema:
+                item = f"x{depth}"
+                checks.append(f"all({self.expr(schema['items'], item, depth+1)} for {item} in {var})")
+        elif schema_type == "object":
+            if "properties" in schema:
+                self.helpers += 1
+                name = f"_obj{self.helpers}"
+                self.function(name, schema)
+                return f"{name}({var})"
+            checks.append(f"type({var}) is dict")
+            values = schema.get("additionalProperties")
+            if isinstance(values, dict):
+                item = f"x{depth}"
+                checks.append(f"all(type(k) is str and {self.expr(values, item, depth+1)} "
+                              f"for k, {item} in {var}.items())")
+        elif schema_type is not None:
+            raise NotImplementedError(f"Unsupported type: {schema_type}")
+
+        if "const" in schema:
+            checks.append(f"{var} == {schema['const']!r}")
+        elif "enum" in schema:
+            checks.append(f"{var} in {self.constant(frozenset(schema['enum']))}")
+
+        return " and ".join(checks) if checks else "True"
+
+
+    def ref(self, ref:str) -> str:
+        prefix = "#/$defs/"
+        if not ref.startswith(prefix):
+            raise NotImplementedError(f"Unsupported reference: {ref}")
+        return ref[len(prefix):]
+
+
+def generate_source(schema:Dict) -> str:
+    """ Returns the source of a module with a validate(obj) function for the given JSON schema.
+    """
+    return CodeGenerator(schema).generate()
+
+
+def _load_module(name:str, filepath:str) -> ModuleType:
+    spec = importlib.util.spec_from_file_location(name, filepath)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_validator(model_class, cache_dir:str=None) -> Callable[[Any], bool]:
+    """ Returns the fast validator for the given pydantic model class, generating
+        it if it is not in the cache yet.
+    """
+    name = model_class.__name__
+    cache_dir = cache_dir or CACHE_DIR
+    if (name, cache_dir) in _validators:
+        return _validators[(name, cache_dir)]
+
+    schema = model_class.model_json_schema()
+    key = hashlib.sha1(json.dumps([GENERATOR_VERSION, schema], sort_keys=True).encode()).hexdigest()[:16]
+    filepath = os.path.join(cache_dir, f"{name}_{key}.py")
+    module_name = f"neuronbridge_validators.{name}_{key}"
+
+    if not os.path.exists(filepath):
+        source = generate_source(schema)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write atomically, since many workers may generate the same module at once
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(source)
+            os.replace(tmp_path, filepath)
+        except OSError:
+            # The cache is not writable, so compile the module in memory instead
+            module = ModuleType(module_name)
+            exec(compile(source, f"<{name} validator>", "exec"), module.__dict__)
+            _validators[(name, cache_dir)] = module.validate
+            return module.validate
+
+    _validators[(name, cache_dir)] = _load_module(module_name, filepath).validate
+    return _validators[(name, cache_dir)]
+
+
+def write_validators(model_classes:List, cache_dir:str=None):
+    """ Generate the validators for the given models ahead of time.
+    """
+    for model_class in model_classes:
+        get_validator(model_class, cache_dir)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+Local color depth search of uploaded CDMs against a library of CDMs.
+
+The library images are first packed into a single memory-mapped array, along
+with an index of their metadata taken from the image lookups of a release:
+
+    neuronbridge search pack --lookups by_line/*.json --cdm-dir /nrs/cdms -o mcfo-library
+
+Searches then only read the library pixels under each mask, from all the cores
+at once, and return ranked CustomMatches:
+
+    neuronbridge search run --library mcfo-library -o results upload1.png upload2.png
+
+Or from Python:
+
+    library = Library("mcfo-library")
+    matches = search(library, Image.open("upload.png"), filename="upload.png")
+
+The scores are computed by cdm.CDMScorer, so the normalizedScore is the
+fraction of mask pixels that match, and not the precomputed NeuronBridge score.
+"""
+
+import os
+import sys
+import argparse
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import rapidjson
+from PIL import Image
+from pydantic import TypeAdapter
+
+from neuronbridge import cdm
+from neuronbridge.model import CDSMatch, ConcreteNeuronImage, CustomMatches, Files, \
+    ImageLookup, LibraryConfig, NeuronImage, UploadedImage
+
+# Name of the memory-mapped stack of library CDMs (NxHxWx3 uint8)
+STACK_FILE = "cdms.npy"
+
+# Name of the JSON index of the library images, in the same order as the stack
+INDEX_FILE = "index.json"
+
+# Number of library CDMs scored at once by each worker
+DEFAULT_BATCH_SIZE = 64
+
+# Maximum number of matches returned for each search
+DEFAULT_MAX_RESULTS = 300
+
+# Number of threads used to decode the library images when packing
+DEFAULT_THREADS = 8
+
+# Libraries opened in this process, by path
+_libraries = {}
+
+
+class Library:
+    """ A library of CDMs packed by pack_library(). The CDMs are memory-mapped,
+        so that they can be shared by many worker processes through the page
+        cache. The metadata of the images is kept as raw JSON, and models are
+        only built for the images which are returned as matches.
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            index = rapidjson.load(f)
+        self.alignment_space = index["alignmentSpace"]
+        self.anatomical_area = index["anatomicalArea"]
+        self.file_type = index["fileType"]
+        self.images = index["images"]
+        self.paths = index["paths"]
+        self.cdms = np.load(os.path.join(path, STACK_FILE), mmap_mode="r")
+        self.shape = self.cdms.shape[1:3]
+        self._adapter = TypeAdapter(ConcreteNeuronImage)
+
+
+    def __len__(self):
+        return len(self.images)
+
+
+    def image(self, i:int) -> NeuronImage:
+        return self._adapter.validate_python(self.images[i])
+
+
+    def library_configs(self) -> List[LibraryConfig]:
+        """ Returns the name and image count of each library in the stack, as
+            listed in a CustomSearchConfig.
+        """
+        counts = Counter(image["libraryName"] for image in self.images)
+        return [LibraryConfig(name=name, count=count) for name, count in counts.items()]
+
+
+def open_library(path:str) -> Library:
+    """ Returns the library at the given path, opening it once per process.
+    """
+    if path not in _libraries:
+        _libraries[path] = Library(path)
+    return _libraries[path]
+
+
+def pack_library(images:Sequence[NeuronImage], cdm_dir:str, output_dir:str, file_type:str="CDM",
+                 threads:int=DEFAULT_THREADS) -> Library:
+    """ Packs the CDMs of the given images into a library in output_dir. The
+        CDM of each image is read from cdm_dir, at the relative path given by
+        its files[file_type], e.g. CDM for the full MIPs. All the images must be
+        in the same alignment space, so that their CDMs have the same size.
+    """
+    if not images:
+        raise ValueError("No images to pack")
+    alignment_spaces = {image.alignmentSpace for image in images}
+    if len(alignment_spaces) > 1:
+        raise ValueError(f"Images are in more than one alignment space: {sorted(alignment_spaces)}")
+    paths = [getattr(image.files, file_type) for image in images]
+    missing = [image.id for image, path in zip(images, paths) if not path]
+    if missing:
+        raise ValueError(f"{len(missing)} images have no {file_type}, e.g. {missing[0]}")
+
+    def read(path):
+        with Image.open(os.path.join(cdm_dir, path)) as image:
+            return cdm.to_array(image)
+
+    os.makedirs(output_dir, exist_ok=True)
+    first = read(paths[0])
+    stack = np.lib.format.open_memmap(os.path.join(output_dir, STACK_FILE), mode="w+",
+                                      dtype=np.uint8, shape=(len(images),) + first.shape)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for i, arr in enumerate(executor.map(read, paths)):
+            if arr.shape != first.shape:
+                raise ValueError(f"{paths[i]} has shape {arr.shape}, expected {first.shape}")
+            stack[i] = arr
+    stack.flush()
+    del stack
+
+    index = {
+        "alignmentSpace": images[0].alignmentSpace,
+        "anatomicalArea": images[0].anatomicalArea,
+        "fileType": file_type,
+        "images": [image.model_dump(mode="json", exclude_none=True) for image in images],
+        "paths": paths,
+    }
+    with open(os.path.join(output_dir, INDEX_FILE), "w") as f:
+        rapidjson.dump(index, f)
+    _libraries.pop(output_dir, None)
+    return open_library(output_dir)
+
+
+def _score_range(library_path:str, mask:np.ndarray, start:int, stop:int, batch_size:int,
+                 scorer_args:Dict) -> Tuple[np.ndarray, np.ndarray]:
+    """ Scores the library CDMs in [start, stop). Returns the matching pixels
+        and mirrored flags.
+    """
+    library = open_library(library_path)
+    scorer = cdm.CDMScorer(mask, **scorer_args)
+    pixels = np.empty(stop - start, dtype=np.int64)
+    mirrored = np.empty(stop - start, dtype=bool)
+    for i in range(start, stop, batch_size):
+        j = min(i + batch_size, stop)
+        scores = scorer.score(library.cdms[i:j])
+        pixels[i-start:j-start] = scores.matching_pixels
+        mirrored[i-start:j-start] = scores.mirrored
+    return pixels, mirrored
+
+
+def search(library:Library, mask, filename:str="upload.png", cores:int=None, executor:Executor=None,
+           batch_size:int=DEFAULT_BATCH_SIZE, max_results:Optional[int]=DEFAULT_MAX_RESULTS,
+           min_matching_pixels:int=1, mirror_mask:bool=True, **kwargs) -> CustomMatches:
+    """ Searches the library with the given mask CDM (an image or an HxWx3
+        array), and returns the matches ranked by descending score.
+
+        The library is split into ranges which are scored by a pool of worker
+        processes. To run many searches, pass a ProcessPoolExecutor as the
+        executor (and its number of workers as cores), so that the workers and
+        their open libraries are reused. With cores=1 and no executor, the
+        search runs in this process. Any other keyword arguments are passed to
+        the CDMScorer.
+    """
+    mask = mask if isinstance(mask, np.ndarray) else cdm.to_array(mask)
+    if mask.shape[:2] != library.shape:
+        raise ValueError(f"Mask has shape {mask.shape[:2]}, expected {library.shape}")
+    scorer_args = dict(kwargs, mirror_mask=mirror_mask)
+    mask_pixels = cdm.CDMScorer(mask, **scorer_args).mask_pixels
+
+    n = len(library)
+    if executor is None and cores == 1:
+        pixels, mirrored = _score_range(library.path, mask, 0, n, batch_size, scorer_args)
+    else:
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(max_workers=cores)
+        try:
+            # A few ranges per worker, so that they finish at about the same time
+            workers = cores or os.cpu_count() or 1
+            chunk = max(batch_size, -(-n // (workers * 4)))
+            futures = [executor.submit(_score_range, library.path, mask, start, min(start + chunk, n),
+                                       batch_size, scorer_args)
+                       for start in range(0, n, chunk)]
+            results = [future.result() for future in futures]
+        finally:
+            if own_executor:
+                executor.shutdown()
+        pixels = np.concatenate([r[0] for r in results])
+        mirrored = np.concatenate([r[1] for r in results])
+
+    order = np.argsort(-pixels, kind="stable")
+    order = order[pixels[order] >= max(min_matching_pixels, 1)]
+    if max_results is not None:
+        order = order[:max_results]
+
+    input_image = UploadedImage(filename=filename, alignmentSpace=library.alignment_space,
+                                anatomicalArea=library.anatomical_area,
+                                files=Files(store=library.images[0]["files"]["store"], CDM=filename))
+    results = []
+    for i in order.tolist():
+        image = library.image(i)
+        results.append(CDSMatch(
+            image=image,
+            files=Files(store=image.files.store, CDMInput=filename, CDMMatch=library.paths[i]),
+            mirrored=bool(mirrored[i]),
+            normalizedScore=float(pixels[i]) / mask_pixels,
+            matchingPixels=int(pixels[i])))
+    return CustomMatches(inputImage=input_image, results=results)
+
+
+def main(argv:List[str]=None):
+
+    parser = argparse.ArgumentParser(prog="neuronbridge search",
+        description='Run color depth searches against a local library of CDMs')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pack = subparsers.add_parser("pack", help='Pack library CDMs into a memory-mapped stack')
+    pack.add_argument('--lookups', type=str, nargs='+', required=True, \
+        help='Image lookup JSON files listing the library images, e.g. by_line/*.json')
+    pack.add_argument('--cdm-dir', dest='cdm_dir', type=str, required=True, \
+        help='Directory containing the CDMs, at the relative paths given in the lookups')
+    pack.add_argument('--file-type', dest='file_type', type=str, default="CDM", \
+        help='File type of the CDM in the image files')
+    pack.add_argument('-o', '--output', type=str, required=True, \
+        help='Directory where the library is written')
+    pack.add_argument('--threads', type=int, default=DEFAULT_THREADS, \
+        help='Number of threads used to decode the CDMs')
+
+    run = subparsers.add_parser("run", help='Search a packed library with uploaded CDMs')
+    run.add_argument('masks', type=str, nargs='+', \
+        help='Uploaded CDMs to search with')
+    run.add_argument('--library', type=str, required=True, \
+        help='Directory of a library written by "neuronbridge search pack"')
+    run.add_argument('-o', '--output', type=str, default="results", \
+        help='Directory where the CustomMatches of each mask are written')
+    run.add_argument('--cores', type=int, default=None, \
+        help='Number of worker processes')
+    run.add_argument('--max-results', dest='max_results', type=int, default=DEFAULT_MAX_RESULTS, \
+        help='Maximum number of matches per search')
+    run.add_argument('--no-mirror', dest='mirror_mask', action='store_false', \
+        help='Do not also match the mirrored mask')
+    run.add_argument('--mask-threshold', dest='mask_threshold', type=int, default=cdm.DEFAULT_MASK_THRESHOLD, \
+        help='Minimum intensity of the mask pixels')
+    run.add_argument('--data-threshold', dest='data_threshold', type=int, default=cdm.DEFAULT_DATA_THRESHOLD, \
+        help='Minimum intensity of the library pixels')
+    run.add_argument('--pix-color-fluctuation', dest='pix_color_fluctuation', type=float, \
+        default=cdm.DEFAULT_PIX_COLOR_FLUCTUATION, \
+        help='Tolerated depth difference, as a percentage of the depth range')
+    run.add_argument('--xy-shift', dest='xy_shift', type=int, default=cdm.DEFAULT_XY_SHIFT, \
+        help='Maximum pixel shift in x and y')
+
+    args = parser.parse_args(argv)
+
+    if args.command == "pack":
+        images = []
+        for filepath in args.lookups:
+            with open(filepath) as f:
+                images.extend(ImageLookup(**rapidjson.load(f)).results)
+        library = pack_library(images, args.cdm_dir, args.output, args.file_type, args.threads)
+        for config in library.library_configs():
+            print(f"  {config.name}: {config.count}")
+        print(f"Packed {len(library)} CDMs into {args.output}")
+        return 0
+
+    library = Library(args.library)
+    os.makedirs(args.output, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=args.cores) as executor:
+        for mask_path in args.masks:
+            with Image.open(mask_path) as image:
+                mask = cdm.to_array(image)
+            filename = os.path.basename(mask_path)
+            matches = search(library, mask, filename=filename, cores=args.cores, executor=executor,
+                             max_results=args.max_results, mirror_mask=args.mirror_mask,
+                             mask_threshold=args.mask_threshold, data_threshold=args.data_threshold,
+                             pix_color_fluctuation=args.pix_color_fluctuation, xy_shift=args.xy_shift)
+            output_path = os.path.join(args.output, os.path.splitext(filename)[0] + ".json")
+            with open(output_path, "w") as f:
+                f.write(matches.model_dump_json(indent=2, exclude_none=True))
+            print(f"{filename}: {len(matches.results)} matches")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+"""
+This program serves one or more NeuronBridge releases over HTTP, using the
+same URL scheme as the data bucket, so that the client can use it as its
+data_url:
+
+    neuronbridge serve /nrs/neuronbridge/v3.4.0 --port 8000
+    client = Client(data_url="http://localhost:8000/v3.4.0")
+
+Each release is served under its directory name, and /current.txt names the
+last one given. A release can be a mirror created with "neuronbridge mirror",
+or a release tree as written by the pipeline (brain+vnc/mips/embodies,
+brain/cdmatches/em-vs-lm, etc.), in which case the metadata/by_body,
+metadata/by_line, metadata/cdsresults and metadata/pppresults paths are
+mapped onto it. Any other path is served as a plain file from the release.
+The config.json is served with its match file prefixes pointing back at the
+server.
+
+Requests are handled by a thread each, over keep-alive connections. Small
+files are kept in an in-memory LRU cache, together with their gzipped form.
+Responses carry an ETag, so that clients can revalidate cached files, and
+byte ranges are supported for partial and resumed downloads.
+"""
+
+import os
+import sys
+import gzip
+import json
+import hashlib
+import argparse
+import mimetypes
+import posixpath
+import threading
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import unquote, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from neuronbridge.mirror import make_prefixes_relative
+from neuronbridge.units import parse_size
+
+# Default port to listen on
+DEFAULT_PORT = 8000
+
+# Maximum total size of the files kept in memory
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+
+# Files larger than this are always streamed from disk
+MAX_CACHED_FILE_SIZE = 16 * 1024 * 1024
+
+# Files smaller than this are not worth compressing
+MIN_GZIP_SIZE = 1024
+
+# Content types which are compressed for clients that accept gzip
+GZIP_TYPES = {"application/json", "text/plain", "text/csv"}
+
+# Paths in the data bucket layout, and the directories of a release tree where
+# the same files are found, in the order they are searched
+RELEASE_PATHS = {
+    "metadata/by_body/": ["brain+vnc/mips/embodies/"],
+    "metadata/by_line/": ["brain+vnc/mips/lmlines/"],
+    "metadata/cdsresults/": [
+        "brain/cdmatches/em-vs-lm/",
+        "brain/cdmatches/lm-vs-em/",
+        "vnc/cdmatches/em-vs-lm/",
+        "vnc/cdmatches/lm-vs-em/",
+    ],
+    "metadata/pppresults/": [
+        "brain/pppmatches/em-vs-lm/",
+        "vnc/pppmatches/em-vs-lm/",
+    ],
+}
+
+mimetypes.add_type("text/plain", ".swc")
+
+
+class CachedFile(NamedTuple):
+    etag: str
+    data: bytes
+    gzipped: Optional[bytes]
+
+
+class FileCache:
+    """ Thread-safe LRU cache of file contents, bounded by their total size.
+        Entries are keyed by path and only returned if their ETag is still
+        current, so files changed on disk are never served stale.
+    """
+
+    def __init__(self, max_bytes:int=DEFAULT_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, path:str, etag:str) -> Optional[CachedFile]:
+        with self.lock:
+            entry = self.files.get(path)
+            if entry is None or entry.etag != etag:
+                return None
+            self.files.move_to_end(path)
+            return entry
+
+
+    def put(self, path:str, entry:CachedFile):
+        size = len(entry.data) + len(entry.gzipped or b"")
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.files.pop(path, None)
+            if old is not None:
+                self.nbytes -= len(old.data) + len(old.gzipped or b"")
+            self.files[path] = entry
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.files.popitem(last=False)
+                self.nbytes -= len(evicted.data) + len(evicted.gzipped or b"")
+
+
+def parse_range(header:str, size:int) -> Optional[Tuple[int,int]]:
+    """ Parse a single byte range like "bytes=0-99", "bytes=100-" or "bytes=-100"
+        into inclusive (start, end) offsets. Returns None if the header should be
+        ignored (e.g. multiple ranges) and raises ValueError if it can't be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+class ReleaseServer(ThreadingHTTPServer):
+    """ HTTP server for the given releases, keyed by their names.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, releases:Dict[str,str], current:str=None, configs:Dict[str,str]=None,
+                 cache_size:int=DEFAULT_CACHE_SIZE, verbose:bool=False):
+        super().__init__(address, ReleaseHandler)
+        self.releases = releases
+        self.current = current or list(releases)[-1]
+        self.config_files = configs or {}
+        self.configs = {}
+        self.cache = FileCache(cache_size)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+    def get_config(self, name:str) -> bytes:
+        """ Returns the config.json of the given release, with its match file
+            prefixes made relative so that the client fetches them from here.
+        """
+        with self.lock:
+            if name not in self.configs:
+                config_file = self.config_files.get(name) or os.path.join(self.releases[name], "config.json")
+                if os.path.exists(config_file):
+                    with open(config_file) as f:
+                        config = json.load(f)
+                else:
+                    from neuronbridge.client import Client
+                    client = Client(version=name)
+                    config = client._get_json(client.data_url + "/config.json")
+                config, _ = make_prefixes_relative(config)
+                self.configs[name] = json.dumps(config, indent=2).encode()
+            return self.configs[name]
+
+
+    def resolve(self, urlpath:str) -> Tuple[Optional[str], Optional[bytes]]:
+        """ Map a URL path to a file on disk, or to generated content. Returns
+            (filepath, None), (None, content) or (None, None) if not found.
+        """
+        path = posixpath.normpath(unquote(urlparse(urlpath).path)).lstrip("/")
+        if path.startswith("..") or "/../" in path:
+            return None, None
+        if path == "current.txt":
+            return None, (self.current + "\n").encode()
+
+        name, _, rest = path.partition("/")
+        if name not in self.releases or not rest:
+            return None, None
+        if rest == "config.json":
+            return None, self.get_config(name)
+
+        root = self.releases[name]
+        candidates = [rest]
+        for prefix, dirs in RELEASE_PATHS.items():
+            if rest.startswith(prefix):
+                candidates = [d + rest[len(prefix):] for d in dirs] + candidates
+                break
+        for candidate in candidates:
+            filepath = os.path.join(root, candidate)
+            if os.path.isfile(filepath):
+                return filepath, None
+        return None, None
+
+
+class ReleaseHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    server_version = "NeuronBridge"
+
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+    def serve(self, send_body:bool):
+        try:
+            filepath, content = self.server.resolve(self.path)
+        except Exception as e:
+            self.send_error(502, f"Could not load {self.path}: {e}")
+            return
+
+        if filepath is None and content is None:
+            self.send_error(404)
+            return
+
+        if content is not None:
+            etag = '"%s"' % hashlib.sha1(content).hexdigest()[:16]
+            size = len(content)
+            content_type = "application/json" if self.path.endswith(".json") else "text/plain"
+            entry = CachedFile(etag, content, None)
+        else:
+            st = os.stat(filepath)
+            etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+            size = st.st_size
+            content_type = mimetypes.guess_type(filepath)[0] or "application/octet-stream"
+            entry = self.server.cache.get(filepath, etag)
+            if entry is None and size <= MAX_CACHED_FILE_SIZE:
+                with open(filepath, "rb") as f:
+                    entry = CachedFile(etag, f.read(), None)
+                self.server.cache.put(filepath, entry)
+
+        byte_range = None
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range", etag) == etag:
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        encoding = None
+        if byte_range is None and entry is not None and content_type in GZIP_TYPES \
+                and size >= MIN_GZIP_SIZE and "gzip" in self.headers.get("Accept-Encoding", ""):
+            encoding = "gzip"
+            # The gzipped content is a different representation, with its own ETag
+            etag = f'{etag[:-1]}-gz"'
+
+        if etag in [t.strip() for t in self.headers.get("If-None-Match", "").split(",")]:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        if encoding and entry.gzipped is None:
+            entry = entry._replace(gzipped=gzip.compress(entry.data, compresslevel=6))
+            if filepath:
+                self.server.cache.put(filepath, entry)
+
+        if byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            start, end = 0, size - 1
+            self.send_response(200)
+        length = len(entry.gzipped) if encoding else end - start + 1
+
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", etag)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Vary", "Accept-Encoding")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+        if not send_body:
+            return
+
+        if encoding:
+            self.wfile.write(entry.gzipped)
+        elif entry is not None:
+            self.wfile.write(entry.data[start:end+1])
+        else:
+            with open(filepath, "rb") as f:
+                self.connection.sendfile(f, start, length)
+
+
+def serve(releases:Dict[str,str], host:str="localhost", port:int=DEFAULT_PORT, **kwargs) -> ReleaseServer:
+    """ Create a server for the given releases, which are keyed by name. Call
+        serve_forever() on it to handle requests.
+    """
+    return ReleaseServer((host, port), releases, **kwargs)
+
+
+def main(argv:List[str]=None):
+
+    parser = argparse.ArgumentParser(prog="neuronbridge serve",
+        description='Serve NeuronBridge releases over HTTP, for use as the data_url of the client')
+    parser.add_argument('releases', type=str, nargs='+', \
+        help='Release directories to serve, each under its directory name')
+    parser.add_argument('--host', type=str, default="localhost", \
+        help='Address to listen on, e.g. 0.0.0.0 for all interfaces')
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT, \
+        help='Port to listen on')
+    parser.add_argument('--current', type=str, default=None, \
+        help='Name of the release returned by /current.txt (default: the last one given)')
+    parser.add_argument('--config', dest='configs', type=str, nargs='*', default=[], \
+        help='config.json to use for a release without one, as NAME=PATH. '+
+             'By default, it is fetched from the data bucket')
+    parser.add_argument('--cache-size', dest='cache_size', type=parse_size, default=DEFAULT_CACHE_SIZE, \
+        help='Maximum size of the in-memory file cache, e.g. 2G')
+    parser.add_argument('-v', '--verbose', action='store_true', \
+        help='Log every request')
+
+    args = parser.parse_args(argv)
+
+    releases = {os.path.basename(os.path.normpath(d)): d for d in args.releases}
+    configs = dict(c.split("=", 1) for c in args.configs)
+    server = serve(releases, args.host, args.port, current=args.current, configs=configs,
+                   cache_size=args.cache_size, verbose=args.verbose)
+    for name in releases:
+        print(f"Serving {releases[name]} at {server.url}/{name}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,343 @@
+"""
+Lazy, ranged access to the 3D image stacks of LM images (VisuallyLosslessStack).
+
+The stacks are H5J files: HDF5 files in which each channel is stored as a
+compressed video, in a 1-D uint8 dataset under /Channels, with one frame per
+z slice. Opening a stack only reads the HDF5 metadata, and a channel is only
+read and decoded up to the last slice which is accessed:
+
+    stack = client.get_image_stack(match)
+    print(stack.shape)           # (channels, z, y, x)
+    mip = stack[0, 40:60].max(axis=0)
+
+Remote stacks are read with HTTP range requests, in fixed-size blocks which
+are kept in an LRU cache, and local stacks with plain file seeks. Reading H5J
+files requires the optional h5py and av (PyAV) packages.
+"""
+
+import io
+import threading
+import importlib
+from collections import OrderedDict
+from typing import Callable, Iterator, Optional, Tuple
+from urllib.parse import urlparse
+
+import numpy as np
+
+# Size of the blocks fetched with each range request, in bytes
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+# Number of blocks kept in the cache of each remote file
+DEFAULT_CACHE_BLOCKS = 64
+
+
+def _require(name:str):
+    """ Import an optional dependency, with a helpful message if it is missing.
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError as e:
+        raise ImportError(f"Reading image stacks requires the '{name}' package. "
+                          "Install it with: pip install neuronbridge-python[stacks]") from e
+
+
+class RangedFile(io.RawIOBase):
+    """ Read-only, seekable file over HTTP, which fetches fixed-size blocks with
+        range requests and keeps the most recently used ones in a cache. The
+        size of the file is taken from the first response, so no extra request
+        is made for it.
+    """
+
+    def __init__(self, url:str, session=None, block_size:int=DEFAULT_BLOCK_SIZE,
+                 cache_blocks:int=DEFAULT_CACHE_BLOCKS):
+        super().__init__()
+        if session is None:
+            from neuronbridge.client import make_session
+            session = make_session()
+        self.url = url
+        self.session = session
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.size = None
+        self.requests = 0
+        self.bytes_fetched = 0
+        self._pos = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def readable(self):
+        return True
+
+
+    def seekable(self):
+        return True
+
+
+    def tell(self):
+        return self._pos
+
+
+    def seek(self, offset:int, whence:int=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self._get_size() + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self._pos
+
+
+    def readinto(self, b) -> int:
+        view = memoryview(b).cast("B")
+        n = 0
+        while n < len(view):
+            index, offset = divmod(self._pos, self.block_size)
+            block = self._get_block(index)
+            chunk = block[offset:offset + len(view) - n]
+            if not chunk:
+                break
+            view[n:n+len(chunk)] = chunk
+            n += len(chunk)
+            self._pos += len(chunk)
+        return n
+
+
+    def _get_size(self) -> int:
+        if self.size is None:
+            self._get_block(0)
+        return self.size
+
+
+    def _get_block(self, index:int) -> bytes:
+        with self._lock:
+            if index in self._blocks:
+                self._blocks.move_to_end(index)
+                return self._blocks[index]
+        if self.size is not None and index * self.block_size >= self.size:
+            return b""
+
+        start = index * self.block_size
+        # Ask for the raw bytes, since the ranges are offsets into the unencoded file
+        headers = {"Range": f"bytes={start}-{start + self.block_size - 1}", "Accept-Encoding": "identity"}
+        res = self.session.get(self.url, headers=headers)
+        self.requests += 1
+        if res.status_code == 416:
+            self.size = int(res.headers.get("Content-Range", "*/0").rpartition("/")[2])
+            return b""
+        if res.status_code == 200:
+            # The server does not support ranges, so it sent the whole file
+            data = res.content
+            self.size = len(data)
+            block = data[start:start + self.block_size]
+        elif res.status_code == 206:
+            block = res.content
+            self.size = int(res.headers["Content-Range"].rpartition("/")[2])
+        else:
+            raise Exception("Could not retrieve "+self.url)
+        self.bytes_fetched += len(res.content)
+
+        with self._lock:
+            self._blocks[index] = block
+            while len(self._blocks) > self.cache_blocks:
+                self._blocks.popitem(last=False)
+        return block
+
+
+class DatasetFile(io.RawIOBase):
+    """ Read-only file view of a 1-D uint8 HDF5 dataset, such as a channel of an
+        H5J file, which only reads the parts of the dataset that are requested.
+    """
+
+    def __init__(self, dataset):
+        super().__init__()
+        self.dataset = dataset
+        self.size = dataset.shape[0]
+        self._pos = 0
+
+
+    def readable(self):
+        return True
+
+
+    def seekable(self):
+        return True
+
+
+    def tell(self):
+        return self._pos
+
+
+    def seek(self, offset:int, whence:int=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self.size}[whence]
+        self._pos = base + offset
+        return self._pos
+
+
+    def readinto(self, b) -> int:
+        view = memoryview(b).cast("B")
+        end = min(self._pos + len(view), self.size)
+        if end <= self._pos:
+            return 0
+        n = end - self._pos
+        view[:n] = self.dataset[self._pos:end].tobytes()
+        self._pos = end
+        return n
+
+
+class LazyFrames:
+    """ A stack of 2D frames (z, y, x) which are produced in order by an
+        iterator, such as a video decoder. Frames are only produced up to the
+        last one which is accessed, and are kept once produced. Indexing works
+        like a numpy array and returns numpy arrays.
+    """
+
+    def __init__(self, frames:Callable[[], Iterator[np.ndarray]], shape:Tuple[int,int,int]):
+        self._open = frames
+        self._iter = None
+        self._frames = []
+        self.shape = shape
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def _decode_to(self, n:int):
+        """ Make sure that the first n frames are decoded.
+        """
+        if len(self._frames) >= n:
+            return
+        if self._iter is None:
+            self._iter = self._open()
+        for frame in self._iter:
+            self._frames.append(frame[:self.shape[1], :self.shape[2]])
+            if len(self._frames) >= n:
+                return
+        raise IndexError(f"Stack ended after {len(self._frames)} of {self.shape[0]} frames")
+
+
+    def __getitem__(self, key):
+        key = (key if isinstance(key, tuple) else (key,)) or (slice(None),)
+        z, rest = key[0], key[1:]
+        if isinstance(z, (int, np.integer)):
+            if z < 0:
+                z += len(self)
+            if not 0 <= z < len(self):
+                raise IndexError(f"Index {z} is out of range for {len(self)} frames")
+            self._decode_to(z + 1)
+            return self._frames[z][rest]
+        if isinstance(z, slice):
+            indices = range(*z.indices(len(self)))
+        else:
+            indices = [int(i) + len(self) if i < 0 else int(i) for i in np.asarray(z).ravel()]
+        if not len(indices):
+            return np.empty((0,) + self.shape[1:], dtype=np.uint8)[(slice(None),) + rest]
+        self._decode_to(max(indices) + 1)
+        return np.stack([self._frames[i] for i in indices])[(slice(None),) + rest]
+
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype)
+
+
+def decode_frames(fileobj) -> Iterator[np.ndarray]:
+    """ Decode the frames of a video stored in a file-like object, as 2D
+        arrays of the luma channel (uint8, or uint16 for deeper videos).
+    """
+    av = _require("av")
+    with av.open(fileobj, mode="r") as container:
+        for frame in container.decode(video=0):
+            bits = frame.format.components[0].bits
+            yield frame.to_ndarray(format="gray16le" if bits > 8 else "gray")
+
+
+class ImageStack:
+    """ An H5J image stack, opened from a local path or a URL. Indexing with
+        [channel, z, y, x] returns numpy arrays, reading and decoding only the
+        channels and slices which are needed.
+    """
+
+    def __init__(self, source:str, session=None, block_size:int=DEFAULT_BLOCK_SIZE,
+                 cache_blocks:int=DEFAULT_CACHE_BLOCKS):
+        h5py = _require("h5py")
+        self.source = source
+        if urlparse(source).scheme in ("http", "https"):
+            self._file = RangedFile(source, session, block_size, cache_blocks)
+        else:
+            path = urlparse(source).path if source.startswith("file:") else source
+            self._file = open(path, "rb")
+        self._h5 = h5py.File(self._file, "r")
+        channels = self._h5["Channels"]
+        self.channel_names = sorted(channels.keys(), key=lambda n: int(n.rpartition("_")[2]))
+
+        x, y, z = (int(v) for v in self._h5.attrs["image_size"])
+        self.image_size = (x, y, z)
+        voxel_size = self._h5.attrs.get("voxel_size")
+        self.voxel_size = tuple(float(v) for v in voxel_size) if voxel_size is not None else None
+        self._channels = {}
+
+
+    @property
+    def shape(self) -> Tuple[int,int,int,int]:
+        x, y, z = self.image_size
+        return (len(self.channel_names), z, y, x)
+
+
+    @property
+    def bytes_fetched(self) -> Optional[int]:
+        """ Number of bytes fetched so far, for a remote stack.
+        """
+        return getattr(self._file, "bytes_fetched", None)
+
+
+    def channel(self, c:int) -> LazyFrames:
+        """ Returns the given channel as lazily decoded (z, y, x) frames.
+        """
+        if c not in self._channels:
+            dataset = self._h5["Channels"][self.channel_names[c]]
+            self._channels[c] = LazyFrames(lambda: decode_frames(DatasetFile(dataset)), self.shape[1:])
+        return self._channels[c]
+
+
+    def _channel_index(self, c:int) -> int:
+        """ Returns the non-negative index of the given channel, which may be
+            negative as with sequences, or raises IndexError.
+        """
+        n = self.shape[0]
+        if not -n <= c < n:
+            raise IndexError(f"Channel {c} is out of range for {n} channels")
+        return int(c) + n if c < 0 else int(c)
+
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        c, rest = key[0], key[1:]
+        if isinstance(c, (int, np.integer)):
+            return self.channel(self._channel_index(c))[rest]
+        if isinstance(c, slice):
+            indices = range(*c.indices(self.shape[0]))
+        else:
+            indices = [self._channel_index(i) for i in np.asarray(c).ravel()]
+        return np.stack([self.channel(i)[rest] for i in indices])
+
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype)
+
+
+    def close(self):
+        self._h5.close()
+        self._file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
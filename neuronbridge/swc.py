@@ -0,0 +1,208 @@
+"""
+Fast reading of SWC skeletons (AlignedBodySWC) into NumPy arrays.
+
+An SWC file lists the nodes of a skeleton, one per line, as seven columns:
+id, type, x, y, z, radius and the id of the parent node (-1 for a root),
+preceded by optional comment lines starting with #. The nodes are parsed in
+a single call into a compact structured array, rather than line by line:
+
+    skeleton = client.get_swc_skeleton(em_image)
+    skeleton.coords                  # (N, 3) float32
+    skeleton.in_box(lo, hi)          # boolean mask of the nodes in a box
+
+Skeletons can be loaded for many bodies at once with
+Client.get_swc_skeletons_batch, and filtered by region with skeletons_in_box.
+"""
+
+import io
+import os
+import warnings
+from typing import Dict, Hashable, List, Optional, Sequence, Union
+
+import numpy as np
+
+# Fields of an SWC node, in file order
+SWC_DTYPE = np.dtype([
+    ("id", np.int64),
+    ("type", np.int16),
+    ("x", np.float32),
+    ("y", np.float32),
+    ("z", np.float32),
+    ("radius", np.float32),
+    ("parent", np.int64),
+])
+
+
+class Skeleton:
+    """ A skeleton as a structured array of nodes (see SWC_DTYPE), in file
+        order, along with the comment lines of the file header.
+    """
+
+    def __init__(self, nodes:np.ndarray, header:List[str]=None):
+        self.nodes = nodes
+        self.header = header or []
+        self._coords = None
+        self._parent_index = None
+
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+    def __repr__(self):
+        return f"Skeleton({len(self)} nodes)"
+
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self.nodes["id"]
+
+
+    @property
+    def types(self) -> np.ndarray:
+        return self.nodes["type"]
+
+
+    @property
+    def radii(self) -> np.ndarray:
+        return self.nodes["radius"]
+
+
+    @property
+    def parents(self) -> np.ndarray:
+        return self.nodes["parent"]
+
+
+    @property
+    def coords(self) -> np.ndarray:
+        """ The (x, y, z) coordinates of the nodes, as an (N, 3) float32 array.
+        """
+        if self._coords is None:
+            self._coords = np.stack([self.nodes["x"], self.nodes["y"], self.nodes["z"]], axis=1)
+        return self._coords
+
+
+    @property
+    def parent_index(self) -> np.ndarray:
+        """ The row of the parent of each node, or -1 for roots and for parents
+            which are not in the skeleton.
+        """
+        if self._parent_index is None:
+            if not len(self):
+                self._parent_index = np.zeros(0, dtype=np.int64)
+            else:
+                order = np.argsort(self.ids, kind="stable")
+                sorted_ids = self.ids[order]
+                pos = np.minimum(np.searchsorted(sorted_ids, self.parents), len(self) - 1)
+                self._parent_index = np.where(sorted_ids[pos] == self.parents, order[pos], -1)
+        return self._parent_index
+
+
+    def bounds(self) -> Optional[np.ndarray]:
+        """ Returns the bounding box of the nodes as a (2, 3) array of the min
+            and max coordinates, or None if the skeleton is empty.
+        """
+        if not len(self):
+            return None
+        return np.stack([self.coords.min(axis=0), self.coords.max(axis=0)])
+
+
+    def cable_length(self) -> float:
+        """ Returns the total length of the edges between nodes and their parents.
+        """
+        child = self.parent_index >= 0
+        edges = self.coords[child] - self.coords[self.parent_index[child]]
+        return float(np.sqrt((edges ** 2).sum(axis=1)).sum())
+
+
+    def in_box(self, lo:Sequence[float], hi:Sequence[float]) -> np.ndarray:
+        """ Returns a boolean mask of the nodes inside the box [lo, hi].
+        """
+        coords = self.coords
+        return ((coords >= np.asarray(lo, dtype=np.float32)) &
+                (coords <= np.asarray(hi, dtype=np.float32))).all(axis=1)
+
+
+    def intersects(self, lo:Sequence[float], hi:Sequence[float]) -> bool:
+        """ Returns True if any node is inside the box [lo, hi].
+        """
+        bounds = self.bounds()
+        if bounds is None or (bounds[1] < lo).any() or (bounds[0] > hi).any():
+            return False
+        return bool(self.in_box(lo, hi).any())
+
+
+    def crop(self, lo:Sequence[float], hi:Sequence[float]) -> "Skeleton":
+        """ Returns the part of the skeleton inside the box [lo, hi]. Nodes whose
+            parent was cropped out become roots.
+        """
+        inside = self.in_box(lo, hi)
+        nodes = self.nodes[inside].copy()
+        parent_index = self.parent_index[inside]
+        kept = np.zeros(len(self) + 1, dtype=bool)
+        kept[:-1] = inside
+        # parent_index is -1 for roots, which maps to the last (False) entry
+        nodes["parent"][~kept[parent_index]] = -1
+        return Skeleton(nodes, self.header)
+
+
+    def to_swc(self) -> str:
+        """ Returns the skeleton in SWC format.
+        """
+        out = io.StringIO()
+        for line in self.header:
+            out.write(line + "\n")
+        np.savetxt(out, self.nodes, fmt=["%d", "%d", "%g", "%g", "%g", "%g", "%d"])
+        return out.getvalue()
+
+
+def read_swc(source:Union[str, bytes, io.IOBase]) -> Skeleton:
+    """ Reads an SWC skeleton from a file path, the content of a file (bytes),
+        or a file object.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            data = f.read()
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        data = bytes(source)
+    else:
+        data = source.read()
+        if isinstance(data, str):
+            data = data.encode()
+
+    # Only the leading comment lines are kept as the header
+    header = []
+    pos = 0
+    while pos < len(data):
+        end = data.find(b"\n", pos)
+        end = len(data) if end < 0 else end
+        line = data[pos:end].strip()
+        if line.startswith(b"#"):
+            header.append(line.decode(errors="replace"))
+        elif line:
+            break
+        pos = end + 1
+
+    with warnings.catch_warnings():
+        # An empty skeleton is not worth a warning
+        warnings.simplefilter("ignore", UserWarning)
+        try:
+            # loadtxt is implemented in C, and parses straight into the structured array
+            nodes = np.loadtxt(io.BytesIO(data), comments="#", dtype=SWC_DTYPE, usecols=range(7), ndmin=1)
+        except ValueError:
+            # Some writers format the ids as floats
+            values = np.loadtxt(io.BytesIO(data), comments="#", dtype=np.float64, usecols=range(7), ndmin=2)
+            nodes = np.empty(len(values), dtype=SWC_DTYPE)
+            for i, name in enumerate(SWC_DTYPE.names):
+                nodes[name] = values[:, i]
+    return Skeleton(nodes, header)
+
+
+def skeletons_in_box(skeletons:Dict[Hashable, Skeleton], lo:Sequence[float], hi:Sequence[float]) -> List[Hashable]:
+    """ Returns the keys of the skeletons which have at least one node in the
+        box [lo, hi]. Values which are not skeletons, such as the exceptions
+        returned by the batch methods of the client, are skipped.
+    """
+    lo, hi = np.asarray(lo, dtype=np.float32), np.asarray(hi, dtype=np.float32)
+    return [key for key, skeleton in skeletons.items()
+            if isinstance(skeleton, Skeleton) and skeleton.intersects(lo, hi)]
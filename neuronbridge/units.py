@@ -0,0 +1,26 @@
+"""
+Parsing and formatting of sizes given on the command line, such as memory
+limits, cache sizes and bandwidths. Units are decimal (1K = 1000).
+"""
+
+# Multiplier of each unit suffix
+UNITS = {"K": 1e3, "M": 1e6, "G": 1e9, "T": 1e12}
+
+
+def parse_size(s:str) -> int:
+    """ Parse a size like "500M", "4G" or "10MB" into bytes.
+    """
+    s = s.strip().upper().rstrip("B")
+    if s and s[-1] in UNITS:
+        return int(float(s[:-1]) * UNITS[s[-1]])
+    return int(s)
+
+
+def format_size(n:int) -> str:
+    """ Format a number of bytes like "1.5 MB".
+    """
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(n) < 1000:
+            return f"{n:.1f} {unit}"
+        n /= 1000
+    return f"{n:.1f} TB"
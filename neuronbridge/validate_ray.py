@@ -13,23 +13,207 @@ To use the dashboard on a remote server:
    ssh -L 8265:0.0.0.0:8265 <server address>
    run validate_ray.py
    open http://localhost:8265 in your browser
+
+Batches are validated by a pool of long-lived workers, one per CPU. To keep
+their memory bounded, a worker is replaced by a fresh process once its RSS
+exceeds --worker-memory after a batch, or after --recycle-after batches. The
+memory and time used by each batch are reported at the end, and memray
+allocation profiles of the largest batches can be recorded with --profile-dir:
+./neuronbridge/validate_ray.py --worker-memory 4G --profile-dir profiles
+
+Completed batches and their counts are checkpointed to disk, so that an
+interrupted run can be continued with --resume. The match files can be split
+between independent jobs with --shard, and their results combined afterwards:
+./neuronbridge/validate_ray.py --shard 0/4 --resume
+./neuronbridge/validate_ray.py --merge
+
+With --check-assets, the files referenced by the image lookups and matches are
+also resolved with the store prefixes of the data config, and checked for
+existence once the validation is done (see assets.py).
 """
 
 import os
 import sys
+import json
+import zlib
+import time
+import glob
+import shutil
+import hashlib
 import argparse
-from typing import Set, List
+import tempfile
+from typing import Dict, Set, List, Tuple
 from collections import defaultdict
 
 import ray
 from tqdm import tqdm
 
+from neuronbridge.units import parse_size, format_size
+
 # Default version of the data to validate
 DEFAULT_VERSION = "3.4.0"
 
-# Number of matches to send to a worker to process in a single batch
+# Maximum number of files to send to a worker to process in a single batch
 BATCH_SIZE = 100
 
+# Target number of bytes per batch. Match files range from a few KB to several MB,
+# so batches are formed by size, and a very large file gets a batch of its own.
+BATCH_BYTES = 32 * 1024 * 1024
+
+# Number of batches to keep in flight per CPU in the cluster. New batches are only
+# submitted as others finish, so that idle workers always pick up the next largest.
+BATCHES_IN_FLIGHT_PER_CPU = 2
+
+# Directory to store checkpoints of completed batches
+CHECKPOINT_DIR = "checkpoints"
+
+# Number of batches to profile, and to list in the report of the slowest batches
+PROFILE_TOP = 5
+
+
+def get_image_dirs(data_path:str) -> List[str]:
+    """ Returns the directories containing the image lookups of a release.
+    """
+    return [
+        f"{data_path}/brain+vnc/mips/embodies",
+        f"{data_path}/brain+vnc/mips/lmlines",
+    ]
+
+
+def get_match_dirs(data_path:str) -> List[str]:
+    """ Returns the directories containing the matches of a release.
+    """
+    return [
+        f"{data_path}/brain/cdmatches/em-vs-lm/",
+        f"{data_path}/brain/cdmatches/lm-vs-em/",
+        f"{data_path}/brain/pppmatches/em-vs-lm/",
+        f"{data_path}/vnc/cdmatches/em-vs-lm/",
+        f"{data_path}/vnc/cdmatches/lm-vs-em/",
+        f"{data_path}/vnc/pppmatches/em-vs-lm/",
+    ]
+
+
+def get_batch_id(root_dir:str, batch:List[str]) -> str:
+    """ Returns a stable identifier for a batch of files, which is the same 
+        across runs and shards as long as the batch contains the same files.
+    """
+    h = hashlib.sha1(root_dir.encode())
+    for filename in batch:
+        h.update(b"\0")
+        h.update(filename.encode())
+    return h.hexdigest()[:20]
+
+
+def get_asset_batch_id(shard:Tuple[int,int]) -> str:
+    """ Returns the identifier of the asset check of the given (index, count)
+        shard, which checks the assets of its own batches.
+    """
+    index, count = shard if shard else (0, 1)
+    return f"assets_{index}_of_{count}"
+
+
+def in_shard(filename:str, shard:Tuple[int,int]) -> bool:
+    """ Returns True if the given file belongs to the given (index, count) shard.
+    """
+    if not shard:
+        return True
+    index, count = shard
+    return zlib.crc32(filename.encode()) % count == index
+
+
+def parse_shard(s:str) -> Tuple[int,int]:
+    """ Parse a shard specification like "2/8" into (2, 8).
+    """
+    index, count = (int(p) for p in s.split("/"))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Invalid shard {s}, expected i/n with 0 <= i < n")
+    return index, count
+
+
+def sum_counts(entries) -> Dict[str, Dict[str, int]]:
+    """ Sum the counts of the given checkpoint entries.
+    """
+    totals = {"warnings": defaultdict(int), "errors": defaultdict(int)}
+    for entry in entries:
+        for kind in totals:
+            for key, count in entry["counts"].get(kind, {}).items():
+                totals[kind][key] += count
+    return {kind: dict(counts) for kind, counts in totals.items()}
+
+
+class Checkpoint:
+    """ Append-only record of the batches completed by one shard. Each line
+        holds the batch id, its counts and (for image lookups) the published
+        names it found. The aggregated counts are also kept in a summary file
+        next to it.
+    """
+
+    def __init__(self, checkpoint_dir:str, shard:Tuple[int,int]=None, resume:bool=False):
+        index, count = shard if shard else (0, 1)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.filepath = os.path.join(checkpoint_dir, f"shard_{index}_of_{count}.jsonl")
+        self.summary_path = os.path.join(checkpoint_dir, f"shard_{index}_of_{count}.summary.json")
+        self.entries = load_checkpoints([self.filepath]) if resume else {}
+        self.file_handle = open(self.filepath, "a" if resume else "w")
+
+
+    def __contains__(self, batch_id:str) -> bool:
+        return batch_id in self.entries
+
+
+    def get(self, batch_id:str):
+        return self.entries[batch_id]
+
+
+    def record(self, batch_id:str, kind:str, counts, published_names:Set[str]=None, stats:Dict=None):
+        """ Record a completed batch. The line is flushed immediately, so that
+            it survives if the job is killed.
+        """
+        entry = {"batch": batch_id, "kind": kind, "counts": counts}
+        if published_names is not None:
+            entry["published_names"] = sorted(published_names)
+        if stats is not None:
+            entry["stats"] = stats
+        self.entries[batch_id] = entry
+        self.file_handle.write(json.dumps(entry) + "\n")
+        self.file_handle.flush()
+
+
+    def write_summary(self):
+        """ Write the aggregated counts of all the completed batches.
+        """
+        summary = sum_counts(self.entries.values())
+        summary["batches"] = len(self.entries)
+        tmp_path = self.summary_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(summary, f, indent=2)
+        os.replace(tmp_path, self.summary_path)
+
+
+    def close(self):
+        self.write_summary()
+        self.file_handle.close()
+
+
+def load_checkpoints(filepaths:List[str]):
+    """ Load the completed batches from the given checkpoint files. Batches
+        completed by several shards (e.g. image lookups, which every shard
+        needs) are only counted once.
+    """
+    entries = {}
+    for filepath in filepaths:
+        if not os.path.exists(filepath):
+            continue
+        with open(filepath) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be truncated if the job was killed
+                    continue
+                entries[entry["batch"]] = entry
+    return entries
+
 
 @ray.remote
 class CounterActor:
@@ -43,14 +227,12 @@ class CounterActor:
         self.errors = defaultdict(int)
        
 
-    def add_counts(self, counter):
-        """ Add the counts from the given counter.
-            TODO: after we upgrade to Python 3.11, we can use 
-                  the Self type for this method signature
+    def add_counts(self, counts):
+        """ Add the given counts, as returned by Counter.counts().
         """
-        for key, count in counter.warnings.items():
+        for key, count in counts.get("warnings", {}).items():
             self.warnings[key] += count
-        for key, count in counter.errors.items():
+        for key, count in counts.get("errors", {}).items():
             self.errors[key] += count
     
 
@@ -79,81 +261,326 @@ class CounterActor:
         print()
 
 
-@ray.remote
-def validate_image_dir_remote(root_dir:str, batch:List[str], counter_actor):
-    from neuronbridge.validate_worker import validate_image_dir_batch
-    return validate_image_dir_batch(root_dir, batch, counter_actor)
+@ray.remote(max_restarts=3, max_task_retries=3)
+class ValidationWorker:
+    """ Validates batches of files in a long-lived worker process, which keeps
+        its state (e.g. its log file) from one batch to the next, until the 
+        WorkerPool recycles it.
+    """
 
+    def validate_image_dir_batch(self, root_dir:str, batch:List[str], counter_actor, **kwargs):
+        from neuronbridge.validate_worker import validate_image_dir_batch
+        return validate_image_dir_batch(root_dir, batch, counter_actor, **kwargs)
 
-@ray.remote
-def validate_matches_remote(root_dir:str, batch:List[str], counter_actor, published_names:Set[str]=None):
-    from neuronbridge.validate_worker import validate_matches_batch
-    return validate_matches_batch(root_dir, batch, counter_actor, published_names=published_names)
 
+    def validate_matches_batch(self, root_dir:str, batch:List[str], counter_actor, **kwargs):
+        from neuronbridge.validate_worker import validate_matches_batch
+        return validate_matches_batch(root_dir, batch, counter_actor, **kwargs)
 
-def validate_image_dir(image_dir:str, one_batch:bool, counter_actor:CounterActor):
-    published_names = set()
-    unfinished = []
-    print(f"Walking image dir {image_dir}")
-    for root, _, files in os.walk(image_dir):
+
+class WorkerPool:
+    """ Pool of ValidationWorkers, each with up to BATCHES_IN_FLIGHT_PER_CPU 
+        batches queued. A worker is retired once its RSS after a batch exceeds 
+        max_rss, or once it was given max_batches batches. A retired worker gets
+        no new batches, and is killed and replaced by a fresh process as soon as
+        its queued batches are done, which returns all of its memory to the OS.
+    """
+
+    def __init__(self, size:int, max_rss:int=None, max_batches:int=None, 
+                 profile_dir:str=None, profile_top:int=PROFILE_TOP):
+        self.size = size
+        self.max_rss = max_rss
+        self.max_batches = max_batches
+        self.profile_dir = profile_dir
+        self.profile_top = profile_top
+        self.workers = [self._start() for _ in range(size)]
+        self.recycled = 0
+        self.stats = []
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+
+    def _start(self):
+        return {"actor": ValidationWorker.remote(), "pending": 0, "batches": 0, "retired": False}
+
+
+    def _available(self):
+        return [w for w in self.workers if not w["retired"] and w["pending"] < BATCHES_IN_FLIGHT_PER_CPU]
+
+
+    def has_capacity(self) -> bool:
+        return bool(self._available())
+
+
+    def submit(self, method:str, *args, **kwargs):
+        """ Queue a batch on the least busy worker. Returns the result ref 
+            and the worker, which must be passed to done() with the result.
+        """
+        worker = min(self._available(), key=lambda w: w["pending"])
+        worker["pending"] += 1
+        worker["batches"] += 1
+        if self.max_batches and worker["batches"] >= self.max_batches:
+            worker["retired"] = True
+        ref = getattr(worker["actor"], method).remote(*args, **kwargs)
+        return ref, worker
+
+
+    def done(self, worker, stats:Dict):
+        """ Account for a finished batch, and recycle the worker if needed.
+        """
+        worker["pending"] -= 1
+        self.stats.append(stats)
+        if self.max_rss and stats["rss"] > self.max_rss:
+            worker["retired"] = True
+        if worker["retired"] and worker["pending"] == 0:
+            ray.kill(worker["actor"])
+            self.workers[self.workers.index(worker)] = self._start()
+            self.recycled += 1
+
+
+    def profile_file(self, batch_id:str):
+        return os.path.join(self.profile_dir, f"{batch_id}.bin")
+
+
+    def print_report(self):
+        """ Print the peak memory of the workers and the slowest batches.
+        """
+        if not self.stats:
+            return
+        peak = max(self.stats, key=lambda s: s["peak_rss"])
+        growth = max(self.stats, key=lambda s: s["rss"] - s["rss_before"])
+        print()
+        print("Worker memory:")
+        print(f"  Peak RSS: {format_size(peak['peak_rss'])} (worker {peak['worker']})")
+        print(f"  Largest growth in one batch: {format_size(growth['rss'] - growth['rss_before'])} "
+              f"(batch {growth.get('batch')}, {growth.get('files')} files in {growth.get('root')})")
+        print(f"  Workers recycled: {self.recycled}")
+        print(f"Slowest batches:")
+        for s in sorted(self.stats, key=lambda s: s["seconds"], reverse=True)[:self.profile_top]:
+            print(f"  {s['seconds']:.1f}s  {s.get('files')} files  {format_size(s.get('bytes', 0))}  "
+                  f"RSS {format_size(s['rss'])}  batch {s.get('batch')} in {s.get('root')}")
+        print()
+
+
+def scan_dir(directory:str):
+    """ Walk the given directory using os.scandir, which provides the file sizes
+        without extra stat calls on most file systems. Yields (root, files) for 
+        each directory, where files is a list of (filename, size) sorted by name.
+    """
+    roots = [directory]
+    while roots:
+        root = roots.pop()
+        files = []
+        try:
+            it = os.scandir(root)
+        except OSError:
+            # Like os.walk, skip directories which cannot be listed
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir():
+                    roots.append(entry.path)
+                elif entry.is_file():
+                    files.append((entry.name, entry.stat().st_size))
+        files.sort()
+        yield root, files
+
+
+def collect_batches(directory:str, label:str, one_batch:bool=False, 
+                    shard:Tuple[int,int]=None) -> List[Tuple[str, List[str], int]]:
+    """ Group the files in the given directory into batches of at most BATCH_SIZE 
+        files and about BATCH_BYTES bytes. Returns (root, filenames, bytes) for 
+        each batch.
+    """
+    batches = []
+    for root, files in scan_dir(directory):
         c = 0
         batch = []
-        for filename in files:
-            batch.append(filename)
-            if len(batch)==BATCH_SIZE:
-                unfinished.append(validate_image_dir_remote.remote(root, batch, counter_actor))
+        nbytes = 0
+        for filename, size in files:
+            if not in_shard(filename, shard):
+                continue
+            if batch and (len(batch)==BATCH_SIZE or nbytes+size > BATCH_BYTES):
+                batches.append((root, batch, nbytes))
                 batch = []
+                nbytes = 0
                 if one_batch:
                     break
+            batch.append(filename)
+            nbytes += size
             c += 1
 
         if batch:
-            unfinished.append(validate_image_dir_remote.remote(root, batch, counter_actor))
+            batches.append((root, batch, nbytes))
+
+        print(f"Validating {c} {label} in {root}")
+
+    return batches
+
+
+def resume_batch(batch_id:str, checkpoint:Checkpoint, counter_actor:CounterActor):
+    """ If the given batch was completed by a previous run, add its counts to
+        the totals and return its checkpoint entry. Otherwise, return None.
+    """
+    if checkpoint is None or batch_id not in checkpoint:
+        return None
+    entry = checkpoint.get(batch_id)
+    counter_actor.add_counts.remote(entry["counts"])
+    return entry
+
+
+def run_batches(batches:List[Tuple[str, List[str], int]], method:str, desc:str, counter_actor:CounterActor,
+                pool:WorkerPool, checkpoint:Checkpoint=None, kind:str=None, asset_dir:str=None, **kwargs):
+    """ Run the given ValidationWorker method on all the batches, and return their 
+        results, including those of batches completed by a previous run. 
         
-        print(f"Validating {c} image lookups in {root}")
-    
-    total = len(unfinished)
-    with tqdm(total=total, desc="Processing image lookups") as pbar:
-        while unfinished:
-            finished, unfinished = ray.wait(unfinished, num_returns=1)
-            for result in ray.get(finished):
-                published_names.update(result)
-            pbar.update(1)
+        The largest batches are submitted first, so that they don't end up as the
+        long tail of the run. Only a bounded number of batches is in flight at once,
+        and the next largest batch goes to whichever worker finishes first. If the
+        pool has a profile_dir, the largest batches are profiled with memray. If an
+        asset_dir is given, each batch writes the assets it references to it, and
+        batches completed by a previous run without collecting their assets (i.e.
+        without --check-assets) are validated again.
+    """
+    results = []
+    todo = []
+    recollect = 0
+    for root, batch, nbytes in batches:
+        batch_id = get_batch_id(root, batch)
+        entry = None
+        if not asset_dir or os.path.exists(os.path.join(asset_dir, f"{batch_id}.run")):
+            entry = resume_batch(batch_id, checkpoint, counter_actor)
+        elif checkpoint and batch_id in checkpoint:
+            recollect += 1
+        if entry:
+            results.append(entry)
+        else:
+            todo.append((batch_id, root, batch, nbytes))
+
+    if results:
+        print(f"Skipping {len(results)} batches completed by a previous run")
+    if recollect:
+        print(f"Validating {recollect} completed batches again to collect their assets")
+
+    todo.sort(key=lambda b: b[3], reverse=True)
+
+    pending = {}
+    next_batch = 0
+    with tqdm(total=sum(b[3] for b in todo), desc=desc, unit="B", unit_scale=True) as pbar:
+        while pending or next_batch < len(todo):
+            while pool.has_capacity() and next_batch < len(todo):
+                batch_id, root, batch, nbytes = todo[next_batch]
+                if pool.profile_dir and next_batch < pool.profile_top:
+                    kwargs["profile_file"] = pool.profile_file(batch_id)
+                else:
+                    kwargs.pop("profile_file", None)
+                if asset_dir:
+                    kwargs["asset_file"] = os.path.join(asset_dir, f"{batch_id}.run")
+                ref, worker = pool.submit(method, root, batch, counter_actor, **kwargs)
+                pending[ref] = (batch_id, root, batch, nbytes, worker)
+                next_batch += 1
+
+            finished, _ = ray.wait(list(pending), num_returns=1)
+            for ref in finished:
+                batch_id, root, batch, nbytes, worker = pending.pop(ref)
+                result = ray.get(ref)
+                stats = result["stats"]
+                stats.update(batch=batch_id, root=root, files=len(batch), bytes=nbytes)
+                pool.done(worker, stats)
+                if checkpoint:
+                    checkpoint.record(batch_id, kind, result["counts"], result.get("published_names"), stats)
+                results.append(result)
+                pbar.update(nbytes)
+
+    if checkpoint:
+        checkpoint.write_summary()
+    return results
+
+
+def validate_image_dir(image_dir:str, one_batch:bool, counter_actor:CounterActor, pool:WorkerPool,
+                       checkpoint:Checkpoint=None, asset_dir:str=None, asset_prefixes=None):
+    published_names = set()
+    print(f"Walking image dir {image_dir}")
+    batches = collect_batches(image_dir, "image lookups", one_batch)
+
+    kwargs = {"asset_prefixes": asset_prefixes} if asset_dir else {}
+    for result in run_batches(batches, "validate_image_dir_batch", "Processing image lookups", 
+                              counter_actor, pool, checkpoint, "images", asset_dir, **kwargs):
+        published_names.update(result["published_names"])
 
     counter_actor.print_summary.remote(f"Totals after validation of image dir {image_dir}:")
     return published_names
 
 
-def validate_match_dir(match_dir, one_batch, counter_actor: CounterActor, published_names:Set[str]=None):
-    unfinished = []
+def validate_match_dir(match_dir, one_batch, counter_actor: CounterActor, pool:WorkerPool, 
+                       published_names:Set[str]=None, checkpoint:Checkpoint=None, shard:Tuple[int,int]=None,
+                       asset_dir:str=None, asset_prefixes=None):
     print(f"Walking match dir {match_dir}")
-    for root, _, files in os.walk(match_dir):
-        c = 0
-        batch = []
-        for filename in files:
-            batch.append(filename)
-            if len(batch)==BATCH_SIZE:
-                unfinished.append(validate_matches_remote.remote(root,batch, counter_actor, published_names=published_names))
-                batch = []
-                if one_batch:
-                    break
-            c += 1
-            
-        if batch:
-            unfinished.append(validate_matches_remote.remote(root, batch, counter_actor, published_names=published_names))
-        
-        print(f"Validating {c} matches in {root}")
-    
-    total = len(unfinished)
-    with tqdm(total=total, desc="Processing matches") as pbar:
-        while unfinished:
-            _, unfinished = ray.wait(unfinished, num_returns=1)
-            pbar.update(1)
+    batches = collect_batches(match_dir, "matches", one_batch, shard)
+
+    # Put the published names in the object store once, instead of with every batch
+    names_ref = ray.put(published_names) if published_names is not None else None
+    kwargs = {"asset_prefixes": asset_prefixes} if asset_dir else {}
+    run_batches(batches, "validate_matches_batch", "Processing matches", 
+                counter_actor, pool, checkpoint, "matches", asset_dir, published_names=names_ref, **kwargs)
 
     counter_actor.print_summary.remote(f"Totals after validation of match dir {match_dir}:")
 
 
+def check_release_assets(asset_dir:str, counter_actor:CounterActor, checkpoint:Checkpoint, checker,
+                         shard:Tuple[int,int]=None):
+    """ Check the assets written to the given directory by the validated batches,
+        and add the errors to the totals. The results are checkpointed for each
+        shard, so that the check is not repeated when a completed run is resumed,
+        and the checks of all the shards are counted when they are merged.
+    """
+    batch_id = get_asset_batch_id(shard)
+    if resume_batch(batch_id, checkpoint, counter_actor):
+        print("Skipping the asset check completed by a previous run")
+        return
+
+    from neuronbridge.assets import check_assets
+    from neuronbridge.validate_worker import Counter, LOG_DIR, MAX_LOGS
+    runs = sorted(glob.glob(os.path.join(asset_dir, "*.run")))
+    work_dir = tempfile.mkdtemp(prefix="assets-")
+    start = time.perf_counter()
+    try:
+        with Counter(log_file=os.path.join(LOG_DIR, "assets.jsonl"), max_logs=MAX_LOGS) as counter:
+            checked = check_assets(runs, counter, work_dir, checker)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    counts = counter.counts()
+    counter_actor.add_counts.remote(counts)
+    if checkpoint:
+        stats = {"files": checked, "seconds": time.perf_counter() - start}
+        checkpoint.record(batch_id, "assets", counts, stats=stats)
+    print(f"Checked {checked} distinct assets")
+    counter_actor.print_summary.remote("Totals after the asset check:")
+
+
+def merge_checkpoints(checkpoint_dir:str) -> int:
+    """ Merge the checkpoints of all the shards in the given directory and
+        print the combined totals. Returns 1 if there were any errors.
+    """
+    filepaths = sorted(glob.glob(os.path.join(checkpoint_dir, "shard_*.jsonl")))
+    entries = load_checkpoints(filepaths)
+    totals = sum_counts(entries.values())
+
+    print(f"Merged {len(entries)} batches from {len(filepaths)} checkpoint files")
+    print(f"  Has Errors: {'yes' if totals['errors'] else 'no'}")
+    for key, count in totals["errors"].items():
+        print(f"  [ERROR] {key}: {count}")
+    for key, count in totals["warnings"].items():
+        print(f"  [WARN] {key}: {count}")
+
+    return 1 if totals["errors"] else 0
+
+
 def main():
+    # Imported here, since the asset module depends on this one
+    from neuronbridge.assets import parse_prefix_map, AssetChecker, load_prefixes
+    from neuronbridge.assets import DEFAULT_THREADS as ASSET_THREADS, DEFAULT_RATE as ASSET_RATE
 
     parser = argparse.ArgumentParser(description='Validate the data and print any issues')
     parser.add_argument('-d', '--data_path', type=str, default=f"/nrs/neuronbridge/v{DEFAULT_VERSION}", \
@@ -174,32 +601,66 @@ def main():
         help='Do only one batch of match validation (for testing)')
     parser.add_argument('--match', dest='match_file', type=str, default=None, \
         help='Only validate the given match file')
+    parser.add_argument('--checkpoint-dir', dest='checkpoint_dir', type=str, default=CHECKPOINT_DIR, \
+        help='Directory where completed batches are recorded')
+    parser.add_argument('--resume', dest='resume', action='store_true', \
+        help='Skip the batches completed by a previous run of the same shard')
+    parser.add_argument('--shard', dest='shard', type=parse_shard, default=None, \
+        help='Only validate the match files in shard i of n, e.g. 0/4')
+    parser.add_argument('--merge', dest='merge', action='store_true', \
+        help='Merge the checkpoints of all shards and print the totals, without validating')
+    parser.add_argument('--worker-memory', dest='worker_memory', type=parse_size, default=None, \
+        help='Recycle a worker once its RSS exceeds this size after a batch, e.g. 4G')
+    parser.add_argument('--recycle-after', dest='recycle_after', type=int, default=None, \
+        help='Recycle a worker after it has validated this many batches')
+    parser.add_argument('--profile-dir', dest='profile_dir', type=str, default=None, \
+        help='Record memray allocation profiles of the largest batches in this directory')
+    parser.add_argument('--profile-top', dest='profile_top', type=int, default=PROFILE_TOP, \
+        help='Number of batches to profile in each directory, and to list as the slowest')
+    parser.add_argument('--check-assets', dest='check_assets', action='store_true', \
+        help='Check that the files referenced by the image lookups and matches exist')
+    parser.add_argument('--config', dest='config', type=str, default=None, \
+        help='Data config with the store prefixes used to resolve the assets (default: <data_path>/config.json)')
+    parser.add_argument('--asset-prefix', dest='asset_prefixes', type=parse_prefix_map, action='append', default=[], \
+        help='Rewrite an asset prefix before checking, e.g. to a local copy or another S3 endpoint: OLD=NEW')
+    parser.add_argument('--asset-threads', dest='asset_threads', type=int, default=ASSET_THREADS, \
+        help='Number of concurrent asset checks')
+    parser.add_argument('--asset-rate', dest='asset_rate', type=float, default=ASSET_RATE, \
+        help='Maximum number of HEAD requests per second when checking remote assets')
 
     parser.set_defaults(validateImageLookups=True)
     parser.set_defaults(validateMatches=True)
     parser.set_defaults(includeDashboard=False)
     parser.set_defaults(one_batch=False)
+    parser.set_defaults(resume=False)
+    parser.set_defaults(merge=False)
+    parser.set_defaults(check_assets=False)
 
     args = parser.parse_args()
     data_path = args.data_path
     one_batch = args.one_batch
 
+    if args.merge:
+        return merge_checkpoints(args.checkpoint_dir)
+
+    if args.profile_dir:
+        import importlib.util
+        if not importlib.util.find_spec("memray"):
+            parser.error("--profile-dir requires memray, e.g. pip install memray")
+
     if one_batch:
         print("Running a single batch per match dir. This mode should only be used for testing!")
 
-    image_dirs = [
-        f"{data_path}/brain+vnc/mips/embodies",
-        f"{data_path}/brain+vnc/mips/lmlines",
-    ]
+    asset_prefixes = None
+    if args.check_assets:
+        config_path = args.config or f"{data_path}/config.json"
+        try:
+            asset_prefixes = load_prefixes(config_path)
+        except (OSError, ValueError, KeyError) as e:
+            parser.error(f"--check-assets could not read the data config {config_path}: {e}")
 
-    match_dirs = [
-        f"{data_path}/brain/cdmatches/em-vs-lm/",
-        f"{data_path}/brain/cdmatches/lm-vs-em/",
-        f"{data_path}/brain/pppmatches/em-vs-lm/",
-        f"{data_path}/vnc/cdmatches/em-vs-lm/",
-        f"{data_path}/vnc/cdmatches/lm-vs-em/",
-        f"{data_path}/vnc/pppmatches/em-vs-lm/",
-    ]
+    image_dirs = get_image_dirs(data_path)
+    match_dirs = get_match_dirs(data_path)
 
     cpus = args.cores
     if cpus:
@@ -228,22 +689,44 @@ def main():
 
     ray.init(num_cpus=cpus, address=address, ignore_reinit_error=True, **kwargs)
 
+    checkpoint = None
+    pool = None
     try:
         published_names = set()
         
         counter_actor = CounterActor.remote()
+        pool = WorkerPool(max(1, int(ray.cluster_resources().get("CPU", 1))), args.worker_memory, 
+                          args.recycle_after, args.profile_dir, args.profile_top)
         
         if args.match_file:
             match_dir = os.path.dirname(args.match_file)
             match_filename = os.path.basename(args.match_file)
             batch = [match_filename]
-            ray.get(validate_matches_remote.remote(match_dir, batch, counter_actor))
+            ref, worker = pool.submit("validate_matches_batch", match_dir, batch, counter_actor)
+            pool.done(worker, ray.get(ref)["stats"])
         else:
+            checkpoint = Checkpoint(args.checkpoint_dir, args.shard, args.resume)
+            if args.shard:
+                print(f"Validating shard {args.shard[0]} of {args.shard[1]}")
+
+            asset_dir = None
+            prefixes_ref = None
+            if args.check_assets:
+                # The assets of each batch are kept with the checkpoints, for resumed runs
+                asset_dir = os.path.join(args.checkpoint_dir, get_asset_batch_id(args.shard))
+                if not args.resume:
+                    shutil.rmtree(asset_dir, ignore_errors=True)
+                os.makedirs(asset_dir, exist_ok=True)
+                prefixes_ref = ray.put(asset_prefixes)
+
             if args.validateImageLookups:
                 print("Validating image lookups...")
+                # Every shard validates the image lookups, but only the first checks their assets
+                lookup_asset_dir = asset_dir if not args.shard or args.shard[0] == 0 else None
                 for image_dir in image_dirs:
                     print(f"Validating image lookups in {image_dir}")
-                    result = validate_image_dir(image_dir, one_batch, counter_actor)
+                    result = validate_image_dir(image_dir, one_batch, counter_actor, pool, checkpoint,
+                                                lookup_asset_dir, prefixes_ref)
                     published_names.update(result)
                                         
                 print(f"Indexed {len(published_names)} total published names")
@@ -252,9 +735,19 @@ def main():
                 print("Validating matches...")
                 for match_dir in match_dirs:
                     p_names = published_names if args.validateImageLookups else None
-                    validate_match_dir(match_dir, one_batch, counter_actor, p_names)
+                    validate_match_dir(match_dir, one_batch, counter_actor, pool, p_names, checkpoint, args.shard,
+                                       asset_dir, prefixes_ref)
+
+            if args.check_assets:
+                print("Checking assets...")
+                checker = AssetChecker(args.asset_threads, args.asset_rate, args.asset_prefixes)
+                check_release_assets(asset_dir, counter_actor, checkpoint, checker, args.shard)
 
     finally:
+        if checkpoint:
+            checkpoint.close()
+        if pool:
+            pool.print_report()
         counter_actor.print_summary.remote("Final totals:")
 
     return 1 if counter_actor.has_errors.remote() else 0
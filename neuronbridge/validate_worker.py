@@ -1,8 +1,11 @@
 import os
 import gc
 import sys
+import time
+import resource
 import traceback
-from typing import Set, DefaultDict, List
+import contextlib
+from typing import Set, DefaultDict, Dict, List
 from collections import defaultdict
 
 import ray
@@ -10,6 +13,8 @@ import pydantic
 import rapidjson
 
 import neuronbridge.model as model
+from neuronbridge.schema_validators import get_validator
+from neuronbridge.assets import AssetCollector
 
 # Directory to store log files
 LOG_DIR = "logs2"
@@ -17,9 +22,12 @@ LOG_DIR = "logs2"
 # Print debug messages on the workers
 DEBUG = False
 
-# Maximum number of log lines (per worker) to print for each warning or error type
+# Maximum number of distinct log records (per worker) to write for each warning or error type
 MAX_LOGS = 1000
 
+# Number of log records to buffer before writing them to the log file
+LOG_BUFFER_SIZE = 1000
+
 # Maximum number of matches allowed per published name
 MAX_MATCHES_PER_NAME = 5
 
@@ -31,6 +39,12 @@ class Counter:
     """ This class keeps track of validation errors and allows for the 
         union of multiple Counter objects to represent the validation
         state of an entire data set.
+
+        Log records are written as JSON lines, in batches, to keep the 
+        logging overhead low. For each warning or error type, only the 
+        first max_logs distinct arguments are logged, so the memory used
+        for deduplication is bounded. Use merge_logs.py to combine the 
+        logs of all the workers into one report.
     """
 
     def __init__(self, warnings:DefaultDict[str, int]=None, errors:Set[str]=None, log_file:str=None, max_logs:int=None):
@@ -38,80 +52,159 @@ class Counter:
         self.errors = errors if errors else defaultdict(int)
         self.log_file = log_file
         self.max_logs = max_logs
-        self.tags = set()
+        self.sampled = defaultdict(set)
+        self.buffer = []
+        self.file_handle = None
 
 
     def __enter__(self):
         """ Open the log file if it was specified.
         """
         if self.log_file:
-            # Use line buffering to ensure that each log message is written immediately
-            self.file_handle = open(self.log_file, "a", buffering=1)
+            self.file_handle = open(self.log_file, "a")
         else:
             self.file_handle = sys.stderr
         return self
 
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        """ Close the log file if it was opened.
+        """ Write any buffered records and close the log file if it was opened.
         """ 
+        self.flush()
         if self.file_handle and self.file_handle != sys.stderr:
             self.file_handle.close()
 
 
-    def __getstate__(self):
-        state = self.__dict__.copy()
-        # Don't pickle file_handle
-        if "file_handle" in state:
-            del state["file_handle"]
-        return state
+    def __reduce__(self):
+        """ Pickle with the compact wire format (see wire.py). The log file
+            handle and any records which have not been written are not
+            included, and the unpickled Counter logs to stderr.
+        """
+        from neuronbridge import wire
+        return wire.loads, (wire.dumps(self),)
+
+
+    def flush(self):
+        """ Write the buffered log records to the log file.
+        """
+        if self.buffer and self.file_handle:
+            self.file_handle.write("".join(self.buffer))
+            self.file_handle.flush()
+        self.buffer = []
+
+
+    def log(self, record:Dict):
+        """ Add a record to the log buffer, writing the buffer if it is full.
+        """
+        self.buffer.append(rapidjson.dumps(record) + "\n")
+        if len(self.buffer) >= LOG_BUFFER_SIZE:
+            self.flush()
+
+
+    def sample(self, s:str, arg:str) -> bool:
+        """ Returns True if the given argument should be logged for the given 
+            type, i.e. it was not logged before and the type is under max_logs.
+        """
+        seen = self.sampled[s]
+        if arg in seen or (self.max_logs and len(seen) >= self.max_logs):
+            return False
+        seen.add(arg)
+        return True
+
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        """ Returns a copy of the current warning and error counts.
+        """
+        return {"warnings": dict(self.warnings), "errors": dict(self.errors)}
 
 
-    def __setstate__(self, state):
-        self.__dict__.update(state)
-        # Add file_handle back since it doesn't exist in the pickle
-        self.file_handle = sys.stderr
+    def counts_since(self, before:Dict[str, Dict[str, int]]) -> Dict[str, Dict[str, int]]:
+        """ Returns the counts accumulated since the given snapshot from counts().
+            The counter lives as long as the worker, so this gives the counts
+            for a single batch.
+        """
+        delta = {}
+        for kind, counts in self.counts().items():
+            delta[kind] = {key: count - before[kind].get(key, 0) for key, count in counts.items()
+                           if count != before[kind].get(key, 0)}
+        return delta
 
 
     def print(self, s:str):
-        """ Print a message to the log file.
+        """ Log a message to the log file.
         """
-        print(s, file=self.file_handle)
+        self.log({"level": "info", "message": s})
 
 
     def warn(self, s:str, arg:str, filepath:str):
-        """ Log a warning to STDERR and keep a count of the warning type.
+        """ Log a warning and keep a count of the warning type.
             Warnings do not produce a failed validation. 
         """
-        tag = f"{s}: {arg}"
-        if tag not in self.tags:
-            self.tags.add(tag)
-            if not self.max_logs or self.warnings[s] <= self.max_logs:
-                print(f"[WARN] {tag} {filepath}", file=self.file_handle)
+        if self.sample(s, arg):
+            self.log({"level": "warn", "type": s, "arg": arg, "file": filepath})
         self.warnings[s] += 1
 
 
     def error(self, s:str, arg:str, filepath:str, trace:str=None):
-        """ Log an error to STDERR and keep a count of the error type.
+        """ Log an error and keep a count of the error type.
             Errors produce a failed validation.
         """
-        tag = f"{s}: {arg}"
-        if tag not in self.tags:
-            self.tags.add(tag)
-            if not self.max_logs or self.errors[s] <= self.max_logs:
-                print(f"[ERROR] {tag} {filepath}", file=self.file_handle)
+        if self.sample(s, arg):
+            record = {"level": "error", "type": s, "arg": arg, "file": filepath}
             if trace:
-                print(trace, file=self.file_handle)
+                record["trace"] = trace
+            self.log(record)
         self.errors[s] += 1
 
 
 
+def get_rss() -> int:
+    """ Returns the current resident set size of this process, in bytes.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Not on Linux, fall back to the peak
+        return get_peak_rss()
+
+
+def get_peak_rss() -> int:
+    """ Returns the peak resident set size of this process, in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+@contextlib.contextmanager
+def batch_stats(profile_file:str=None):
+    """ Measure the time and memory used by a batch. Yields a dict which is
+        filled in when the batch is done. If profile_file is given, a memray
+        allocation profile of the batch is written to it.
+    """
+    stats = {"worker": worker_id, "rss_before": get_rss()}
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if profile_file:
+            import memray
+            if os.path.exists(profile_file):
+                os.remove(profile_file)
+            stack.enter_context(memray.Tracker(profile_file))
+        yield stats
+    # Collect whatever the batch left behind before measuring what it kept
+    gc.collect()
+    stats["seconds"] = time.perf_counter() - start
+    stats["rss"] = get_rss()
+    stats["peak_rss"] = get_peak_rss()
+
+
 # Create log directory if it doesn't exist
 os.makedirs(LOG_DIR, exist_ok=True)
 
 # Get the worker ID and create a log file for this worker
 worker_id = ray.get_runtime_context().get_worker_id()
-log_file = f"{LOG_DIR}/worker_{worker_id}.log"
+log_file = f"{LOG_DIR}/worker_{worker_id}.jsonl"
 
 # Putting this counter state in a separate module is a neat little hack that I found here:
 # https://discuss.ray.io/t/global-variables-to-maintain-a-worker-specific-state/12251/3
@@ -120,130 +213,169 @@ log_file = f"{LOG_DIR}/worker_{worker_id}.log"
 counter = Counter(log_file=log_file, max_logs=MAX_LOGS) 
 
 
-def validate(counter:Counter, image, filepath):
-    if isinstance(image, model.LMImage):
-        if not image.files.VisuallyLosslessStack:
-            counter.warn("Missing VisuallyLosslessStack", image.id, filepath)
-        if not image.mountingProtocol:
-            counter.warn("Missing mountingProtocol", image.id, filepath)
-    if isinstance(image, model.EMImage):
-        if not image.files.AlignedBodySWC:
-            counter.warn("Missing AlignedBodySWC", image.id, filepath)
-
-
-def validate_image_lookup(counter:Counter, filepath:str, published_names:Set[str]):
+def load(filepath:str, model_class) -> Dict:
+    """ Load a JSON file and validate it against the given model. The fast
+        schema validator is tried first, and the pydantic model is only built
+        if it fails, either to raise a ValidationError with the details, or to
+        normalize an object which the stricter fast validator rejected.
+        Returns the validated object as a dict.
+    """
     with open(filepath) as f:
         obj = rapidjson.load(f)
-        lookup = model.ImageLookup(**obj)
-        if not lookup.results:
-            counter.error("No images", "", filepath)
-        for image in lookup.results:
-            validate(counter, image, filepath)
-            files = image.files
-            if not files.CDM:
-                counter.error("Missing CDM", image.id, filepath)
-            if not files.CDMThumbnail:
-                counter.error("Missing CDMThumbnail", image.id, filepath)
-            if not files.CDSResults and not files.PPPMResults:
-                counter.error("Missing CDSResults or PPPMResults", image.id, filepath)
-            published_names.add(image.publishedName)
-
-
-def validate_image_dir_batch(root_dir:str, image_files:List[str], counter_actor):
+    if get_validator(model_class)(obj):
+        return obj
+    return model_class(**obj).model_dump(mode="json")
+
+
+def validate(counter:Counter, image:Dict, filepath):
+    files = image["files"]
+    if image["type"] == "LMImage":
+        if not files.get("VisuallyLosslessStack"):
+            counter.warn("Missing VisuallyLosslessStack", image["id"], filepath)
+        if not image.get("mountingProtocol"):
+            counter.warn("Missing mountingProtocol", image["id"], filepath)
+    if image["type"] == "EMImage":
+        if not files.get("AlignedBodySWC"):
+            counter.warn("Missing AlignedBodySWC", image["id"], filepath)
+
+
+def collect_assets(assets:AssetCollector, files:Dict, filepath:str):
+    """ Collect the files referenced by the given Files, if assets are being checked.
+    """
+    if assets is not None:
+        assets.add(files, filepath)
+
+
+def validate_image_lookup(counter:Counter, filepath:str, published_names:Set[str], assets:AssetCollector=None):
+    lookup = load(filepath, model.ImageLookup)
+    if not lookup["results"]:
+        counter.error("No images", "", filepath)
+    for image in lookup["results"]:
+        validate(counter, image, filepath)
+        files = image["files"]
+        collect_assets(assets, files, filepath)
+        if not files.get("CDM"):
+            counter.error("Missing CDM", image["id"], filepath)
+        if not files.get("CDMThumbnail"):
+            counter.error("Missing CDMThumbnail", image["id"], filepath)
+        if not files.get("CDSResults") and not files.get("PPPMResults"):
+            counter.error("Missing CDSResults or PPPMResults", image["id"], filepath)
+        published_names.add(image["publishedName"])
+
+
+def validate_image_dir_batch(root_dir:str, image_files:List[str], counter_actor, profile_file:str=None,
+                             asset_prefixes:Dict=None, asset_file:str=None):
     
-    with counter:
+    with batch_stats(profile_file) as stats, counter:
+        before = counter.counts()
         published_names = set()
+        assets = AssetCollector(asset_prefixes) if asset_file else None
 
         for filename in image_files:
             filepath = os.path.join(root_dir, filename)
             try:
-                validate_image_lookup(counter, filepath, published_names)
+                validate_image_lookup(counter, filepath, published_names, assets)
             except pydantic.ValidationError:
                 counter.error("Validation failed for image", "", filepath, trace=traceback.format_exc())
-        
-        counter_actor.add_counts.remote(counter)
-        return published_names
-
 
-
-def validate_match_file(filepath:str, counter:Counter, published_names:Set[str]=None):
-    with open(filepath) as f:
-        num_matches_per_name = defaultdict(int)
-        obj = rapidjson.load(f)
-        matches = model.PrecomputedMatches(**obj)
-
-        # Validate the input image
-        input_image = matches.inputImage
-        validate(counter, input_image, filepath)
-        files = input_image.files
-        if not files.CDM:
-            counter.error("Missing CDM", input_image.id, filepath)
-        if not files.CDMThumbnail:
-            counter.error("Missing CDMThumbnail", input_image.id, filepath)
-            
-        # Validate the published name
-        if published_names and matches.inputImage.publishedName not in published_names:
-            counter.error("Published name not indexed", matches.inputImage.publishedName, filepath)
+        if assets is not None:
+            assets.write(asset_file)
         
-        # Validate the matches
-        c = 0
-        for match in matches.results:
-            num_matches_per_name[match.image.publishedName] += 1
-            validate(counter, match.image, filepath)
-            match_files = match.files
-            image_files = match.image.files
-            if isinstance(match, model.CDSMatch):
-                if not image_files.CDM:
-                    counter.error("Missing CDM", match.image.id, filepath)
-                if not image_files.CDMThumbnail:
-                    counter.error("Missing CDMThumbnail", match.image.id, filepath)
-                if not match_files.CDMInput:
-                    counter.error("Missing CDMInput", match.image.id, filepath)
-                if not match_files.CDMMatch:
-                    counter.error("Missing CDMMatch", match.image.id, filepath)
-            if isinstance(match, model.PPPMatch):
-                if not match_files.CDMBest:
-                    counter.error("Missing CDMBest", match.image.id, filepath)
-                if not match_files.CDMBestThumbnail:
-                    counter.error("Missing CDMBestThumbnail", match.image.id, filepath)
-                if not match_files.CDMSkel:
-                    counter.error("Missing CDMSkel", match.image.id, filepath)
-                if not match_files.SignalMip:
-                    counter.error("Missing SignalMip", match.image.id, filepath)
-                if not match_files.SignalMipMasked:
-                    counter.error("Missing SignalMipMasked", match.image.id, filepath)
-                if not match_files.SignalMipMaskedSkel:
-                    counter.error("Missing SignalMipMaskedSkel", match.image.id, filepath)
-            if published_names and match.image.publishedName not in published_names:
-                counter.error("Match published name not indexed", match.image.publishedName, filepath)
-
-            c += 1
-            
-            # Validate the number of matches. Stop processing if we hit the limit.
-            if c > MAX_MATCHES_PER_FILE:
-                counter.error("Too many matches", f"({c})", filepath)
-                break
-
-        # Validate the number of matches per published name
-        for name, count in num_matches_per_name.items():
-            if count > MAX_MATCHES_PER_NAME:
-                counter.error("Too many matches for published name", name, filepath)
-                break
-
-
-def validate_matches_batch(root_dir:str, match_files:List[str], counter_actor, published_names:Set[str]=None, log_dir:str=None):
+        counts = counter.counts_since(before)
+        counter_actor.add_counts.remote(counts)
+
+    return {"counts": counts, "published_names": published_names, "stats": stats}
+
+
+
+def validate_match_file(filepath:str, counter:Counter, published_names:Set[str]=None, assets:AssetCollector=None):
+    num_matches_per_name = defaultdict(int)
+    matches = load(filepath, model.PrecomputedMatches)
+
+    # Validate the input image
+    input_image = matches["inputImage"]
+    validate(counter, input_image, filepath)
+    files = input_image["files"]
+    collect_assets(assets, files, filepath)
+    if not files.get("CDM"):
+        counter.error("Missing CDM", input_image["id"], filepath)
+    if not files.get("CDMThumbnail"):
+        counter.error("Missing CDMThumbnail", input_image["id"], filepath)
+
+    # Validate the published name
+    if published_names and input_image["publishedName"] not in published_names:
+        counter.error("Published name not indexed", input_image["publishedName"], filepath)
+
+    # Validate the matches
+    c = 0
+    for match in matches["results"]:
+        image = match["image"]
+        num_matches_per_name[image["publishedName"]] += 1
+        validate(counter, image, filepath)
+        match_files = match["files"]
+        image_files = image["files"]
+        collect_assets(assets, match_files, filepath)
+        collect_assets(assets, image_files, filepath)
+        if match["type"] == "CDSMatch":
+            if not image_files.get("CDM"):
+                counter.error("Missing CDM", image["id"], filepath)
+            if not image_files.get("CDMThumbnail"):
+                counter.error("Missing CDMThumbnail", image["id"], filepath)
+            if not match_files.get("CDMInput"):
+                counter.error("Missing CDMInput", image["id"], filepath)
+            if not match_files.get("CDMMatch"):
+                counter.error("Missing CDMMatch", image["id"], filepath)
+        if match["type"] == "PPPMatch":
+            if not match_files.get("CDMBest"):
+                counter.error("Missing CDMBest", image["id"], filepath)
+            if not match_files.get("CDMBestThumbnail"):
+                counter.error("Missing CDMBestThumbnail", image["id"], filepath)
+            if not match_files.get("CDMSkel"):
+                counter.error("Missing CDMSkel", image["id"], filepath)
+            if not match_files.get("SignalMip"):
+                counter.error("Missing SignalMip", image["id"], filepath)
+            if not match_files.get("SignalMipMasked"):
+                counter.error("Missing SignalMipMasked", image["id"], filepath)
+            if not match_files.get("SignalMipMaskedSkel"):
+                counter.error("Missing SignalMipMaskedSkel", image["id"], filepath)
+        if published_names and image["publishedName"] not in published_names:
+            counter.error("Match published name not indexed", image["publishedName"], filepath)
+
+        c += 1
+
+        # Validate the number of matches. Stop processing if we hit the limit.
+        if c > MAX_MATCHES_PER_FILE:
+            counter.error("Too many matches", f"({c})", filepath)
+            break
+
+    # Validate the number of matches per published name
+    for name, count in num_matches_per_name.items():
+        if count > MAX_MATCHES_PER_NAME:
+            counter.error("Too many matches for published name", name, filepath)
+            break
+
+
+def validate_matches_batch(root_dir:str, match_files:List[str], counter_actor, published_names:Set[str]=None,
+                           log_dir:str=None, profile_file:str=None, asset_prefixes:Dict=None, asset_file:str=None):
     i = 0
-    with counter:
+    with batch_stats(profile_file) as stats, counter:
+        before = counter.counts()
+        assets = AssetCollector(asset_prefixes) if asset_file else None
         
         for filename in match_files:
             filepath = os.path.join(root_dir, filename)
-            counter.print(f"Validating {filepath} ({i}/{len(match_files)})")
+            if DEBUG:
+                counter.print(f"Validating {filepath} ({i}/{len(match_files)})")
             try:
-                validate_match_file(filepath, counter, published_names)
+                validate_match_file(filepath, counter, published_names, assets)
             except pydantic.ValidationError:
                 counter.error("Validation failed for match", "", filepath, trace=traceback.format_exc())
             i += 1
+
+        if assets is not None:
+            assets.write(asset_file)
         
-        counter_actor.add_counts.remote(counter)
-        
-    gc.collect()
+        counts = counter.counts_since(before)
+        counter_actor.add_counts.remote(counts)
+
+    return {"counts": counts, "stats": stats}
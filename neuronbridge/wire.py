@@ -0,0 +1,311 @@
+"""
+Compact, versioned binary encoding of the NeuronBridge models, for shipping
+parsed objects between processes (Ray tasks and actors, multiprocessing):
+
+    data = wire.dumps(matches)
+    matches = wire.loads(data)
+
+A model is encoded with msgpack, as an array of its class code, a bit mask
+of the fields which are set, and the values of those fields in declaration
+order, so that no field names are written. The values of interned fields (see
+model.InternedStr) and the directories of file paths, which repeat across the
+images of a match set, are written once per message in a string table and
+referenced by index.
+Decoding trusts the data, and builds the models without validating them, with
+functions that are generated for each class and set of fields.
+
+The models and the validation Counter pickle through this encoding (see
+their __reduce__ hooks), so it applies transparently wherever they are
+pickled. Data written by a different version of the models is rejected.
+"""
+
+import sys
+import zlib
+import typing
+from enum import Enum
+from typing import Any, Dict, List, Tuple
+
+import msgpack
+from pydantic import BaseModel
+
+import neuronbridge.model as model
+
+# Version of the encoding. Changes to the models are detected separately.
+FORMAT_VERSION = 1
+
+# Classes which can be encoded. Codes are list positions, so append new classes.
+MODEL_CLASSES = [
+    model.AnatomicalArea,
+    model.LibraryConfig,
+    model.CustomSearchConfig,
+    model.DataStore,
+    model.DataConfig,
+    model.Files,
+    model.UploadedImage,
+    model.EMImage,
+    model.LMImage,
+    model.ImageLookup,
+    model.CDSMatch,
+    model.PPPMatch,
+    model.Matches,
+    model.PrecomputedMatches,
+    model.CustomMatches,
+]
+
+# Class code of the validation Counter, which is not a model
+COUNTER_CODE = len(MODEL_CLASSES)
+
+class UnknownType(TypeError):
+    """ Raised when encoding an object of a class which is not known to the
+        wire format, such as a subclass of one of the models.
+    """
+
+
+# Ways of encoding a field value
+VALUE, INTERNED, PATH, ENUM, MODEL, MODEL_LIST, MODEL_DICT, CONSTANT = range(8)
+
+
+def _field_kind(annotation) -> Tuple[int, Any]:
+    """ Returns how values of the given field type are encoded, and the enum
+        class or constant value that goes with it.
+    """
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+    if origin is typing.Annotated:
+        if any(getattr(m, "func", None) is sys.intern for m in annotation.__metadata__):
+            return INTERNED, None
+        return _field_kind(args[0])
+    if origin is typing.Union:
+        kinds = {_field_kind(a) for a in args if a is not type(None)}
+        return kinds.pop() if len(kinds) == 1 else (VALUE, None)
+    if origin is typing.Literal:
+        return CONSTANT, args[0]
+    if origin in (list, List):
+        kind, _ = _field_kind(args[0])
+        return (MODEL_LIST, None) if kind == MODEL else (VALUE, None)
+    if origin in (dict, Dict):
+        kind, _ = _field_kind(args[1])
+        return (MODEL_DICT, None) if kind == MODEL else (VALUE, None)
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return MODEL, None
+    if isinstance(annotation, type) and issubclass(annotation, Enum):
+        return ENUM, {e.value: e for e in annotation}
+    return VALUE, None
+
+
+def _field_plan(cls) -> List[Tuple[str, int, Any]]:
+    """ Returns (name, kind, extra) for each field of a model class.
+    """
+    plan = []
+    for name, field in cls.model_fields.items():
+        annotation = field.annotation
+        if field.metadata:
+            annotation = typing.Annotated[(annotation, *field.metadata)]
+        kind, extra = _field_kind(annotation)
+        if cls is model.Files and kind == VALUE:
+            kind = PATH
+        plan.append((name, kind, extra))
+    return plan
+
+
+_plans = [_field_plan(cls) for cls in MODEL_CLASSES]
+_codes = {cls: code for code, cls in enumerate(MODEL_CLASSES)}
+
+# Checksum of the model layouts, which changes whenever a field is added,
+# removed, reordered or changes kind
+LAYOUT = zlib.crc32(repr([(cls.__name__, [(name, kind) for name, kind, _ in plan])
+                          for cls, plan in zip(MODEL_CLASSES, _plans)]).encode())
+
+
+def _encoder_source(code:int) -> str:
+    """ Returns the source of a function which encodes a model of the given
+        class, adding its strings to the string table t. The bits of the
+        mask which follows the class code tell which fields are set, and
+        only their values are written.
+    """
+    lines = [
+        "def encode(o, t):",
+        "    v = o.__dict__",
+        "    f = o.__pydantic_fields_set__",
+        f"    out = [{code}, 0]",
+        "    m = 0",
+    ]
+    for i, (name, kind, _) in enumerate(_plans[code]):
+        if kind == VALUE:
+            expr = "x"
+        elif kind == INTERNED:
+            expr = "t.setdefault(x, len(t))"
+        elif kind == PATH:
+            # The directories are shared by many images, so they go in the string table
+            expr = "x if not (p := x.rpartition('/'))[1] else [t.setdefault(p[0], len(t)), p[2]]"
+        elif kind == ENUM:
+            expr = "x.value"
+        elif kind == MODEL:
+            expr = "_encoders[_codes[x.__class__]](x, t)"
+        elif kind == MODEL_LIST:
+            expr = "[_encoders[_codes[y.__class__]](y, t) for y in x]"
+        elif kind == MODEL_DICT:
+            expr = "{k: _encoders[_codes[y.__class__]](y, t) for k, y in x.items()}"
+        lines.append(f"    if {name!r} in f:")
+        lines.append(f"        m |= {1 << i}")
+        if kind != CONSTANT:
+            # Constants are implied by the class code
+            expr = expr if kind == VALUE else f"None if x is None else {expr}"
+            lines.append(f"        x = v[{name!r}]")
+            lines.append(f"        out.append({expr})")
+    lines += ["    out[1] = m", "    return out"]
+    return "\n".join(lines)
+
+
+# Expression which decodes a nested model, inlined to save a function call per model
+_DISPATCH = "(_decoders.get(({0}[0], {0}[1])) or _compile_decoder({0}[0], {0}[1]))({0}, s)"
+
+
+def _decoder_source(code:int, mask:int) -> str:
+    """ Returns the source of a function which builds a model of the given
+        class, with the given fields set, from its encoded data and the string
+        table s. Fields which are not set keep their defaults, as when the
+        model is validated.
+    """
+    values = []
+    fields_set = []
+    j = 2
+    for i, (name, kind, extra) in enumerate(_plans[code]):
+        if not mask & (1 << i):
+            default = _defaults[code][name]
+            if default is None or type(default) in (str, int, float, bool):
+                values.append(f"{name!r}: {default!r}")
+            else:
+                values.append(f"{name!r}: _defaults[{code}][{name!r}]")
+            continue
+        fields_set.append(name)
+        if kind == CONSTANT:
+            values.append(f"{name!r}: {extra!r}")
+            continue
+        x = f"d[{j}]"
+        j += 1
+        if kind == VALUE:
+            expr = x
+        elif kind == INTERNED:
+            expr = f"s[x]"
+        elif kind == PATH:
+            expr = "x if x.__class__ is str else s[x[0]] + '/' + x[1]"
+        elif kind == ENUM:
+            expr = f"_enums[{code}][{name!r}][x]"
+        elif kind == MODEL:
+            expr = _DISPATCH.format("x")
+        elif kind == MODEL_LIST:
+            expr = f"[{_DISPATCH.format('y')} for y in x]"
+        elif kind == MODEL_DICT:
+            expr = f"{{k: {_DISPATCH.format('y')} for k, y in x.items()}}"
+        if kind != VALUE:
+            expr = f"None if (x := {x}) is None else {expr}"
+        values.append(f"{name!r}: {expr}")
+    return "\n".join([
+        "def decode(d, s):",
+        "    values = {",
+        *[f"        {value}," for value in values],
+        "    }",
+        # This is how pydantic builds a model when it is unpickled
+        f"    obj = _new(_classes[{code}])",
+        "    _set(obj, '__dict__', values)",
+        f"    _set(obj, '__pydantic_fields_set__', {repr(set(fields_set)) if fields_set else 'set()'})",
+        "    _set(obj, '__pydantic_extra__', None)",
+        "    _set(obj, '__pydantic_private__', None)",
+        "    return obj",
+    ])
+
+
+def _compile_decoder(code:int, mask:int):
+    """ Compiles the decoder of a class for a set of fields. There are only a
+        few distinct sets of fields for each class, so the decoders are
+        compiled as they are needed, and cached.
+    """
+    namespace = dict(_namespace)
+    source = _decoder_source(code, mask)
+    exec(compile(source, f"<{MODEL_CLASSES[code].__name__} decoder>", "exec"), namespace)
+    _decoders[code, mask] = decoder = namespace["decode"]
+    return decoder
+
+
+def _decode(d:list, s:List[str]) -> BaseModel:
+    """ Decodes an encoded model, given the string table of the message.
+    """
+    return (_decoders.get((d[0], d[1])) or _compile_decoder(d[0], d[1]))(d, s)
+
+
+# Default values of the fields, which are used for the fields which are not set
+_defaults = [{name: None if field.is_required() else field.default for name, field in cls.model_fields.items()}
+             for cls in MODEL_CLASSES]
+
+# Encoders by class code, and decoders by class code and mask
+_encoders = []
+_decoders = {}
+_namespace = {
+    "_classes": MODEL_CLASSES,
+    "_codes": _codes,
+    "_encoders": _encoders,
+    "_decoders": _decoders,
+    "_compile_decoder": _compile_decoder,
+    "_defaults": _defaults,
+    "_enums": [{name: extra for name, kind, extra in plan if kind == ENUM} for plan in _plans],
+    "_new": object.__new__,
+    "_set": object.__setattr__,
+}
+for _code, _cls in enumerate(MODEL_CLASSES):
+    exec(compile(_encoder_source(_code), f"<{_cls.__name__} encoder>", "exec"), _namespace)
+    _encoders.append(_namespace.pop("encode"))
+
+
+def _counter_class():
+    # Imported lazily, since the worker module depends on Ray
+    from neuronbridge.validate_worker import Counter
+    return Counter
+
+
+def dumps(obj) -> bytes:
+    """ Encodes a model, or a validation Counter, as bytes. Raises UnknownType
+        for other objects, including models which are (or contain) instances
+        of classes which are not in MODEL_CLASSES.
+    """
+    strings = {}
+    if isinstance(obj, BaseModel):
+        try:
+            payload = _encoders[_codes[type(obj)]](obj, strings)
+        except KeyError as e:
+            # Subclasses of the models are not in MODEL_CLASSES
+            if not isinstance(e.args[0], type):
+                raise
+            raise UnknownType(f"Cannot encode objects of type {e.args[0].__name__}") from e
+    elif isinstance(obj, _counter_class()):
+        # Records which have not been written are not shipped, as with pickle
+        payload = [COUNTER_CODE, dict(obj.warnings), dict(obj.errors), obj.log_file,
+                   obj.max_logs, {k: list(v) for k, v in obj.sampled.items()}]
+    else:
+        raise UnknownType(f"Cannot encode objects of type {type(obj).__name__}")
+    return msgpack.packb([FORMAT_VERSION, LAYOUT, list(strings), payload], use_bin_type=True)
+
+
+def loads(data:bytes):
+    """ Decodes an object encoded with dumps.
+    """
+    try:
+        version, layout, strings, payload = msgpack.unpackb(data, raw=False, strict_map_key=False)
+    except (ValueError, TypeError, msgpack.UnpackException) as e:
+        raise ValueError("Data is not in the NeuronBridge wire format") from e
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported wire format version {version}, expected {FORMAT_VERSION}")
+    if layout != LAYOUT:
+        raise ValueError("Data was encoded with a different version of the NeuronBridge models")
+
+    if payload[0] == COUNTER_CODE:
+        _, warnings, errors, log_file, max_logs, sampled = payload
+        counter = _counter_class()(log_file=log_file, max_logs=max_logs)
+        counter.warnings.update(warnings)
+        counter.errors.update(errors)
+        for k, v in sampled.items():
+            counter.sampled[k] = set(v)
+        # As when a Counter is unpickled
+        counter.file_handle = sys.stderr
+        return counter
+    return _decode(payload, [sys.intern(s) for s in strings])
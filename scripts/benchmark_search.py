@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Benchmarks local color depth searches against a synthetic library, e.g.
+
+    python scripts/benchmark_search.py --size 5000 --searches 10 --cores 1 4 16
+
+The library images take their metadata from the matches in the test data
+(cycled, with distinct ids), and their CDMs are random neuron-like traces in
+the JRC2018_Unisex_20x_HR alignment space. The masks are library CDMs with
+some of their pixels dropped, so that each search has a known best match.
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from neuronbridge import search
+from neuronbridge.model import LMImage
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), "..", "test_data", "flyem-flylight.json")
+
+# Size (height, width) of the CDMs in the JRC2018_Unisex_20x_HR alignment space
+SHAPE = (566, 1210)
+
+
+def trace(rng, steps:int=3000) -> np.ndarray:
+    """ Returns a CDM of a random walk, colored by a depth that drifts along it.
+    """
+    arr = np.zeros(SHAPE + (3,), dtype=np.uint8)
+    ys = np.clip(SHAPE[0] // 2 + np.cumsum(rng.integers(-1, 2, steps)), 0, SHAPE[0] - 1)
+    xs = np.clip(rng.integers(0, SHAPE[1]) + np.cumsum(rng.integers(-1, 2, steps)), 0, SHAPE[1] - 1)
+    hue = np.mod(rng.random() + np.cumsum(rng.normal(0, 0.002, steps)), 5 / 6)
+    rgb = np.stack([np.clip(np.abs(hue * 6 - 3) - 1, 0, 1), np.clip(2 - np.abs(hue * 6 - 2), 0, 1),
+                    np.clip(2 - np.abs(hue * 6 - 4), 0, 1)], axis=1)
+    arr[ys, xs] = (rgb * 255).astype(np.uint8)
+    return arr
+
+
+def make_library(size:int, output_dir:str, seed:int=0) -> search.Library:
+    with open(TEST_DATA) as f:
+        matches = json.load(f)["results"]
+    rng = np.random.default_rng(seed)
+    cdm_dir = os.path.join(output_dir, "cdms")
+    os.makedirs(cdm_dir, exist_ok=True)
+    images = []
+    for i in range(size):
+        obj = copy.deepcopy(matches[i % len(matches)]["image"])
+        obj["id"] = str(3000000000000000000 + i)
+        obj["files"]["CDM"] = f"{i}.png"
+        images.append(LMImage(**obj))
+        Image.fromarray(trace(rng)).save(os.path.join(cdm_dir, f"{i}.png"), compress_level=1)
+    return search.pack_library(images, cdm_dir, os.path.join(output_dir, "library"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark local color depth searches')
+    parser.add_argument('--size', type=int, default=2000, \
+        help='Number of CDMs in the synthetic library')
+    parser.add_argument('--searches', type=int, default=5, \
+        help='Number of searches to run for each number of cores')
+    parser.add_argument('--cores', type=int, nargs='*', default=[1, os.cpu_count()], \
+        help='Numbers of worker processes to benchmark')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        library = make_library(args.size, tmp_dir)
+        print(f"Packed {len(library)} CDMs in {time.perf_counter()-start:.1f}s")
+
+        rng = np.random.default_rng(1)
+        targets = rng.choice(len(library), args.searches, replace=False)
+        masks = []
+        for i in targets:
+            mask = np.array(library.cdms[i])
+            mask[rng.random(SHAPE) < 0.2] = 0
+            masks.append(mask)
+
+        for cores in args.cores:
+            with ProcessPoolExecutor(max_workers=cores) as executor:
+                # Warm up the workers and the page cache
+                search.search(library, masks[0], cores=cores, executor=executor)
+                start = time.perf_counter()
+                for i, mask in zip(targets, masks):
+                    matches = search.search(library, mask, cores=cores, executor=executor)
+                    assert matches.results[0].image.id == library.images[i]["id"]
+                elapsed = (time.perf_counter() - start) / len(masks)
+            print(f"{cores:>3} cores: {elapsed*1000:8.1f} ms per search, {len(library)/elapsed:10.0f} CDMs/s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Compares the size and round-trip time of the wire format used to pickle the
+models (see neuronbridge/wire.py) with default pickling, on the test data, e.g.
+
+    python scripts/benchmark_wire.py --repeats 20
+
+Default pickling is measured by bypassing the __reduce__ hooks of the models.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import pickle
+import argparse
+import copyreg
+
+from pydantic import BaseModel
+
+import neuronbridge.model as model
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), "..", "test_data")
+
+
+class DefaultPickler(pickle.Pickler):
+    """ Pickles models the way pydantic does without the wire format hooks.
+    """
+
+    def reducer_override(self, obj):
+        if isinstance(obj, BaseModel):
+            return copyreg.__newobj__, (type(obj),), obj.__getstate__()
+        return NotImplemented
+
+
+def default_dumps(obj) -> bytes:
+    f = pickle.io.BytesIO()
+    DefaultPickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(obj)
+    return f.getvalue()
+
+
+def wire_dumps(obj) -> bytes:
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load(filepath:str):
+    """ Loads a test data file as the model it contains, or returns None.
+    """
+    with open(filepath) as f:
+        obj = json.load(f)
+    for model_class in (model.PrecomputedMatches, model.ImageLookup, model.DataConfig):
+        try:
+            return model_class(**obj)
+        except Exception:
+            pass
+    return None
+
+
+def timed(fn, arg, repeats:int):
+    """ Returns the result of fn(arg), and the best time of the repeated calls
+        in ms, which is the least affected by other load on the machine.
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn(arg)
+        best = min(best, time.perf_counter() - start)
+    return result, best * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the wire format against default pickling')
+    parser.add_argument('--repeats', type=int, default=10, \
+        help='Number of times each object is pickled and unpickled, keeping the best time')
+    args = parser.parse_args(argv)
+
+    print(f"{'':>26} {'pickle KB':>10} {'dump ms':>8} {'load ms':>8} {'wire KB':>10} {'dump ms':>8} {'load ms':>8}")
+    for filepath in sorted(glob.glob(os.path.join(TEST_DATA, "*.json"))):
+        obj = load(filepath)
+        if obj is None:
+            continue
+        row = f"{os.path.basename(filepath):>26}"
+        for dumps in (default_dumps, wire_dumps):
+            data, dump_ms = timed(dumps, obj, args.repeats)
+            loaded, load_ms = timed(pickle.loads, data, args.repeats)
+            assert loaded == obj
+            row += f" {len(data)/1024:10.1f} {dump_ms:8.2f} {load_ms:8.2f}"
+        print(row)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
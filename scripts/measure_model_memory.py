@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Measures the memory held by loaded PrecomputedMatches, for the test data and
+for synthetic match sets scaled up from it, e.g.
+
+    python scripts/measure_model_memory.py --copies 10 --scales 10000 50000
+
+For each input, the given number of copies is loaded and kept resident, and
+the memory they hold is measured with tracemalloc.
+"""
+
+import os
+import sys
+import copy
+import json
+import argparse
+import tracemalloc
+
+from neuronbridge.model import PrecomputedMatches
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), "..", "test_data", "flyem-flylight.json")
+
+
+def synthetic(obj, num_matches:int):
+    """ Returns a copy of the given matches scaled to num_matches results,
+        with distinct ids and published names like those of a real release.
+    """
+    results = []
+    for i in range(num_matches):
+        match = copy.deepcopy(obj["results"][i % len(obj["results"])])
+        match["image"]["id"] = str(3000000000000000000 + i)
+        match["image"]["publishedName"] = f"R{i // 4}"
+        match["image"]["slideCode"] = f"20190101_{i // 8}_A1"
+        results.append(match)
+    return {"inputImage": obj["inputImage"], "results": results}
+
+
+def measure(text:str, copies:int) -> int:
+    """ Returns the number of bytes held by the given number of loaded copies.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    loaded = [PrecomputedMatches(**json.loads(text)) for _ in range(copies)]
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del loaded
+    return held
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the memory held by loaded match sets')
+    parser.add_argument('--copies', type=int, default=10, \
+        help='Number of copies of each match set to keep loaded')
+    parser.add_argument('--scales', type=int, nargs='*', default=[10000, 50000], \
+        help='Number of matches in each synthetic match set')
+    args = parser.parse_args(argv)
+
+    with open(TEST_DATA) as f:
+        obj = json.load(f)
+
+    inputs = [("flyem-flylight.json", obj)] + [(f"synthetic x{n}", synthetic(obj, n)) for n in args.scales]
+    for name, data in inputs:
+        held = measure(json.dumps(data), args.copies)
+        per_match = held / (args.copies * len(data["results"]))
+        print(f"{name:>24}: {len(data['results']):>6} matches, {held/1e6/args.copies:8.1f} MB per copy, {per_match:6.0f} B per match")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,16 @@
+""" Synthetic color depth MIPs shared by the CDM and search tests.
+"""
+
+import numpy as np
+
+# Pure colors in front-to-back order along the color depth lookup table
+MAGENTA, BLUE, GREEN, RED = (255, 0, 255), (0, 0, 255), (0, 255, 0), (255, 0, 0)
+
+
+def make_cdm(pixels, shape=(8, 10)):
+    """ Returns a black CDM with the given {(y, x): color} pixels.
+    """
+    arr = np.zeros(shape + (3,), dtype=np.uint8)
+    for (y, x), color in pixels.items():
+        arr[y, x] = color
+    return arr
@@ -0,0 +1,105 @@
+import os
+import json
+import threading
+
+import pytest
+
+from neuronbridge import assets, integrity, serve
+from neuronbridge.assets import AssetChecker, AssetCollector, check_assets, load_prefixes, resolve
+
+
+def test_resolve(tmp_path):
+    config = {"stores": {"prod": {"prefixes": {
+        "CDM": "https://s3.amazonaws.com/bucket/",
+        "CDSResults": "v3.4.0/brain+vnc/cdmatches/",
+    }}}}
+    (tmp_path / "config.json").write_text(json.dumps(config))
+    prefixes = load_prefixes(str(tmp_path / "config.json"))
+    assert prefixes["prod"]["CDM"] == "https://s3.amazonaws.com/bucket/"
+    assert prefixes["prod"]["CDSResults"] == f"{tmp_path}/v3.4.0/brain+vnc/cdmatches/"
+
+    assert resolve(prefixes["prod"], "CDM", "a/1.png") == "https://s3.amazonaws.com/bucket/a/1.png"
+    assert resolve(prefixes["prod"], "CDM", "https://example.org/1.png") == "https://example.org/1.png"
+    # Paths without a prefix are absolute
+    assert resolve(prefixes["prod"], "CDMThumbnail", "/data/a/1.jpg") == "/data/a/1.jpg"
+
+
+def test_collector(tmp_path):
+    collector = AssetCollector({"prod": {"CDM": "/data/", "CDSResults": "/results/"}})
+    collector.add({"store": "prod", "CDM": "b.png", "CDSResults": "1.json"}, "1.json")
+    collector.add({"store": "prod", "CDM": "a.png", "CDMThumbnail": "/thumbnails/a.jpg"}, "2.json")
+    # The first file referencing a location is kept
+    collector.add({"store": "prod", "CDM": "b.png"}, "3.json")
+
+    run_file = str(tmp_path / "0.run")
+    collector.write(run_file)
+    with open(run_file) as f:
+        assert f.read().splitlines() == [
+            "/data/a.png\tCDM\t2.json",
+            "/data/b.png\tCDM\t1.json",
+            "/results/1.json\tCDSResults\t1.json",
+            "/thumbnails/a.jpg\tCDMThumbnail\t2.json",
+        ]
+
+
+@pytest.fixture
+def release(tmp_path):
+    """ Serve a release with a single file over HTTP.
+    """
+    release = tmp_path / "v3.4.0"
+    release.mkdir()
+    (release / "found.png").write_bytes(b"png")
+    server = serve.serve({"v3.4.0": str(release)}, "127.0.0.1", 0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield release, f"{server.url}/v3.4.0"
+    server.shutdown()
+    server.server_close()
+
+
+def test_checker(release):
+    path, url = release
+    checker = AssetChecker(threads=2, rewrites=[("s3://bucket/", f"{path}/"), ("s3://", "/nowhere/")])
+    refs = [
+        (f"{path}/found.png", "1"),
+        (f"{path}/lost.png", "2"),
+        ("s3://bucket/found.png", "3"),
+        (f"{url}/found.png", "4"),
+        (f"{url}/lost.png", "5"),
+        (f"{path}/found.png/lost.png", "6"),
+    ]
+    results = list(checker.check(refs))
+    assert [(location, value) for location, value, _ in results] == refs
+    errors = [error for _, _, error in results]
+    assert [error is None for error in errors] == [True, False, True, True, False, False]
+    assert isinstance(errors[1], FileNotFoundError)
+    assert isinstance(errors[4], FileNotFoundError)
+    assert isinstance(errors[5], NotADirectoryError)
+
+
+def test_check_assets(tmp_path, monkeypatch):
+    pytest.importorskip("ray")
+    from neuronbridge.validate_worker import Counter
+    # Force a merge of the runs
+    monkeypatch.setattr(assets, "MAX_MERGE_FAN_IN", 2)
+    monkeypatch.setattr(integrity, "MAX_MERGE_FAN_IN", 2)
+
+    data = tmp_path / "data"
+    data.mkdir()
+    (data / "a.png").write_bytes(b"png")
+    runs = []
+    for i, names in enumerate([["a.png", "b.png"], ["b.png", "c.png"], ["c.png", "d.png"]]):
+        collector = AssetCollector({"prod": {"CDM": f"{data}/"}})
+        for name in names:
+            collector.add({"store": "prod", "CDM": name}, f"{i}.json")
+        runs.append(str(tmp_path / f"{i}.run"))
+        collector.write(runs[-1])
+
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    counter = Counter()
+    assert check_assets(runs, counter, str(work_dir), AssetChecker(threads=2)) == 4
+    assert counter.errors == {"Missing CDM asset": 3}
+    assert sorted(os.listdir(work_dir)) == ["assets.merged0.0.run", "assets.merged0.2.run"]
+    # The runs are kept for resumed validations
+    assert all((tmp_path / f"{i}.run").exists() for i in range(3))
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from neuronbridge import cdm
+
+from cdm_helpers import MAGENTA, BLUE, GREEN, RED, make_cdm
+
+
+def test_depth_order():
+    d = cdm.depth(np.array([MAGENTA, BLUE, GREEN, RED], dtype=np.uint8))
+    assert list(np.argsort(d)) == [0, 1, 2, 3]
+    assert d[0] == 0
+
+
+def test_depth_near_magenta():
+    # Pixels on either side of magenta are at the front, and those on either side of red at the back
+    d = cdm.depth(np.array([MAGENTA, (250, 0, 255), (255, 0, 250), RED, (255, 0, 5), (255, 5, 0)], dtype=np.uint8))
+    assert d[:3] == pytest.approx([0, 0.0033, 0], abs=1e-4)
+    assert d[3:] == pytest.approx([5 / 6, 5 / 6, 0.83], abs=1e-2)
+
+    mask = make_cdm({(1, 1): (255, 0, 250)})
+    target = make_cdm({(1, 1): (250, 0, 255)})
+    assert cdm.CDMScorer(mask).score(target[np.newaxis]).matching_pixels.tolist() == [1]
+
+
+def test_load_cdms():
+    images = [Image.fromarray(make_cdm({(1, 1): RED})) for _ in range(3)]
+    stack = cdm.load_cdms(images)
+    assert stack.shape == (3, 8, 10, 3)
+    assert cdm.load_cdms(images, out=stack) is stack
+
+
+def test_score_batch():
+    mask = make_cdm({(1, 1): RED, (2, 2): GREEN, (3, 3): BLUE, (4, 4): MAGENTA})
+    targets = np.stack([
+        mask,                                       # identical
+        make_cdm({(1, 1): RED, (2, 2): GREEN}),     # half of the pixels
+        make_cdm({(1, 1): BLUE, (2, 2): RED}),      # wrong depths
+        np.zeros_like(mask),                        # empty
+    ])
+    scorer = cdm.CDMScorer(mask)
+    assert scorer.mask_pixels == 4
+    scores = scorer.score(targets)
+    assert scores.matching_pixels.tolist() == [4, 2, 0, 0]
+    assert scores.normalized_score.tolist() == [1.0, 0.5, 0.0, 0.0]
+    assert not scores.mirrored.any()
+
+    overlap = cdm.overlap_mask(mask, targets)
+    assert overlap.sum(axis=(1, 2)).tolist() == [4, 2, 0, 0]
+
+
+def test_score_mirrored_and_shifted():
+    mask = make_cdm({(2, 1): GREEN, (3, 1): GREEN})
+    mirrored = cdm.mirror(mask)
+    shifted = np.roll(mask, 1, axis=1)
+    targets = np.stack([mask, mirrored, shifted])
+
+    scores = cdm.CDMScorer(mask, mirror_mask=True).score(targets)
+    assert scores.matching_pixels.tolist() == [2, 2, 0]
+    assert scores.mirrored.tolist() == [False, True, False]
+
+    scores = cdm.CDMScorer(mask, xy_shift=1).score(targets)
+    assert scores.matching_pixels.tolist() == [2, 0, 2]
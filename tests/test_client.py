@@ -0,0 +1,255 @@
+import sys
+import os
+import json
+import time
+import threading
+import subprocess
+
+from neuronbridge.client import Client, MultiVersionClient, ResponseCache
+
+# Modules which are slow to import, and only needed once data is fetched
+HEAVY_MODULES = {"requests", "PIL", "pydantic", "neuronbridge.model"}
+
+# Budget for the cumulative import time of neuronbridge.client, in microseconds
+IMPORT_TIME_BUDGET_US = 150000
+
+config = {
+    "anatomicalAreas": {
+        "Brain": {"label": "Brain", "alignmentSpace": "JRC2018_Unisex_20x_HR"}
+    },
+    "stores": {
+        "fl:open_data:brain": {
+            "label": "FlyLight Brain Open Data Store",
+            "anatomicalArea": "Brain",
+            "prefixes": {
+                "CDM": "https://s3.amazonaws.com/janelia-flylight-color-depth/",
+                "CDSResults": "https://s3.amazonaws.com/janelia-neuronbridge-data-prod/v3.4.0/metadata/cdsresults/",
+            },
+            "customSearch": {
+                "searchFolder": "searchable_neurons",
+                "lmLibraries": [{"name": "FlyLight_Gen1_MCFO", "count": 349364}],
+                "emLibraries": [],
+            },
+        }
+    },
+}
+
+
+def _run_python(code):
+    res = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                         capture_output=True, text=True, check=True)
+    return res.stdout, res.stderr
+
+
+def test_import_is_lightweight():
+    stdout, _ = _run_python(
+        "import sys, neuronbridge.client\n"
+        f"print(sorted(m for m in {sorted(HEAVY_MODULES)} if m in sys.modules))")
+    assert stdout.strip() == "[]"
+
+
+def test_import_time_budget():
+    # The best of a few runs, against a budget well above the usual import time
+    # (~15 ms) but below that of the heavy modules (~200 ms for the model alone)
+    best = None
+    for _ in range(3):
+        _, stderr = _run_python("import neuronbridge.client")
+        for line in stderr.splitlines():
+            # Format is "import time: self [us] | cumulative | imported package"
+            parts = [p.strip() for p in line.split("|")]
+            if len(parts) == 3 and parts[2] == "neuronbridge.client":
+                cumulative = int(parts[1])
+                best = cumulative if best is None else min(best, cumulative)
+    assert best is not None, "neuronbridge.client not found in import time report"
+    assert best < IMPORT_TIME_BUDGET_US
+
+
+def test_lazy_config_from_snapshot(tmp_path, monkeypatch):
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps(config))
+
+    def no_network(self, url, **kwargs):
+        raise AssertionError(f"Unexpected fetch of {url}")
+    monkeypatch.setattr(Client, "_get", no_network)
+
+    client = Client(version="v3.4.0", config_file=str(config_file))
+    assert client._config is None
+    assert client.data_url.endswith("/v3.4.0")
+    assert client.config.stores["fl:open_data:brain"].anatomicalArea == "Brain"
+
+
+def test_config_snapshot_is_written(tmp_path, monkeypatch):
+    config_file = tmp_path / "config.json"
+    fetched = []
+
+    def fake_get_json(self, url):
+        fetched.append(url)
+        return config
+    monkeypatch.setattr(Client, "_get_json", fake_get_json)
+
+    Client(version="v3.4.0", config_file=str(config_file)).config
+    assert fetched == ["https://janelia-neuronbridge-data-prod.s3.us-east-1.amazonaws.com/v3.4.0/config.json"]
+    assert json.loads(config_file.read_text()) == config
+
+    Client(version="v3.4.0", config_file=str(config_file)).config
+    assert len(fetched) == 1
+
+    # A snapshot of another version is not reused
+    Client(version="v3.3.0", config_file=str(config_file)).config
+    assert fetched[1].endswith("/v3.3.0/config.json")
+    Client(version="v3.3.0", config_file=str(config_file)).config
+    assert len(fetched) == 2
+
+
+def test_get_images_batch(tmp_path):
+    by_body = tmp_path / "v3.4.0" / "metadata" / "by_body"
+    by_body.mkdir(parents=True)
+    with open(os.path.join(os.path.dirname(__file__), "..", "test_data", "em-body.json")) as f:
+        lookup = f.read()
+    for body_id in ["1734696429", "2"]:
+        (by_body / f"{body_id}.json").write_text(lookup)
+
+    client = Client(data_url=str(tmp_path / "v3.4.0"))
+    results = client.get_em_images_batch([1734696429, "1734696429", "2", "missing"], threads=4)
+    assert list(results) == [1734696429, "1734696429", "2", "missing"]
+    assert results[1734696429][0].publishedName == "1734696429"
+    assert results[1734696429] is results["1734696429"]
+    assert isinstance(results["missing"], Exception)
+
+
+def test_get_swc_skeletons_batch(tmp_path):
+    from neuronbridge.model import EMImage
+    release = tmp_path / "v3.4.0"
+    (release / "swc").mkdir(parents=True)
+    (release / "config.json").write_text(json.dumps({
+        "anatomicalAreas": {},
+        "stores": {"prod": {"label": "Prod", "anatomicalArea": "Brain",
+                            "prefixes": {"AlignedBodySWC": "swc/"},
+                            "customSearch": {"searchFolder": "x", "lmLibraries": [], "emLibraries": []}}}}))
+    with open(os.path.join(os.path.dirname(__file__), "..", "test_data", "em-body.json")) as f:
+        image = EMImage(**json.load(f)["results"][0])
+    image.files.store = "prod"
+    (release / "swc" / image.files.AlignedBodySWC).parent.mkdir(parents=True)
+    (release / "swc" / image.files.AlignedBodySWC).write_text("1 1 0 0 0 1 -1\n2 3 1 2 3 1 1\n")
+    missing = image.model_copy(update={"id": "missing", "files": image.files.model_copy(update={"AlignedBodySWC": "none.swc"})})
+
+    client = Client(data_url=str(release))
+    assert client.get_swc_skeleton(image).coords.tolist() == [[0, 0, 0], [1, 2, 3]]
+    results = client.get_swc_skeletons_batch([image, image, missing], threads=2)
+    assert list(results) == [image.id, "missing"]
+    assert len(results[image.id]) == 2
+    assert isinstance(results["missing"], Exception)
+
+
+def test_concurrent_fetches_are_coalesced():
+    with open(os.path.join(os.path.dirname(__file__), "..", "test_data", "em-body.json")) as f:
+        content = f.read()
+    body_ids = ["1734696429"] * 8 + ["missing"] * 2
+    started = []
+    fetched = []
+    fetching = set()
+
+    def waiting(thread):
+        """ Whether the given thread is done, or blocked on a condition, e.g. a result in flight.
+        """
+        frame = sys._current_frames().get(thread.ident)
+        if frame is None:
+            return not thread.is_alive()
+        while frame is not None:
+            if frame.f_code.co_filename == threading.__file__ and frame.f_code.co_name == "wait":
+                return True
+            frame = frame.f_back
+        return False
+
+    class FakeResponse:
+        def __init__(self, url):
+            self.status_code = 404 if "missing" in url else 200
+
+        def json(self):
+            return json.loads(content)
+
+    class BlockingSession:
+        """ Counts the requests, and only answers once every other caller is waiting.
+        """
+        def get(self, url, **kwargs):
+            fetched.append(url)
+            fetching.add(threading.get_ident())
+            deadline = time.monotonic() + 10
+            while len(started) < len(threads) or not all(
+                    t.ident in fetching or waiting(t) for t in threads):
+                assert time.monotonic() < deadline, "Callers did not join the fetch in flight"
+                time.sleep(0.01)
+            return FakeResponse(url)
+
+    client = Client(data_url="https://example.org/v3.4.0", session=BlockingSession())
+    barrier = threading.Barrier(len(body_ids))
+    results, errors = [], []
+
+    def worker(body_id):
+        barrier.wait()
+        started.append(body_id)
+        try:
+            results.append(client.get_em_images(body_id))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(body_id,)) for body_id in body_ids]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(fetched) == ["https://example.org/v3.4.0/metadata/by_body/1734696429.json",
+                               "https://example.org/v3.4.0/metadata/by_body/missing.json"]
+    assert len(results) == 8 and len(errors) == 2
+    assert all(isinstance(e, FileNotFoundError) for e in errors)
+    assert all(r == results[0] for r in results)
+    assert results[0][0].publishedName == "1734696429"
+    # Each caller gets its own objects
+    assert results[0][0] is not results[1][0]
+
+    stats = client.latency_stats()["metadata/by_body"]
+    assert stats["count"] == 10
+    assert stats["errors"] == 2
+    assert stats["coalesced"] == 8
+
+
+def test_multi_version_client(tmp_path):
+    with open(os.path.join(os.path.dirname(__file__), "..", "test_data", "em-body.json")) as f:
+        lookup = json.load(f)
+    for version, n in [("v3.3.0", 1), ("v3.4.0", 2)]:
+        version_dir = tmp_path / version
+        (version_dir / "metadata" / "by_body").mkdir(parents=True)
+        (version_dir / "metadata" / "cdsresults").mkdir(parents=True)
+        (version_dir / "metadata" / "by_body" / "1734696429.json").write_text(json.dumps(lookup))
+        (version_dir / "config.json").write_text(json.dumps({
+            "anatomicalAreas": {},
+            "stores": {"prod": {"label": "Prod", "anatomicalArea": "Brain",
+                                "prefixes": {"CDSResults": "metadata/cdsresults/"},
+                                "customSearch": {"searchFolder": "x", "lmLibraries": [], "emLibraries": []}}}}))
+        image = lookup["results"][0]
+        matches = {"inputImage": image, "results": []}
+        (version_dir / "metadata" / "cdsresults" / image["files"]["CDSResults"]).write_text(json.dumps(matches))
+
+    client = MultiVersionClient(["v3.3.0", "v3.4.0"], data_url_prefix=str(tmp_path))
+    images = client.get_em_images(1734696429, versions=["v3.3.0", "v3.4.0", "v9.9.9"])
+    assert images["v3.4.0"][0].publishedName == "1734696429"
+    assert isinstance(images["v9.9.9"], Exception)
+
+    matches = client.get_cds_matches(images["v3.3.0"][0])
+    assert matches == {"v3.3.0": [], "v3.4.0": []}
+    assert client.client("v3.3.0").config is not client.client("v3.4.0").config
+    assert client.client("v3.3.0")._get_session() is client.client("v3.4.0")._get_session()
+    assert client.client("v3.3.0")._cache is client.cache
+    assert client.get_em_images(1734696429, versions=[]) == {}
+    assert MultiVersionClient([]).get_em_images(1734696429) == {}
+
+
+def test_response_cache():
+    cache = ResponseCache(max_bytes=10)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    assert cache.get("a") == b"12345"
+    cache.put("c", b"123")
+    assert cache.get("b") is None
+    assert cache.nbytes == 8
@@ -0,0 +1,82 @@
+import json
+
+from neuronbridge import diff
+from neuronbridge.client import Client
+
+
+def image(image_id, name="A", cds=None):
+    files = {"store": "prod"}
+    if cds:
+        files["CDSResults"] = cds
+    return {"id": image_id, "publishedName": name, "files": files}
+
+
+def matches(input_id, scores):
+    return {"inputImage": {"id": input_id},
+            "results": [{"image": {"id": i}, "normalizedScore": s} for i, s in scores]}
+
+
+def write(path, obj):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(obj))
+
+
+def test_diff_matches():
+    old = matches("1", [("a", 10), ("b", 8), ("c", 5)])
+    new = matches("1", [("b", 9), ("a", 8), ("d", 1)])
+    assert diff.diff_matches(old, new) == {
+        "added": ["d"],
+        "removed": ["c"],
+        "rank_changes": [["b", 1, 0], ["a", 0, 1]],
+        "score_changes": [["b", "normalizedScore", 8, 9], ["a", "normalizedScore", 10, 8]],
+    }
+    assert diff.diff_objects(old, json.loads(json.dumps(old))) is None
+
+
+def test_diff_trees(tmp_path):
+    old, new = tmp_path / "old", tmp_path / "new"
+    for root in (old, new):
+        write(root / "brain/cdmatches/em-vs-lm/same.json", matches("1", [("a", 1)]))
+    write(old / "brain/cdmatches/em-vs-lm/1.json", matches("1", [("a", 10), ("b", 8)]))
+    write(new / "brain/cdmatches/em-vs-lm/1.json", matches("1", [("a", 10), ("b", 9)]))
+    write(old / "brain/mips/embodies/100.json", {"results": [image("1", "A"), image("2")]})
+    write(new / "brain/mips/embodies/100.json", {"results": [image("1", "B")]})
+    write(old / "brain/cdmatches/em-vs-lm/gone.json", matches("2", []))
+    write(new / "brain/cdmatches/em-vs-lm/new.json", matches("3", []))
+
+    summary = diff.write_report(diff.diff_trees(str(old), str(new), cores=2), str(tmp_path / "report"))
+    assert summary == {"added": 1, "removed": 1, "changed": 2, "error": 0, "images_added": 0, "images_removed": 1,
+                       "rank_changes": 0, "score_changes": 1}
+
+    records = {r["path"]: r for r in map(json.loads, (tmp_path / "report/changes.jsonl").read_text().splitlines())}
+    assert set(records) == {"brain/cdmatches/em-vs-lm/1.json", "brain/cdmatches/em-vs-lm/gone.json",
+                            "brain/cdmatches/em-vs-lm/new.json", "brain/mips/embodies/100.json"}
+    assert records["brain/mips/embodies/100.json"]["changed"] == [["1", ["publishedName"]]]
+    assert records["brain/cdmatches/em-vs-lm/1.json"]["score_changes"] == [["b", "normalizedScore", 8, 9]]
+
+
+def test_diff_clients(tmp_path):
+    config = {"anatomicalAreas": {}, "stores": {"prod": {
+        "label": "Prod", "anatomicalArea": "Brain",
+        "prefixes": {"CDSResults": "metadata/cdsresults/"},
+        "customSearch": {"searchFolder": "x", "lmLibraries": [], "emLibraries": []}}}}
+    for version, score in (("v1", 1), ("v2", 2)):
+        root = tmp_path / version
+        write(root / "config.json", config)
+        write(root / "metadata/by_body/100.json", {"results": [image("1", cds="1.json")]})
+        write(root / "metadata/cdsresults/1.json", matches("1", [("a", score)]))
+
+    # A file which cannot be parsed is an error, not an added or removed file
+    write(tmp_path / "v1/metadata/by_body/200.json", {"results": []})
+    (tmp_path / "v2/metadata/by_body/200.json").write_text("{truncated")
+
+    old = Client(data_url=str(tmp_path / "v1"))
+    new = Client(data_url=str(tmp_path / "v2"))
+    records = list(diff.diff_clients(old, new, body_ids=["100", "200", "999"]))
+    assert records[0]["path"] == "metadata/by_body/200.json"
+    assert records[0]["status"] == "error"
+    assert records[1:] == [{"path": "CDSResults/1", "status": "changed", "added": [], "removed": [],
+                            "rank_changes": [], "score_changes": [["a", "normalizedScore", 1, 2]]}]
+
+    summary = diff.write_report(records, str(tmp_path / "report"))
+    assert summary["error"] == 1 and summary["changed"] == 1
@@ -0,0 +1,82 @@
+import os
+import json
+
+import rapidjson
+import pytest
+from PIL import Image
+
+from neuronbridge import gallery
+from neuronbridge.client import Client
+from neuronbridge.model import PrecomputedMatches
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), "..", "test_data")
+
+
+@pytest.fixture
+def release(tmp_path):
+    """ A local release with thumbnails for the first few matches of a test file.
+    """
+    thumbnails = tmp_path / "thumbnails"
+    version_dir = tmp_path / "v3.4.0"
+    version_dir.mkdir()
+    config = {
+        "anatomicalAreas": {"Brain": {"label": "Brain", "alignmentSpace": "JRC2018_Unisex_20x_HR"}},
+        "stores": {
+            "prod": {
+                "label": "Brain",
+                "anatomicalArea": "Brain",
+                "prefixes": {"CDMThumbnail": f"{thumbnails}/"},
+                "customSearch": {"searchFolder": "searchable_neurons", "lmLibraries": [], "emLibraries": []},
+            }
+        },
+    }
+    (version_dir / "config.json").write_text(json.dumps(config))
+
+    with open(os.path.join(TEST_DATA, "flyem-flylight.json")) as f:
+        matches = PrecomputedMatches(**rapidjson.load(f)).results[:5]
+    for i, match in enumerate(matches[:4]):
+        path = thumbnails / match.image.files.CDMThumbnail
+        path.parent.mkdir(parents=True, exist_ok=True)
+        Image.new('RGB', (400, 200), (50 * i, 0, 0)).save(path)
+    # The last thumbnail is missing
+    return Client(data_url=str(version_dir)), matches
+
+
+def test_render_mosaic(release):
+    client, matches = release
+    mosaic = gallery.render_mosaic(client, matches, columns=2, tile_size=(40, 20), labels=False,
+                                   cache=gallery.ThumbnailCache())
+    assert mosaic.size == (80, 60)
+    assert abs(mosaic.getpixel((60, 10))[0] - 50) <= 2
+    assert mosaic.getpixel((10, 50)) == (0, 0, 0)
+
+
+def test_missing_thumbnails_are_logged(release, caplog):
+    client, matches = release
+    tiles = gallery.fetch_thumbnails(client, matches, cache=gallery.ThumbnailCache())
+    assert [tile is None for tile in tiles] == [False] * 4 + [True]
+    assert matches[4].image.files.CDMThumbnail in caplog.text
+
+
+def test_concurrent_fetches_to_disk(release, tmp_path):
+    client, matches = release
+    cache = gallery.ThumbnailCache(cache_dir=str(tmp_path / "cache"))
+    url = gallery.thumbnail_url(client, matches[0])
+    tiles = gallery.fetch_thumbnails(client, [matches[0]] * 32, threads=16, cache=cache)
+    assert all(tile is not None for tile in tiles)
+    assert [p.name for p in (tmp_path / "cache").rglob("*") if p.is_file()] == [os.path.basename(url)]
+
+
+def test_write_sprite_sheet(release, tmp_path):
+    client, matches = release
+    cache = gallery.ThumbnailCache(cache_dir=str(tmp_path / "cache"))
+    index_path = gallery.write_sprite_sheet(client, matches, str(tmp_path / "sheet.png"),
+                                            columns=5, tile_size=(40, 20), cache=cache)
+    with open(index_path) as f:
+        index = json.load(f)
+    assert index["image"] == "sheet.png"
+    assert [t["x"] for t in index["tiles"]] == [0, 40, 80, 120, 160]
+    assert [t["missing"] for t in index["tiles"]] == [False] * 4 + [True]
+    assert index["tiles"][0]["id"] == matches[0].image.id
+    assert len(cache.tiles) == 4
+    assert len(list((tmp_path / "cache").rglob("*.jpg"))) == 4
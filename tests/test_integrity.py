@@ -0,0 +1,66 @@
+import json
+
+from neuronbridge import integrity
+
+
+def image(image_id, cds=None, ppp=None):
+    files = {"store": "prod"}
+    if cds:
+        files["CDSResults"] = cds
+    if ppp:
+        files["PPPMResults"] = ppp
+    return {"id": image_id, "files": files}
+
+
+def matches(input_id, match_ids):
+    return {"inputImage": {"id": input_id}, "results": [{"image": {"id": i}} for i in match_ids]}
+
+
+def write(path, obj):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(obj))
+
+
+def test_integrity(tmp_path, monkeypatch):
+    # Force many small runs and several merge passes
+    monkeypatch.setattr(integrity, "BATCH_SIZE", 1)
+    monkeypatch.setattr(integrity, "MAX_RUN_LINES", 2)
+    monkeypatch.setattr(integrity, "MAX_MERGE_FAN_IN", 2)
+
+    data = tmp_path / "v3.4.0"
+    write(data / "brain+vnc/mips/embodies/100.json", {"results": [image("1", cds="1.json", ppp="100.json")]})
+    write(data / "brain+vnc/mips/embodies/200.json", {"results": [image("2", cds="2.json")]})
+    write(data / "brain+vnc/mips/lmlines/LINE.json", {"results": [image("3", cds="3.json"), image("4", cds="4.json")]})
+
+    write(data / "brain/cdmatches/em-vs-lm/1.json", matches("1", ["3", "4"]))
+    write(data / "brain/cdmatches/em-vs-lm/2.json", matches("2", ["3", "99"]))
+    write(data / "brain/cdmatches/lm-vs-em/3.json", matches("3", ["1", "2"]))
+    write(data / "brain/pppmatches/em-vs-lm/100.json", matches("1", ["3"]))
+    write(data / "vnc/cdmatches/em-vs-lm/5.json", matches("5", ["1"]))
+
+    # An image without an id is reported, not indexed
+    write(data / "brain+vnc/mips/lmlines/NOID.json", {"results": [image("6", cds="4.json"), {"files": {}}]})
+
+    output = tmp_path / "integrity"
+    counts = integrity.run(str(data), str(output), cores=2, work_dir=str(tmp_path))
+    assert counts == {"dangling": 1, "orphaned": 1, "unresolved": 2, "missing_ids": 1}
+
+    def keys(name):
+        return [line.split("\t")[0] for line in (output / name).read_text().splitlines()]
+
+    assert keys("dangling.tsv") == ["CDSResults/4.json"]
+    assert keys("orphaned.tsv") == ["CDSResults/5.json"]
+    assert keys("unresolved.tsv") == ["5", "99"]
+    assert (output / "missing_ids.tsv").read_text() == f"{data}/brain+vnc/mips/lmlines/NOID.json\t1\n"
+    # Temporary runs are cleaned up
+    assert not list(tmp_path.glob("integrity-*"))
+
+
+def test_join():
+    left = [("a", "1"), ("b", "2"), ("b", "3")]
+    right = [("b", "x"), ("c", "y")]
+    assert list(integrity.join(left, right)) == [
+        ("a", "1", None),
+        ("b", "2", "x"),
+        ("c", None, "y"),
+    ]
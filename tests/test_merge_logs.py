@@ -0,0 +1,29 @@
+import json
+
+from neuronbridge import merge_logs
+
+
+def test_merge_logs(tmp_path):
+    log_dir = tmp_path / "logs2"
+    log_dir.mkdir()
+    records = [
+        {"level": "warn", "type": "Missing mountingProtocol", "arg": "1", "file": "b.json"},
+        {"level": "error", "type": "Missing CDM", "arg": "2", "file": "a.json"},
+        {"level": "warn", "type": "Missing mountingProtocol", "arg": "3", "file": "a.json"},
+    ]
+    (log_dir / "worker_1.jsonl").write_text("".join(json.dumps(r) + "\n" for r in records[:2]))
+    # The last line of a killed worker's log may be truncated
+    (log_dir / "worker_2.jsonl").write_text(json.dumps(records[2]) + "\n" + '{"level": "err')
+
+    output = tmp_path / "report"
+    assert merge_logs.main(["-l", str(log_dir), "-o", str(output)]) == 0
+
+    index = json.loads((output / "report_index.json").read_text())
+    assert [(t["level"], t["type"], t["logged"]) for t in index["types"]] == [
+        ("error", "Missing CDM", 1),
+        ("warn", "Missing mountingProtocol", 2),
+    ]
+
+    warnings = merge_logs.read_type(str(output), "warn", "Missing mountingProtocol")
+    assert [(r["file"], r["worker"]) for r in warnings] == [("a.json", "worker_2"), ("b.json", "worker_1")]
+    assert merge_logs.read_type(str(output), "error", "Unknown") == []
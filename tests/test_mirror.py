@@ -0,0 +1,163 @@
+import os
+import json
+import shutil
+import threading
+import functools
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import pytest
+
+from neuronbridge import mirror
+from neuronbridge.client import Client
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), "..", "test_data")
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    """ Serve a minimal release over HTTP, laid out like the data bucket.
+    """
+    root = tmp_path / "bucket"
+    version_dir = root / "v3.4.0"
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=str(root)))
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    (version_dir / "metadata" / "by_body").mkdir(parents=True)
+    (version_dir / "metadata" / "cdsresults").mkdir(parents=True)
+    (version_dir / "metadata" / "pppresults").mkdir(parents=True)
+    shutil.copy(os.path.join(TEST_DATA, "em-body.json"), version_dir / "metadata" / "by_body" / "1734696429.json")
+    shutil.copy(os.path.join(TEST_DATA, "flyem-flylight.json"), version_dir / "metadata" / "cdsresults" / "2945073143148142603.json")
+    (version_dir / "metadata" / "pppresults" / "1734696429.json").write_text("{}")
+
+    config = {
+        "anatomicalAreas": {"Brain": {"label": "Brain", "alignmentSpace": "JRC2018_Unisex_20x_HR"}},
+        "stores": {
+            "prod": {
+                "label": "Brain",
+                "anatomicalArea": "Brain",
+                "prefixes": {
+                    "CDM": "https://s3.amazonaws.com/janelia-flylight-color-depth/",
+                    "CDSResults": f"{base_url}/v3.4.0/metadata/cdsresults/",
+                    "PPPMResults": f"{base_url}/v3.4.0/metadata/pppresults/",
+                },
+                "customSearch": {"searchFolder": "searchable_neurons", "lmLibraries": [], "emLibraries": []},
+            }
+        },
+    }
+    (version_dir / "config.json").write_text(json.dumps(config))
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"{base_url}/v3.4.0"
+    server.shutdown()
+
+
+def test_mirror(bucket, tmp_path):
+    output = tmp_path / "mirror"
+    ret = mirror.main(["-o", str(output), "--data-url", bucket, "--bodies", "1734696429", "--threads", "2"])
+    assert ret == 0
+
+    version_dir = output / "v3.4.0"
+    assert (version_dir / "metadata" / "cdsresults" / "2945073143148142603.json").exists()
+    assert (version_dir / "metadata" / "pppresults" / "1734696429.json").exists()
+    assert not list(version_dir.rglob("*.part"))
+
+    client = Client(data_url=str(version_dir))
+    assert client.version == "v3.4.0"
+    em_image = client.get_em_image(1734696429)
+    assert em_image.publishedName == "1734696429"
+    assert len(client.get_cds_matches(em_image)) == 615
+
+
+def test_mirror_config_is_not_modified(bucket, tmp_path):
+    client = Client(data_url=bucket)
+    config_url = client.data_url + "/config.json"
+    # The client may hand the same object to concurrent callers
+    shared = client._get_json(config_url)
+    original = json.loads(json.dumps(shared))
+    client._get_json = lambda url: shared
+    prefixes = mirror.mirror_config(client, str(tmp_path / "mirror"))
+    assert prefixes["prod"]["CDSResults"] == f"{bucket}/metadata/cdsresults/"
+    assert client._get_json(config_url) == original
+    mirrored = json.loads((tmp_path / "mirror" / "config.json").read_text())
+    assert mirrored["stores"]["prod"]["prefixes"]["CDSResults"] == "metadata/cdsresults/"
+
+
+def test_mirror_skips_complete_files(bucket, tmp_path):
+    output = tmp_path / "mirror"
+    lookup = output / "v3.4.0" / "metadata" / "by_body" / "1734696429.json"
+    lookup.parent.mkdir(parents=True)
+    shutil.copy(os.path.join(TEST_DATA, "em-body.json"), lookup)
+
+    downloader = mirror.Downloader(threads=1)
+    assert not downloader.download(f"{bucket}/metadata/by_body/1734696429.json", str(lookup))
+    assert downloader.download(f"{bucket}/config.json", str(output / "config.json"))
+
+
+@pytest.fixture
+def release(tmp_path):
+    """ Serve a file over HTTP with support for ranges and If-Range.
+    """
+    from neuronbridge import serve
+    release = tmp_path / "release"
+    release.mkdir()
+    data = os.urandom(200_000)
+    (release / "stack.h5j").write_bytes(data)
+    server = serve.serve({"v3.4.0": str(release)}, "127.0.0.1", 0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"{server.url}/v3.4.0/stack.h5j", data
+    server.shutdown()
+    server.server_close()
+
+
+def test_resume(release, tmp_path):
+    url, data = release
+    downloader = mirror.Downloader(threads=1)
+    etag = downloader._session().head(url).headers["ETag"]
+    filepath = tmp_path / "stack.h5j"
+    part_path = tmp_path / "stack.h5j.part"
+    etag_path = tmp_path / "stack.h5j.part.etag"
+
+    def check():
+        assert downloader.download(url, str(filepath))
+        assert filepath.read_bytes() == data
+        assert not part_path.exists() and not etag_path.exists()
+        filepath.unlink()
+
+    # 206: the rest of an unchanged file is appended
+    part_path.write_bytes(data[:1000])
+    etag_path.write_text(etag)
+    check()
+
+    # 200: the file changed since the partial download, so it is written again
+    part_path.write_bytes(b"x" * 1000)
+    etag_path.write_text('"stale"')
+    check()
+
+    # Partial downloads without an ETag are not resumed
+    part_path.write_bytes(b"x" * 1000)
+    check()
+
+    # 416: the partial download is already complete
+    part_path.write_bytes(data)
+    etag_path.write_text(etag)
+    check()
+
+    # 416: the partial download is larger than the file, so it starts over
+    part_path.write_bytes(data + b"x")
+    etag_path.write_text(etag)
+    check()
+
+
+def test_match_files_without_prefix(tmp_path, capsys):
+    lookup = tmp_path / "1734696429.json"
+    shutil.copy(os.path.join(TEST_DATA, "em-body.json"), lookup)
+    files = mirror.get_match_files([str(lookup)], {"other": {"CDSResults": "http://x/"}}, str(tmp_path))
+    assert files == []
+    assert "No CDSResults prefix" in capsys.readouterr().err
@@ -1,3 +1,4 @@
+import os
 import json
 
 from neuronbridge.model import *
@@ -200,3 +201,15 @@ def test_DataConfig():
     for dataSetName in data_config.stores:
         store = data_config.stores[dataSetName]
         assert store.anatomicalArea in data_config.anatomicalAreas
+
+
+def test_low_cardinality_strings_are_interned():
+    with open(os.path.join(os.path.dirname(__file__), "..", "test_data", "flyem-flylight.json")) as f:
+        text = f.read()
+    first = PrecomputedMatches(**json.loads(text))
+    second = PrecomputedMatches(**json.loads(text))
+    a, b = first.results[0], second.results[1]
+    assert a.image.libraryName is b.image.libraryName
+    assert a.image.alignmentSpace is b.image.alignmentSpace
+    assert a.image.files.store is b.image.files.store
+    assert a.files.CDMInput is b.files.CDMInput
@@ -0,0 +1,85 @@
+import os
+import copy
+import json
+
+import pytest
+import pydantic
+
+from neuronbridge import model
+from neuronbridge.schema_validators import get_validator
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), "..", "test_data")
+
+
+def load(filename):
+    with open(os.path.join(TEST_DATA, filename)) as f:
+        return json.load(f)
+
+
+def test_generated_module_is_cached(tmp_path):
+    validate = get_validator(model.ImageLookup, str(tmp_path))
+    files = os.listdir(tmp_path)
+    assert len(files) == 1 and files[0].startswith("ImageLookup_")
+    assert validate(load("em-body.json"))
+    assert get_validator(model.ImageLookup, str(tmp_path)) is validate
+
+
+@pytest.mark.parametrize("filename,model_class", [
+    ("em-body.json", model.ImageLookup),
+    ("mcfo-line.json", model.ImageLookup),
+    ("flyem-flylight.json", model.PrecomputedMatches),
+    ("flyem-flylight-vnc.json", model.PrecomputedMatches),
+    # Older test data which the current models reject
+    ("config.json", model.DataConfig),
+    ("pppresult.json", model.PrecomputedMatches),
+])
+def test_agrees_with_model(tmp_path, filename, model_class):
+    obj = load(filename)
+    try:
+        model_class(**obj)
+        valid = True
+    except pydantic.ValidationError:
+        valid = False
+    assert get_validator(model_class, str(tmp_path))(obj) == valid
+
+
+def invalidate_extra_key(match):
+    match["files"]["bogus"] = "x"
+
+def invalidate_missing_key(match):
+    del match["normalizedScore"]
+
+def invalidate_wrong_type(match):
+    match["mirrored"] = "maybe"
+
+def invalidate_discriminator(match):
+    match["image"]["type"] = "OtherImage"
+
+def invalidate_enum(match):
+    match["image"]["gender"] = "x"
+
+def invalidate_nested_list(match):
+    match["image"]["annotations"] = ["a", 1]
+
+
+@pytest.mark.parametrize("invalidate", [invalidate_extra_key, invalidate_missing_key, invalidate_wrong_type,
+                                        invalidate_discriminator, invalidate_enum, invalidate_nested_list])
+def test_rejects_invalid_matches(tmp_path, invalidate):
+    obj = load("flyem-flylight.json")
+    validate = get_validator(model.PrecomputedMatches, str(tmp_path))
+    assert validate(obj)
+    obj = copy.deepcopy(obj)
+    invalidate(obj["results"][3])
+    assert not validate(obj)
+    with pytest.raises(pydantic.ValidationError):
+        model.PrecomputedMatches(**obj)
+
+
+def test_custom_matches(tmp_path):
+    obj = load("flyem-flylight.json")
+    obj["inputImage"] = {"filename": "upload.png", "alignmentSpace": "JRC2018_Unisex_20x_HR",
+                         "anatomicalArea": "Brain", "files": {"store": "prod", "CDM": "upload.png"}}
+    validate = get_validator(model.CustomMatches, str(tmp_path))
+    assert validate(obj)
+    del obj["inputImage"]["filename"]
+    assert not validate(obj)
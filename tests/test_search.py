@@ -0,0 +1,62 @@
+import os
+import json
+
+import numpy as np
+from PIL import Image
+
+from neuronbridge import search
+from neuronbridge.model import LMImage
+
+from cdm_helpers import MAGENTA, BLUE, GREEN, RED, make_cdm
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), "..", "test_data")
+
+
+def make_library(tmp_path, cdms):
+    with open(os.path.join(TEST_DATA, "flyem-flylight.json")) as f:
+        results = json.load(f)["results"]
+    images = [LMImage(**match["image"]) for match in results[:len(cdms)]]
+    cdm_dir = tmp_path / "cdms"
+    for image, arr in zip(images, cdms):
+        path = cdm_dir / image.files.CDM
+        path.parent.mkdir(parents=True, exist_ok=True)
+        Image.fromarray(arr).save(path)
+    return images, search.pack_library(images, str(cdm_dir), str(tmp_path / "library"), threads=2)
+
+
+def test_pack_library(tmp_path):
+    cdms = [make_cdm({(1, i): RED}) for i in range(3)]
+    images, library = make_library(tmp_path, cdms)
+    assert len(library) == 3
+    assert library.shape == (8, 10)
+    assert isinstance(library.cdms, np.memmap)
+    assert np.array_equal(library.cdms[2], cdms[2])
+    assert library.image(1) == images[1]
+    assert sum(c.count for c in library.library_configs()) == 3
+
+    reopened = search.Library(str(tmp_path / "library"))
+    assert reopened.paths == [image.files.CDM for image in images]
+
+
+def test_search(tmp_path):
+    mask = make_cdm({(1, 1): RED, (2, 2): GREEN, (3, 3): BLUE, (4, 4): MAGENTA})
+    cdms = [
+        make_cdm({(1, 1): RED, (2, 2): GREEN}),     # half of the pixels
+        np.zeros_like(mask),                        # empty
+        mask,                                       # identical
+        mask[:, ::-1],                              # mirrored
+    ]
+    images, library = make_library(tmp_path, cdms)
+
+    for cores in (1, 2):
+        matches = search.search(library, mask, filename="mask.png", cores=cores, batch_size=2)
+        assert [m.image.id for m in matches.results] == [images[2].id, images[3].id, images[0].id]
+        assert [m.matchingPixels for m in matches.results] == [4, 4, 2]
+        assert [m.normalizedScore for m in matches.results] == [1.0, 1.0, 0.5]
+        assert [m.mirrored for m in matches.results] == [False, True, False]
+        assert matches.inputImage.filename == "mask.png"
+        assert matches.inputImage.alignmentSpace == images[0].alignmentSpace
+        assert matches.results[0].files.CDMMatch == images[2].files.CDM
+
+    matches = search.search(library, mask, cores=1, mirror_mask=False, max_results=1)
+    assert [m.image.id for m in matches.results] == [images[2].id]
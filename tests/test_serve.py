@@ -0,0 +1,95 @@
+import os
+import json
+import shutil
+import threading
+
+import pytest
+import requests
+
+from neuronbridge import serve
+from neuronbridge.client import Client
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), "..", "test_data")
+
+
+@pytest.fixture
+def server(tmp_path):
+    """ Serve a minimal release tree, laid out like on disk rather than like the bucket.
+    """
+    release = tmp_path / "v3.4.0"
+    (release / "brain+vnc" / "mips" / "embodies").mkdir(parents=True)
+    (release / "vnc" / "cdmatches" / "em-vs-lm").mkdir(parents=True)
+    shutil.copy(os.path.join(TEST_DATA, "em-body.json"), release / "brain+vnc" / "mips" / "embodies" / "1734696429.json")
+    shutil.copy(os.path.join(TEST_DATA, "flyem-flylight.json"), release / "vnc" / "cdmatches" / "em-vs-lm" / "2945073143148142603.json")
+    config = {
+        "anatomicalAreas": {"Brain": {"label": "Brain", "alignmentSpace": "JRC2018_Unisex_20x_HR"}},
+        "stores": {
+            "prod": {
+                "label": "Brain",
+                "anatomicalArea": "Brain",
+                "prefixes": {"CDSResults": "https://janelia-neuronbridge-data-prod.s3.amazonaws.com/v3.4.0/metadata/cdsresults/"},
+                "customSearch": {"searchFolder": "searchable_neurons", "lmLibraries": [], "emLibraries": []},
+            }
+        },
+    }
+    (release / "config.json").write_text(json.dumps(config))
+
+    server = serve.serve({"v3.4.0": str(release)}, "127.0.0.1", 0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_client(server):
+    assert requests.get(f"{server.url}/current.txt").text == "v3.4.0\n"
+    client = Client(data_url=f"{server.url}/v3.4.0")
+    em_image = client.get_em_image(1734696429)
+    assert em_image.publishedName == "1734696429"
+    assert len(client.get_cds_matches(em_image)) == 615
+    # Missing files are distinguished from other errors
+    with pytest.raises(FileNotFoundError):
+        client._get_bytes(f"{server.url}/v3.4.0/metadata/by_body/missing.json")
+
+
+def test_http_features(server):
+    url = f"{server.url}/v3.4.0/metadata/cdsresults/2945073143148142603.json"
+    with open(os.path.join(TEST_DATA, "flyem-flylight.json"), "rb") as f:
+        data = f.read()
+
+    res = requests.get(url)
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert int(res.headers["Content-Length"]) < len(data)
+    assert res.content == data
+    assert requests.get(url, headers={"If-None-Match": res.headers["ETag"]}).status_code == 304
+
+    res = requests.get(url, headers={"Accept-Encoding": "identity", "Range": "bytes=10-19"})
+    assert res.status_code == 206
+    assert res.content == data[10:20]
+    assert res.headers["Content-Range"] == f"bytes 10-19/{len(data)}"
+    assert requests.get(url, headers={"Range": "bytes=-5"}).content == data[-5:]
+    assert requests.get(url, headers={"Range": f"bytes={len(data)}-"}).status_code == 416
+
+    res = requests.head(url, headers={"Accept-Encoding": "identity"})
+    assert int(res.headers["Content-Length"]) == len(data)
+    assert requests.get(f"{server.url}/v3.4.0/metadata/by_body/missing.json").status_code == 404
+    assert requests.get(f"{server.url}/v3.4.0/../../etc/passwd").status_code == 404
+
+
+def test_parse_range():
+    assert serve.parse_range("bytes=0-99", 50) == (0, 49)
+    assert serve.parse_range("bytes=0-1,5-6", 50) is None
+    with pytest.raises(ValueError):
+        serve.parse_range("bytes=60-", 50)
+
+
+def test_file_cache_evicts_by_size():
+    cache = serve.FileCache(max_bytes=10)
+    cache.put("a", serve.CachedFile("1", b"12345", None))
+    cache.put("b", serve.CachedFile("1", b"12345", None))
+    assert cache.get("a", "1") is not None
+    cache.put("c", serve.CachedFile("1", b"12345", None))
+    assert cache.get("b", "1") is None
+    assert cache.get("a", "2") is None
+    assert cache.nbytes == 10
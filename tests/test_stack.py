@@ -0,0 +1,111 @@
+import io
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from neuronbridge import serve
+from neuronbridge.stack import RangedFile, LazyFrames
+
+
+@pytest.fixture
+def remote_file(tmp_path):
+    """ Serve a binary file over HTTP with range support.
+    """
+    data = os.urandom(100_000)
+    release = tmp_path / "v3.4.0"
+    release.mkdir()
+    (release / "stack.h5j").write_bytes(data)
+    server = serve.serve({"v3.4.0": str(release)}, "127.0.0.1", 0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"{server.url}/v3.4.0/stack.h5j", data
+    server.shutdown()
+    server.server_close()
+
+
+def test_ranged_file(remote_file):
+    url, data = remote_file
+    f = RangedFile(url, block_size=4096, cache_blocks=4)
+    f.seek(50_000)
+    assert f.read(10_000) == data[50_000:60_000]
+    assert f.size == len(data)
+    assert f.requests == 3
+    assert f.bytes_fetched == 3 * 4096
+
+    # Cached blocks are not fetched again
+    f.seek(52_000)
+    assert f.read(100) == data[52_000:52_100]
+    assert f.requests == 3
+
+    assert f.seek(-10, io.SEEK_END) == len(data) - 10
+    assert f.read() == data[-10:]
+    assert f.read(10) == b""
+    assert len(f._blocks) <= 4
+
+    f.seek(0)
+    assert io.BufferedReader(f).read() == data
+
+
+def test_lazy_frames():
+    produced = []
+
+    def frames():
+        for i in range(10):
+            produced.append(i)
+            yield np.full((6, 8), i, dtype=np.uint8)
+
+    stack = LazyFrames(frames, (10, 5, 7))
+    assert stack[2].shape == (5, 7)
+    assert stack[2][0, 0] == 2
+    assert produced == [0, 1, 2]
+
+    assert stack[1:4, 0, 0].tolist() == [1, 2, 3]
+    assert stack[[5, 0], :2, :3].shape == (2, 2, 3)
+    assert produced == list(range(6))
+
+    assert stack[-1][0, 0] == 9
+    assert np.asarray(stack).shape == (10, 5, 7)
+    with pytest.raises(IndexError):
+        stack[10]
+
+
+def test_image_stack(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    av = pytest.importorskip("av")
+    from neuronbridge.stack import ImageStack
+
+    # Encode two channels of 12 frames as videos, laid out like an H5J file
+    z, y, x = 12, 32, 48
+    channels = [np.tile(np.linspace(0, 200, x, dtype=np.uint8), (z, y, 1)) + c * 20 for c in range(2)]
+    filepath = tmp_path / "stack.h5j"
+    with h5py.File(filepath, "w") as f:
+        f.attrs["image_size"] = [x, y, z]
+        f.attrs["voxel_size"] = [0.5, 0.5, 1.0]
+        group = f.create_group("Channels")
+        for c, frames in enumerate(channels):
+            buf = io.BytesIO()
+            with av.open(buf, mode="w", format="mp4") as container:
+                stream = container.add_stream("libx264", rate=10)
+                stream.width, stream.height, stream.pix_fmt = x, y, "yuv420p"
+                stream.options = {"crf": "0"}
+                for frame in frames:
+                    rgb = np.repeat(frame[..., None], 3, axis=2)
+                    for packet in stream.encode(av.VideoFrame.from_ndarray(rgb, format="rgb24")):
+                        container.mux(packet)
+                for packet in stream.encode():
+                    container.mux(packet)
+            group.create_dataset(f"Channel_{c}", data=np.frombuffer(buf.getvalue(), dtype=np.uint8))
+
+    with ImageStack(str(filepath)) as stack:
+        assert stack.shape == (2, z, y, x)
+        assert stack.voxel_size == (0.5, 0.5, 1.0)
+        assert stack[1, 3].shape == (y, x)
+        assert np.abs(stack[1, 3].astype(int) - channels[1][3]).max() <= 8
+        assert stack[:, 0:2].shape == (2, 2, y, x)
+        assert np.array_equal(stack[-1, 3], stack[1, 3])
+        assert stack[[-2, 1], 0].shape == (2, y, x)
+        for c in (2, -3, [0, 2]):
+            with pytest.raises(IndexError):
+                stack[c, 0]
@@ -0,0 +1,62 @@
+import numpy as np
+
+from neuronbridge.swc import Skeleton, read_swc, skeletons_in_box
+
+SWC = b"""# Skeleton of a small body
+# id type x y z radius parent
+1 1 0 0 0 2.5 -1
+2 3 3 4 0 1 1
+3 3 3 4 10 1 2
+4 3 20 20 20 1 2
+"""
+
+
+def test_read_swc(tmp_path):
+    skeleton = read_swc(SWC)
+    assert len(skeleton) == 4
+    assert skeleton.header == ["# Skeleton of a small body", "# id type x y z radius parent"]
+    assert skeleton.ids.tolist() == [1, 2, 3, 4]
+    assert skeleton.types.tolist() == [1, 3, 3, 3]
+    assert skeleton.radii.tolist() == [2.5, 1, 1, 1]
+    assert skeleton.parents.tolist() == [-1, 1, 2, 2]
+    assert skeleton.coords.shape == (4, 3)
+    assert skeleton.coords.dtype == np.float32
+    assert skeleton.parent_index.tolist() == [-1, 0, 1, 1]
+
+    path = tmp_path / "body.swc"
+    path.write_bytes(SWC)
+    with open(path, "rb") as f:
+        assert read_swc(f).nodes.tolist() == skeleton.nodes.tolist()
+    assert read_swc(str(path)).nodes.tolist() == skeleton.nodes.tolist()
+    assert read_swc(skeleton.to_swc().encode()).nodes.tolist() == skeleton.nodes.tolist()
+
+
+def test_read_swc_variants():
+    assert len(read_swc(b"# no nodes\n")) == 0
+    skeleton = read_swc(b"1.0 1 0 0 0 1 -1.0\n\n2.0 1 1 0 0 1 1.0 # tip\n")
+    assert skeleton.ids.tolist() == [1, 2]
+    assert skeleton.parents.tolist() == [-1, 1]
+
+
+def test_geometry():
+    skeleton = read_swc(SWC)
+    assert skeleton.bounds().tolist() == [[0, 0, 0], [20, 20, 20]]
+    assert skeleton.cable_length() == 5 + 10 + np.sqrt(17**2 + 16**2 + 20**2).astype(np.float32)
+    assert skeleton.in_box([0, 0, 0], [5, 5, 5]).tolist() == [True, True, False, False]
+    assert skeleton.intersects([2, 2, 5], [4, 5, 12])
+    assert not skeleton.intersects([5, 5, 5], [10, 10, 10])
+
+    cropped = skeleton.crop([1, 1, 0], [30, 30, 30])
+    assert cropped.ids.tolist() == [2, 3, 4]
+    assert cropped.parents.tolist() == [-1, 2, 2]
+
+
+def test_skeletons_in_box():
+    skeletons = {
+        "a": read_swc(SWC),
+        "b": read_swc(b"1 1 100 100 100 1 -1\n"),
+        "c": Exception("Could not retrieve"),
+        "d": Skeleton(read_swc(b"").nodes),
+    }
+    assert skeletons_in_box(skeletons, [0, 0, 0], [50, 50, 50]) == ["a"]
+    assert skeletons_in_box(skeletons, [0, 0, 0], [500, 500, 500]) == ["a", "b"]
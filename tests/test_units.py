@@ -0,0 +1,16 @@
+from neuronbridge.units import parse_size, format_size
+
+
+def test_parse_size():
+    assert parse_size("4G") == 4000000000
+    assert parse_size("500mb") == 500000000
+    assert parse_size("500K") == 500000
+    assert parse_size("10MB") == 10000000
+    assert parse_size(" 1.5T ") == 1500000000000
+    assert parse_size("1024") == 1024
+
+
+def test_format_size():
+    assert format_size(512) == "512.0 B"
+    assert format_size(1500000) == "1.5 MB"
+    assert format_size(2 * 10**12) == "2.0 TB"
@@ -0,0 +1,98 @@
+import argparse
+
+import pytest
+
+from neuronbridge import validate_ray
+
+
+def test_parse_shard():
+    assert validate_ray.parse_shard("2/8") == (2, 8)
+    with pytest.raises(argparse.ArgumentTypeError):
+        validate_ray.parse_shard("8/8")
+
+
+def test_shards_partition_files():
+    files = [f"{i}.json" for i in range(1000)]
+    shards = [[f for f in files if validate_ray.in_shard(f, (i, 4))] for i in range(4)]
+    assert sorted(sum(shards, [])) == sorted(files)
+    assert all(shards)
+    assert all(validate_ray.in_shard(f, None) for f in files)
+
+
+def test_batch_id_is_stable():
+    batch_id = validate_ray.get_batch_id("/data/matches", ["a.json", "b.json"])
+    assert batch_id == validate_ray.get_batch_id("/data/matches", ["a.json", "b.json"])
+    assert batch_id != validate_ray.get_batch_id("/data/matches", ["a.json"])
+    assert batch_id != validate_ray.get_batch_id("/data/other", ["a.json", "b.json"])
+
+
+def test_checkpoint_resume_and_merge(tmp_path, capsys):
+    checkpoint_dir = str(tmp_path)
+    images = {"warnings": {}, "errors": {"No images": 1}}
+    matches = {"warnings": {"Missing mountingProtocol": 2}, "errors": {}}
+
+    checkpoint = validate_ray.Checkpoint(checkpoint_dir, (0, 2))
+    checkpoint.record("img", "images", images, {"B", "A"})
+    checkpoint.record("m0", "matches", matches)
+    checkpoint.close()
+
+    resumed = validate_ray.Checkpoint(checkpoint_dir, (0, 2), resume=True)
+    assert "img" in resumed and "m0" in resumed
+    assert resumed.get("img")["published_names"] == ["A", "B"]
+    resumed.close()
+
+    # Every shard validates the image lookups, but they are only counted once
+    other = validate_ray.Checkpoint(checkpoint_dir, (1, 2))
+    other.record("img", "images", images, {"A", "B"})
+    other.record("m1", "matches", matches)
+    other.file_handle.write('{"batch": "trunc')
+    other.close()
+
+    assert validate_ray.merge_checkpoints(checkpoint_dir) == 1
+    out = capsys.readouterr().out
+    assert "Merged 3 batches from 2 checkpoint files" in out
+    assert "[ERROR] No images: 1" in out
+    assert "[WARN] Missing mountingProtocol: 4" in out
+
+    restarted = validate_ray.Checkpoint(checkpoint_dir, (0, 2))
+    assert "img" not in restarted
+    restarted.close()
+
+
+def test_merge_asset_checks(tmp_path, capsys):
+    checkpoint_dir = str(tmp_path)
+    assert validate_ray.get_asset_batch_id(None) == "assets_0_of_1"
+    # Each shard checks the assets of its own batches
+    for shard, missing in [((0, 2), 5), ((1, 2), 6)]:
+        checkpoint = validate_ray.Checkpoint(checkpoint_dir, shard)
+        counts = {"warnings": {}, "errors": {"Missing CDM asset": missing}}
+        checkpoint.record(validate_ray.get_asset_batch_id(shard), "assets", counts, stats={"files": 10})
+        checkpoint.close()
+
+    assert validate_ray.merge_checkpoints(checkpoint_dir) == 1
+    out = capsys.readouterr().out
+    assert "Merged 2 batches from 2 checkpoint files" in out
+    assert "[ERROR] Missing CDM asset: 11" in out
+
+
+def test_collect_batches_by_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(validate_ray, "BATCH_SIZE", 3)
+    monkeypatch.setattr(validate_ray, "BATCH_BYTES", 100)
+    sizes = {"a.json": 10, "b.json": 500, "c.json": 40, "d.json": 40, "e.json": 10, "f.json": 10, "g.json": 10}
+    for name, size in sizes.items():
+        (tmp_path / name).write_bytes(b"x" * size)
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "h.json").write_bytes(b"x" * 5)
+
+    batches = validate_ray.collect_batches(str(tmp_path), "matches")
+    assert [(b[1], b[2]) for b in batches] == [
+        (["a.json"], 10),
+        (["b.json"], 500),
+        (["c.json", "d.json", "e.json"], 90),
+        (["f.json", "g.json"], 20),
+        (["h.json"], 5),
+    ]
+
+    batches = validate_ray.collect_batches(str(tmp_path), "matches", one_batch=True)
+    assert [b[1] for b in batches] == [["a.json"], ["h.json"]]
+
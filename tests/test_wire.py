@@ -0,0 +1,129 @@
+import os
+import json
+import pickle
+
+import msgpack
+import pytest
+
+from neuronbridge import wire
+from neuronbridge.model import DataConfig, ImageLookup, PrecomputedMatches, Files, LMImage, CDSMatch
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), "..", "test_data")
+
+
+class CustomLMImage(LMImage):
+    """ A subclass defined outside of the models, which the wire format does not know.
+    """
+
+
+def read(filename:str):
+    with open(os.path.join(TEST_DATA, filename)) as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize("model_class,filename", [
+    (PrecomputedMatches, "flyem-flylight.json"),
+    (PrecomputedMatches, "flyem-flylight-vnc.json"),
+    (ImageLookup, "mcfo-line.json"),
+    (ImageLookup, "em-body.json"),
+])
+def test_round_trip(model_class, filename):
+    obj = model_class(**read(filename))
+    check_round_trip(obj)
+    # The results pickle through the wire format
+    assert pickle.loads(pickle.dumps(obj)) == obj
+    assert len(pickle.dumps(obj)) < len(wire.dumps(obj)) + 100
+
+
+def test_config_round_trip():
+    from test_model import config
+    check_round_trip(DataConfig(**config))
+
+
+def check_round_trip(obj):
+    data = wire.dumps(obj)
+    loaded = wire.loads(data)
+    assert loaded == obj
+    assert loaded.model_dump(exclude_unset=True) == obj.model_dump(exclude_unset=True)
+    assert loaded.model_dump_json() == obj.model_dump_json()
+
+
+def test_compact():
+    matches = PrecomputedMatches(**read("flyem-flylight.json"))
+    assert len(pickle.dumps(matches)) < len(json.dumps(read("flyem-flylight.json"))) / 2
+
+    # Interned strings are shared by the loaded images
+    loaded = pickle.loads(pickle.dumps(matches))
+    images = [match.image for match in loaded.results]
+    assert images[0].libraryName is images[1].libraryName
+    assert images[0].files.store is images[1].files.store
+
+
+def test_fields_set():
+    image = LMImage(**read("mcfo-line.json")["results"][0])
+    image.files.CDMBest = None
+    loaded = pickle.loads(pickle.dumps(image))
+    assert loaded.model_fields_set == image.model_fields_set
+    assert loaded.files.model_fields_set == image.files.model_fields_set
+    assert loaded.files.CDMBest is None
+    assert list(loaded.__dict__) == list(image.__dict__)
+
+    # Paths without a directory, and absolute URLs, come back as they were
+    files = Files(store="prod", CDM="a.png", VisuallyLosslessStack="https://example.org/a/b.h5j")
+    assert wire.loads(wire.dumps(files)) == files
+
+    # The models are still mutable and validated on assignment as usual
+    match = pickle.loads(pickle.dumps(CDSMatch(image=image, files=files, mirrored=False,
+                                               normalizedScore=1.5, matchingPixels=10)))
+    match.mirrored = True
+    assert match.mirrored and "mirrored" in match.model_fields_set
+
+
+def test_counter():
+    pytest.importorskip("ray")
+    from neuronbridge.validate_worker import Counter
+    counter = Counter(max_logs=10)
+    counter.warn("Missing mountingProtocol", "123", "a.json")
+    counter.error("Missing CDM", "456", "b.json")
+    counter.error("Missing CDM", "789", "b.json")
+    loaded = pickle.loads(pickle.dumps(counter))
+    assert loaded.counts() == counter.counts()
+    assert loaded.max_logs == 10
+    assert loaded.buffer == []
+    assert not loaded.sample("Missing CDM", "456")
+    loaded.error("Missing CDM", "000", "c.json")
+    assert loaded.errors["Missing CDM"] == 3
+
+
+def test_subclasses():
+    lookup = ImageLookup(**read("mcfo-line.json"))
+    image = CustomLMImage(**lookup.results[0].model_dump())
+    with pytest.raises(wire.UnknownType, match="CustomLMImage"):
+        wire.dumps(image)
+
+    # Subclasses pickle as usual, including when they are nested in known models
+    loaded = pickle.loads(pickle.dumps(image))
+    assert type(loaded) is CustomLMImage and loaded == image
+    lookup.results[0] = image
+    loaded = pickle.loads(pickle.dumps(lookup))
+    assert type(loaded.results[0]) is CustomLMImage and loaded == lookup
+
+    # Other errors are not hidden by falling back to pickle
+    broken = lookup.results[1].model_copy()
+    assert "publishedName" in broken.model_fields_set
+    del broken.__dict__["publishedName"]
+    with pytest.raises(KeyError):
+        pickle.dumps(broken)
+
+
+def test_versions():
+    data = wire.dumps(Files(store="prod"))
+    version, layout, strings, payload = msgpack.unpackb(data)
+    with pytest.raises(ValueError, match="version"):
+        wire.loads(msgpack.packb([version + 1, layout, strings, payload]))
+    with pytest.raises(ValueError, match="different version"):
+        wire.loads(msgpack.packb([version, layout + 1, strings, payload]))
+    with pytest.raises(ValueError):
+        wire.loads(b"not msgpack")
+    with pytest.raises(wire.UnknownType):
+        wire.dumps(object())